@@ -97,6 +97,33 @@ DATABASES = {
     'default': dj_database_url.config(),
 }
 
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    # The results of the Book reports, see BOOK_CACHE below.
+    "books": {
+        "BACKEND": os.environ.get(
+            "BOOK_CACHE_BACKEND",
+            "django.core.cache.backends.locmem.LocMemCache",
+        ),
+        "LOCATION": os.environ.get("BOOK_CACHE_LOCATION", "books"),
+        "TIMEOUT": int(os.environ.get("BOOK_CACHE_TIMEOUT", 3600)),
+    },
+}
+# The cache alias used for the Book reports, see gemcore.models.cached_report.
+# Every process changing entries (web workers, the import worker, management
+# commands) forgets the reports of the books it changes, so the cache must be
+# shared by all of them: reports are only cached when BOOK_CACHE_BACKEND is
+# set, for example to django.core.cache.backends.redis.RedisCache (with
+# BOOK_CACHE_LOCATION=redis://127.0.0.1:6379) or to
+# django.core.cache.backends.db.DatabaseCache (with BOOK_CACHE_LOCATION set
+# to a table created by the createcachetable command).
+BOOK_CACHE = "books" if os.environ.get("BOOK_CACHE_BACKEND") else None
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.10/ref/settings/#auth-password-validators
@@ -128,7 +155,12 @@ USE_TZ = True
 
 STATIC_ROOT = os.path.join(BASE_DIR, "staticfiles")
 STATIC_URL = "/static/"
+# Uploaded files, only kept until imported.
+MEDIA_ROOT = os.environ.get("MEDIA_ROOT", os.path.join(BASE_DIR, "media"))
 STORAGES = {
+    "default": {
+        "BACKEND": "django.core.files.storage.FileSystemStorage",
+    },
     "staticfiles": {
         "BACKEND": "whitenoise.storage.CompressedManifestStaticFilesStorage",
     },
@@ -170,6 +202,16 @@ ENTRY_TAGS = [
     ("UT", "Utilities"),
 ]
 ENTRY_DEFAULT_TAG = "IM"
+# Maximum amount of entries accepted by a single API batch request.
+API_BATCH_MAX_SIZE = int(os.environ.get("API_BATCH_MAX_SIZE", 1000))
+# Every how many values tagged the cost of each tag rule is measured, 0 to
+# never measure it (matches are always counted).
+TAG_RULES_PROFILE_EVERY = int(os.environ.get("TAG_RULES_PROFILE_EVERY", 100))
+# Directory watched for files to import, see the watchinbox command.
+IMPORT_INBOX = os.environ.get("IMPORT_INBOX")
+# Seconds without progress after which an import job still running is
+# considered abandoned by its worker, and claimed again.
+IMPORT_JOB_TIMEOUT = int(os.environ.get("IMPORT_JOB_TIMEOUT", 3 * 3600))
 
 LOGGING = {
     "version": 1,
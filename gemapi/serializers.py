@@ -1,5 +1,8 @@
 from django.conf import settings
+from django.db import IntegrityError, transaction
 from rest_framework import serializers
+from rest_framework.settings import api_settings
+from rest_framework.validators import UniqueTogetherValidator
 
 from gemcore.constants import REVERSED_TAGS, ChoicesMixin
 from gemcore.models import Account, Book, Entry
@@ -11,24 +14,152 @@ class BackwardCompatibleTagField(serializers.ChoiceField):
         return super().to_internal_value(data)
 
 
+class PrefetchedSlugRelatedField(serializers.SlugRelatedField):
+    """A SlugRelatedField using the objects prefetched by a list serializer.
+
+    Slugs not prefetched (or serializers used on their own) fall back to the
+    regular one query per lookup.
+
+    """
+
+    def to_internal_value(self, data):
+        prefetched = self.context.get("prefetched", {}).get(self.field_name)
+        if prefetched and isinstance(data, str) and data in prefetched:
+            return prefetched[data]
+        return super().to_internal_value(data)
+
+
+class EntryListSerializer(serializers.ListSerializer):
+    """Validate and create many entries at once, skipping the invalid ones.
+
+    Unlike the default list serializer, invalid items do not make the whole
+    list invalid: they are left out of `validated_data`. After saving,
+    `statuses` has the outcome of every item, in the order given.
+
+    """
+
+    UNIQUE_FIELDS = Entry._meta.unique_together[0]
+    UNIQUE_ERROR = UniqueTogetherValidator.message.format(
+        field_names=", ".join(UNIQUE_FIELDS)
+    )
+
+    def prefetch(self, data):
+        prefetched = {}
+        for name, field in self.child.fields.items():
+            if not isinstance(field, PrefetchedSlugRelatedField):
+                continue
+            slugs = {
+                item.get(name)
+                for item in data
+                if isinstance(item, dict) and isinstance(item.get(name), str)
+            }
+            queryset = field.get_queryset().filter(
+                **{field.slug_field + "__in": slugs}
+            )
+            prefetched[name] = {
+                getattr(o, field.slug_field): o for o in queryset
+            }
+        self._context["prefetched"] = prefetched
+
+    def to_internal_value(self, data):
+        self.statuses = []
+        self.keys = set()
+        if isinstance(data, list):
+            self.prefetch(data)
+        result = super().to_internal_value(data)
+        return [item for item in result if item is not None]
+
+    def run_child_validation(self, data):
+        try:
+            result = super().run_child_validation(data)
+            key = tuple(result[name] for name in self.UNIQUE_FIELDS)
+            if key in self.keys:
+                raise serializers.ValidationError(
+                    {api_settings.NON_FIELD_ERRORS_KEY: [self.UNIQUE_ERROR]},
+                    code="unique",
+                )
+            self.keys.add(key)
+        except serializers.ValidationError as e:
+            self.statuses.append({"status": 400, "errors": e.detail})
+            return None
+        self.statuses.append(None)
+        return result
+
+    def create(self, validated_data):
+        pending = [i for i, status in enumerate(self.statuses) if not status]
+        entries = [Entry(**item) for item in validated_data]
+        try:
+            Entry.objects.bulk_create(entries)
+        except IntegrityError:
+            # Some entry was created meanwhile, save one entry at a time so
+            # only the offending ones fail.
+            entries = [
+                self._save_entry(i, e) for i, e in zip(pending, entries)
+            ]
+
+        for i, entry in zip(pending, entries):
+            if entry is not None:
+                self.statuses[i] = {
+                    "status": 201,
+                    "entry": self.child.to_representation(entry),
+                }
+        return [entry for entry in entries if entry is not None]
+
+    def _save_entry(self, index, entry):
+        try:
+            with transaction.atomic():
+                entry.pk = None
+                entry.save(force_insert=True)
+        except IntegrityError:
+            self.statuses[index] = {
+                "status": 400,
+                "errors": {
+                    api_settings.NON_FIELD_ERRORS_KEY: [self.UNIQUE_ERROR]
+                },
+            }
+            return None
+        return entry
+
+
 class EntrySerializer(serializers.ModelSerializer):
-    book = serializers.SlugRelatedField(
+    book = PrefetchedSlugRelatedField(
         slug_field="slug", queryset=Book.objects.all()
     )
-    account = serializers.SlugRelatedField(
+    account = PrefetchedSlugRelatedField(
         slug_field="slug", queryset=Account.objects.all()
     )
     who = serializers.ReadOnlyField(source="who.username")
 
+    def get_suggester(self, account):
+        # Shared by all the entries of a list, through the root's context.
+        suggesters = self.context.setdefault("suggesters", {})
+        if account.pk not in suggesters:
+            suggesters[account.pk] = account.tag_suggester()
+        return suggesters[account.pk]
+
     def validate(self, data):
+        """Tag entries given no tags, and set their asset, as imports do.
+
+        See CSVParser.find_tags.
+
+        """
         tags = data.get("tags")
         if tags is None:
-            tags = data["account"].tags_for(data["what"]).keys()
+            account = data["account"]
+            tags_dict = account.tags_for(data["what"])
+            tags = list(tags_dict)
+            assets = {a.pk for _, a in tags_dict.values() if a is not None}
+            asset = assets.pop() if len(assets) == 1 else None
+            if not tags and account.suggest_tags:
+                tags, asset = self.get_suggester(account).suggest(data["what"])
+            if asset is not None:
+                data.setdefault("asset_id", asset)
         data["tags"] = tags or [settings.ENTRY_DEFAULT_TAG]
         return data
 
     class Meta:
         model = Entry
+        list_serializer_class = EntryListSerializer
         fields = [
             "book",
             "account",
@@ -1,17 +1,19 @@
 import random
+from datetime import date
 from decimal import Decimal
 
 from django.conf import settings
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
 from gemcore.constants import TAGS, ChoicesMixin
-from gemcore.models import Entry
+from gemcore.models import Asset, Entry, TagToken
 from gemcore.tests.helpers import BaseTestCase
 
 
-class AddEntryViewTestCase(BaseTestCase):
-    url = reverse("api:entry-list")
-
+class BaseAPITestCase(BaseTestCase):
     def make_auth_header(self, user=None):
         token = self.factory.make_token(user=user)
         return {"HTTP_AUTHORIZATION": "Token " + token.key}
@@ -32,6 +34,10 @@ class AddEntryViewTestCase(BaseTestCase):
         data.update(kwargs)
         return data
 
+
+class AddEntryViewTestCase(BaseAPITestCase):
+    url = reverse("api:entry-list")
+
     def test_authentication_required(self):
         for method in ("GET", "OPTIONS", "PATCH", "POST", "PUT", "DELETE"):
             with self.subTest(method=method):
@@ -89,6 +95,49 @@ class AddEntryViewTestCase(BaseTestCase):
         entry = Entry.objects.get()
         self.assertEqual(entry.tags, [settings.ENTRY_DEFAULT_TAG])
 
+    def test_tags_suggested_if_tags_missing(self):
+        user = self.factory.make_user()
+        auth = self.make_auth_header(user=user)
+        account = self.factory.make_account(suggest_tags=True)
+        for i in range(3):
+            self.factory.make_entry(
+                account=account, what="Shell %s" % i, tags=[TAGS[1]]
+            )
+        data = self.make_entry_data(account_slug=account.slug, what="SHELL")
+        data.pop("tags")
+
+        response = self.client.post(self.url, data=data, **auth)
+        self.assertEqual(response.status_code, 201, response.content)
+
+        entry = Entry.objects.get(what="SHELL")
+        self.assertEqual(entry.tags, [TAGS[1]])
+        self.assertIsNone(entry.asset)
+
+    def test_asset_set_if_tags_missing(self):
+        user = self.factory.make_user()
+        auth = self.make_auth_header(user=user)
+        account = self.factory.make_account(suggest_tags=True)
+        car = Asset.objects.create(name="Car", slug="car", since=date.today())
+        account.tagregex_set.create(regex="fuel", tag=TAGS[0], asset=car)
+        house = Asset.objects.create(
+            name="House", slug="house", since=date.today()
+        )
+        for i in range(3):
+            self.factory.make_entry(
+                account=account,
+                what="Roof %s" % i,
+                tags=[TAGS[1]],
+                asset=house,
+            )
+
+        for what, asset in (("fuel", car), ("ROOF", house), ("other", None)):
+            data = self.make_entry_data(account_slug=account.slug, what=what)
+            data.pop("tags")
+            response = self.client.post(self.url, data=data, **auth)
+            self.assertEqual(response.status_code, 201, response.content)
+
+            self.assertEqual(Entry.objects.get(what=what).asset, asset)
+
     def test_tags_by_code(self):
         user = self.factory.make_user()
         auth = self.make_auth_header(user=user)
@@ -116,3 +165,152 @@ class AddEntryViewTestCase(BaseTestCase):
 
         entry = Entry.objects.get()
         self.assertCountEqual(entry.tags, [t1, t2, t3, t4])
+
+
+class BatchEntryViewTestCase(BaseAPITestCase):
+    url = reverse("api:entry-batch")
+
+    def setUp(self):
+        super(BatchEntryViewTestCase, self).setUp()
+        self.user = self.factory.make_user()
+        self.auth = self.make_auth_header(user=self.user)
+        self.book = self.factory.make_book(users=[self.user])
+        self.account = self.factory.make_account(users=[self.user])
+
+    def make_entry_data(self, **kwargs):
+        return super(BatchEntryViewTestCase, self).make_entry_data(
+            book_slug=self.book.slug, account_slug=self.account.slug, **kwargs
+        )
+
+    def post(self, data):
+        return self.client.post(
+            self.url, data=data, content_type="application/json", **self.auth
+        )
+
+    def test_authentication_required(self):
+        response = self.client.post(
+            self.url, data=[], content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 401)
+
+    def test_success(self):
+        data = [self.make_entry_data(what="Test %s" % i) for i in range(5)]
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.post(data)
+
+        self.assertEqual(response.status_code, 201, response.content)
+        result = response.json()
+        self.assertEqual(result["created"], 5)
+        self.assertEqual(result["errors"], 0)
+        self.assertEqual([r["status"] for r in result["results"]], [201] * 5)
+        self.assertEqual(
+            [r["entry"]["what"] for r in result["results"]],
+            [d["what"] for d in data],
+        )
+        entries = Entry.objects.filter(book=self.book, who=self.user)
+        self.assertEqual(entries.count(), 5)
+        inserts = [
+            q
+            for q in queries.captured_queries
+            if q["sql"].startswith('INSERT INTO "gemcore_entry"')
+        ]
+        self.assertEqual(len(inserts), 1)
+
+    def test_tags_suggested(self):
+        self.account.suggest_tags = True
+        self.account.save()
+        for i in range(3):
+            self.factory.make_entry(
+                book=self.book,
+                account=self.account,
+                what="Shell %s" % i,
+                tags=[TAGS[1]],
+            )
+        data = [self.make_entry_data(what="SHELL %s" % i) for i in range(3)]
+        for item in data:
+            item.pop("tags")
+
+        response = self.post(data)
+
+        self.assertEqual(response.status_code, 201, response.content)
+        entries = Entry.objects.filter(what__startswith="SHELL ")
+        self.assertEqual(
+            list(entries.values_list("tags", flat=True)), [[TAGS[1]]] * 3
+        )
+        # Entries saved at once are learned from too.
+        token = TagToken.objects.get(
+            account=self.account, token="shell", tag=""
+        )
+        self.assertEqual(token.count, 6)
+
+    def test_partial_failure(self):
+        self.factory.make_entry(
+            book=self.book,
+            account=self.account,
+            who=self.user,
+            what="Existing",
+            amount=Decimal("10"),
+        )
+        existing = Entry.objects.get()
+        data = [
+            self.make_entry_data(what="Valid"),
+            self.make_entry_data(account="missing"),
+            self.make_entry_data(
+                what="Existing",
+                amount="10",
+                when=existing.when.isoformat(),
+                is_income=existing.is_income,
+            ),
+            self.make_entry_data(what="Valid"),
+            self.make_entry_data(what="Other"),
+        ]
+
+        response = self.post(data)
+
+        self.assertEqual(response.status_code, 207, response.content)
+        result = response.json()
+        self.assertEqual(result["created"], 2)
+        self.assertEqual(result["errors"], 3)
+        statuses = result["results"]
+        self.assertEqual(
+            [r["status"] for r in statuses], [201, 400, 400, 400, 201]
+        )
+        self.assertIn("account", statuses[1]["errors"])
+        unique_error = (
+            "The fields book, account, when, what, amount, is_income must "
+            "make a unique set."
+        )
+        self.assertEqual(
+            statuses[2]["errors"], {"non_field_errors": [unique_error]}
+        )
+        self.assertEqual(
+            statuses[3]["errors"], {"non_field_errors": [unique_error]}
+        )
+        self.assertCountEqual(
+            Entry.objects.values_list("what", flat=True),
+            ["Existing", "Valid", "Other"],
+        )
+
+    def test_all_invalid(self):
+        response = self.post([self.make_entry_data(amount="xx")])
+
+        self.assertEqual(response.status_code, 400, response.content)
+        self.assertEqual(response.json()["created"], 0)
+        self.assertFalse(Entry.objects.exists())
+
+    def test_not_a_list(self):
+        response = self.post(self.make_entry_data())
+
+        self.assertEqual(response.status_code, 400, response.content)
+        self.assertFalse(Entry.objects.exists())
+
+    @override_settings(API_BATCH_MAX_SIZE=2)
+    def test_batch_size_limit(self):
+        data = [self.make_entry_data(what="Test %s" % i) for i in range(3)]
+
+        response = self.post(data)
+
+        self.assertEqual(response.status_code, 400, response.content)
+        self.assertIn("no more than 2", response.content.decode("utf-8"))
+        self.assertFalse(Entry.objects.exists())
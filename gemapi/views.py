@@ -1,13 +1,15 @@
 import subprocess
 
-from rest_framework import mixins, viewsets
+from django.conf import settings
+from rest_framework import mixins, status, viewsets
 from rest_framework.authentication import TokenAuthentication
+from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from gemapi.serializers import EntrySerializer
-from gemcore.models import Entry
+from gemcore.models import Entry, flush_tag_rule_stats
 
 
 class AddEntryView(mixins.CreateModelMixin, viewsets.GenericViewSet):
@@ -20,6 +22,42 @@ class AddEntryView(mixins.CreateModelMixin, viewsets.GenericViewSet):
     # 4-authentication-and-permissions/#associating-snippets-with-users
     def perform_create(self, serializer):
         serializer.save(who=self.request.user)
+        flush_tag_rule_stats()
+
+    @action(detail=False, methods=["post"])
+    def batch(self, request):
+        """Create many entries from a JSON array, in a single INSERT.
+
+        Invalid items are reported without preventing the valid ones from
+        being created. The response has the status of each item, in the
+        order given.
+
+        """
+        serializer = self.get_serializer(
+            data=request.data,
+            many=True,
+            max_length=settings.API_BATCH_MAX_SIZE,
+        )
+        serializer.is_valid(raise_exception=True)
+        serializer.save(who=request.user)
+        flush_tag_rule_stats()
+
+        results = serializer.statuses
+        created = sum(1 for r in results if r["status"] == 201)
+        if created == len(results):
+            code = status.HTTP_201_CREATED
+        elif created:
+            code = status.HTTP_207_MULTI_STATUS
+        else:
+            code = status.HTTP_400_BAD_REQUEST
+        return Response(
+            {
+                "created": created,
+                "errors": len(results) - created,
+                "results": results,
+            },
+            status=code,
+        )
 
 
 class VersionView(APIView):
@@ -6,6 +6,8 @@ from gemcore.models import (
     Book,
     Entry,
     EntryHistory,
+    ImportJob,
+    ImportRun,
     ParserConfig,
     TagRegex,
 )
@@ -15,6 +17,7 @@ class TagRegexInline(admin.StackedInline):
     model = TagRegex
     extra = 1
     fk_name = "account"
+    readonly_fields = ("hits", "overlaps", "shadowed")
 
 
 class AccountAdmin(admin.ModelAdmin):
@@ -23,19 +26,38 @@ class AccountAdmin(admin.ModelAdmin):
         "slug",
         "currency",
         "active",
+        "suggest_tags",
         "people",
         "parser_config",
     )
     list_filter = (
         "active",
         "currency",
+        "suggest_tags",
     )
     prepopulated_fields = {"slug": ("name",)}
     inlines = (TagRegexInline,)
+    actions = ("retag_entries",)
 
     def people(self, instance):
         return ", ".join(u.username for u in instance.users.all())
 
+    @admin.action(description="Re-tag entries with the current tag rules")
+    def retag_entries(self, request, queryset):
+        for account in queryset:
+            result = account.retag_entries()
+            self.message_user(
+                request,
+                "Re-tagged %s of %s entries for %s, %s left alone because of "
+                "conflicting assets."
+                % (
+                    result["changed"],
+                    result["entries"],
+                    account.slug,
+                    result["conflicts"],
+                ),
+            )
+
 
 class AssetAdmin(admin.ModelAdmin):
     list_display = (
@@ -90,6 +112,34 @@ class EntryHistoryAdmin(admin.ModelAdmin):
     pass
 
 
+class ImportJobAdmin(admin.ModelAdmin):
+    list_display = (
+        "__str__",
+        "book",
+        "status",
+        "rows",
+        "entry_count",
+        "error_count",
+        "created",
+        "finished",
+    )
+    list_filter = ("status", "account")
+
+
+class ImportRunAdmin(admin.ModelAdmin):
+    list_display = (
+        "__str__",
+        "book",
+        "content_hash",
+        "rows",
+        "entry_count",
+        "skipped",
+        "error_count",
+        "created",
+    )
+    list_filter = ("account",)
+
+
 class ParserConfigAdmin(admin.ModelAdmin):
     list_display = (
         "name",
@@ -111,9 +161,38 @@ class ParserConfigAdmin(admin.ModelAdmin):
 
 
 class TagRegexAdmin(admin.ModelAdmin):
-    list_display = ("regex", "tag", "account")
+    list_display = (
+        "regex",
+        "tag",
+        "account",
+        "hits",
+        "overlaps",
+        "shadowed",
+        "cost_us",
+        "seconds",
+        "dead",
+        "slow",
+    )
     list_filter = ("account", "asset", "tag")
     search_fields = ("regex",)
+    actions = ("reset_stats",)
+
+    @admin.display(description="µs per evaluation", ordering="seconds")
+    def cost_us(self, obj):
+        return None if obj.cost is None else round(obj.cost * 1e6, 2)
+
+    @admin.display(boolean=True)
+    def dead(self, obj):
+        return obj.is_dead
+
+    @admin.display(boolean=True)
+    def slow(self, obj):
+        return obj.is_slow
+
+    @admin.action(description="Reset the usage stats of the rules")
+    def reset_stats(self, request, queryset):
+        count = queryset.update(**dict.fromkeys(TagRegex.STATS_FIELDS, 0))
+        self.message_user(request, "Reset the stats of %s rules." % count)
 
 
 admin.site.register(Account, AccountAdmin)
@@ -121,5 +200,7 @@ admin.site.register(Asset, AssetAdmin)
 admin.site.register(Book, BookAdmin)
 admin.site.register(Entry, EntryAdmin)
 admin.site.register(EntryHistory, EntryHistoryAdmin)
+admin.site.register(ImportJob, ImportJobAdmin)
+admin.site.register(ImportRun, ImportRunAdmin)
 admin.site.register(ParserConfig, ParserConfigAdmin)
 admin.site.register(TagRegex, TagRegexAdmin)
@@ -1,7 +1,8 @@
 from datetime import date
 
 from django import forms
-from django.db import IntegrityError, transaction
+from django.core.exceptions import NON_FIELD_ERRORS, ValidationError
+from django.db import IntegrityError, models, transaction
 from django_countries import countries
 
 from gemcore.constants import ChoicesMixin
@@ -91,6 +92,9 @@ class TagsCheckboxSelectMultiple(forms.CheckboxSelectMultiple):
 
 
 class EntryForm(forms.ModelForm):
+    DUPLICATED_ENTRY_ERROR = "There is already an entry for this data."
+    MISSING_TAGS_ERROR = "Missing tags, choose at least one."
+
     def __init__(self, book, *args, **kwargs):
         self.book = book
         super(EntryForm, self).__init__(*args, **kwargs)
@@ -104,7 +108,7 @@ class EntryForm(forms.ModelForm):
     def clean(self):
         cleaned_data = super(EntryForm, self).clean()
         if not cleaned_data.get("tags"):
-            raise forms.ValidationError("Missing tags, choose at least one.")
+            raise forms.ValidationError(self.MISSING_TAGS_ERROR)
         return cleaned_data
 
     @transaction.atomic
@@ -114,7 +118,7 @@ class EntryForm(forms.ModelForm):
             self.instance = super(EntryForm, self).save(*args, **kwargs)
         except IntegrityError:
             self.instance = None
-            self.add_error(None, "There is already an entry for this data.")
+            self.add_error(None, self.DUPLICATED_ENTRY_ERROR)
         return self.instance
 
     class Meta:
@@ -156,6 +160,119 @@ class EntryForm(forms.ModelForm):
         )
 
 
+class EntryValidator(object):
+    """Validate entry data for `book` like EntryForm does, without queries.
+
+    Every EntryForm evaluates the accounts and assets of its book, and runs
+    a few more queries per row when cleaning the related fields. This
+    validator builds the form fields only once, caching the allowed
+    accounts and assets, the users seen so far, and the tag and country
+    choices. It is meant to be built once per import and reused for all
+    the rows.
+
+    """
+
+    RELATED = ("account", "asset", "who")
+    CHOICES = ("tags", "country")
+
+    def __init__(self, book):
+        super(EntryValidator, self).__init__()
+        self.book = book
+        self.fields = EntryForm(book=book).fields
+        self.objects = {
+            name: {o.pk: o for o in self.fields[name].queryset}
+            for name in ("account", "asset")
+        }
+        # Users are not restricted by book, cache them as they are found.
+        self.objects["who"] = {}
+        self.choices = {
+            name: {str(k) for k, v in self.fields[name].choices}
+            for name in self.CHOICES
+        }
+
+    def get_object(self, name, pk):
+        objects = self.objects[name]
+        if name == "who" and pk not in objects:
+            objects[pk] = self.fields[name].queryset.filter(pk=pk).first()
+        return objects.get(pk)
+
+    def clean_related(self, name, value):
+        field = self.fields[name]
+        result = None
+        if value not in field.empty_values:
+            if isinstance(value, models.Model):
+                value = value.pk
+            try:
+                result = self.get_object(name, int(value))
+            except (TypeError, ValueError):
+                pass
+            if result is None:
+                raise ValidationError(
+                    field.error_messages["invalid_choice"],
+                    code="invalid_choice",
+                    params={"value": value},
+                )
+        field.validate(result)
+        return result
+
+    def clean_choice(self, name, value):
+        field = self.fields[name]
+        value = field.to_python(value)
+        # Only check for required values, choices are checked below.
+        forms.Field.validate(field, value)
+        for item in value if isinstance(value, list) else [value]:
+            if item and str(item) not in self.choices[name]:
+                raise ValidationError(
+                    field.error_messages["invalid_choice"],
+                    code="invalid_choice",
+                    params={"value": item},
+                )
+        field.run_validators(value)
+        return value
+
+    def validate(self, data):
+        """Validate `data`, a dict of raw values as given to EntryForm.
+
+        Return an unsaved Entry for this validator's book and a dict with the
+        errors found, in the same format as `EntryForm.errors`. The entry is
+        only meaningful if there are no errors.
+
+        """
+        cleaned = {}
+        errors = {}
+        for name, field in self.fields.items():
+            value = field.widget.value_from_datadict(data, {}, name)
+            try:
+                if name in self.RELATED:
+                    value = self.clean_related(name, value)
+                elif name in self.CHOICES:
+                    value = self.clean_choice(name, value)
+                else:
+                    value = field.clean(value)
+            except ValidationError as e:
+                errors[name] = e.messages
+            else:
+                cleaned[name] = value
+
+        if not cleaned.get("tags"):
+            errors.setdefault(NON_FIELD_ERRORS, []).append(
+                EntryForm.MISSING_TAGS_ERROR
+            )
+
+        entry = Entry(book=self.book, **cleaned)
+        # Like ModelForm, run the model validation for the fields that are
+        # valid so far. Related fields and choices are already validated.
+        exclude = {"book", *errors, *self.RELATED, *self.CHOICES}
+        try:
+            entry.clean_fields(exclude=exclude)
+            entry.clean()
+        except ValidationError as e:
+            for name, messages in e.message_dict.items():
+                errors.setdefault(name, []).extend(messages)
+
+        return entry, errors
+
+
 class EntryMergeForm(forms.Form):
     when = forms.DateField(
         widget=forms.DateInput(
@@ -172,7 +289,10 @@ class CSVExpenseForm(forms.Form):
             attrs={"class": "form-control", "autofocus": "true"}
         ),
     )
-    csv_file = forms.FileField(required=False)
+    csv_file = forms.FileField(
+        required=False,
+        help_text="Optionally gzip or bzip2 compressed, or a zip archive.",
+    )
     csv_content = forms.CharField(
         required=False,
         label="CSV content (optional, only used if not file given)",
@@ -0,0 +1,47 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from gemcore.models import ImportJob
+from gemcore.parser import BATCH_SIZE, run_import_job
+
+
+class Command(BaseCommand):
+    help = "Process pending import jobs, using the database as the queue."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            default=False,
+            help="Exit once there are no pending jobs.",
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=2,
+            help="Seconds to wait before checking again for new jobs.",
+        )
+        parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        while True:
+            job = ImportJob.objects.claim()
+            if job is None:
+                if options["once"]:
+                    break
+                time.sleep(options["sleep"])
+                continue
+
+            self.stdout.write("Processing %s" % job)
+            job = run_import_job(job, batch_size=options["batch_size"])
+            rate = job.rows_per_second
+            self.stdout.write(
+                "Finished %s (%s entries, %s errors, %s rows/s)"
+                % (
+                    job,
+                    job.entry_count,
+                    job.error_count,
+                    "%.1f" % rate if rate is not None else "-",
+                )
+            )
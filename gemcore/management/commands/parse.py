@@ -1,51 +1,396 @@
-import argparse
+import difflib
+import glob
+import multiprocessing
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import partial
 
 from django.contrib.auth import get_user_model
-from django.core.management.base import BaseCommand
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
 
 from gemcore.models import Account, Book
-from gemcore.parser import CSVParser
+from gemcore.parser import BATCH_SIZE, ENGINES, import_file, open_archive
 
 User = get_user_model()
 
 
+# Standard input is spooled to disk past this size.
+STDIN_SPOOL_SIZE = 16 * 1024 * 1024
+
+
+def queue_report(events, kind, path, payload):
+    events.put((kind, path, payload))
+
+
+def open_input(path):
+    """Return the binary file for `path`, reading standard input for "-".
+
+    Standard input is copied to a temporary file first, since importing
+    needs to read the content more than once.
+
+    """
+    if path != "-":
+        return open(path, "rb")
+    spool = tempfile.SpooledTemporaryFile(max_size=STDIN_SPOOL_SIZE)
+    shutil.copyfileobj(sys.stdin.buffer, spool)
+    spool.seek(0)
+    return spool
+
+
+def make_summary(path, **kwargs):
+    summary = dict(
+        path=path,
+        rows=0,
+        entries=0,
+        skipped=0,
+        errors=[],
+        duplicate_of=None,
+        stages={},
+        elapsed=0,
+    )
+    summary.update(kwargs)
+    return summary
+
+
+def make_error(error, data):
+    return {
+        "exception": error.__class__.__name__,
+        "message": str(error),
+        "data": data,
+    }
+
+
+def import_member(path, binary, name, report, dry_run, **kwargs):
+    start = time.monotonic()
+    summary = make_summary(path)
+
+    def progress(result):
+        elapsed = time.monotonic() - start
+        report(
+            "progress", path, (result["rows"], len(result["errors"]), elapsed)
+        )
+
+    def write_entry(entry):
+        report("entries", path, [str(entry)])
+
+    try:
+        # Entries are only counted, and written as they are made when
+        # reporting a dry run.
+        result = import_file(
+            binary,
+            name=name,
+            dry_run=dry_run,
+            progress=None if report is None else progress,
+            on_entry=(
+                write_entry
+                if dry_run and report is not None
+                else lambda entry: None
+            ),
+            **kwargs
+        )
+    except Exception as e:
+        summary["errors"].append(make_error(e, path))
+    else:
+        summary["rows"] = result["rows"]
+        summary["entries"] = result["entry_count"]
+        summary["skipped"] = result["skipped"]
+        summary["errors"] = result["errors"]
+        summary["stages"] = result["stages"]
+        if result["duplicate_of"] is not None:
+            summary["duplicate_of"] = str(result["duplicate_of"])
+    summary["elapsed"] = time.monotonic() - start
+    return summary
+
+
+def parse_file(
+    path,
+    report,
+    account_id,
+    book_id,
+    user_id,
+    dry_run,
+    batch_size,
+    engine="orm",
+    jobs=1,
+):
+    """Parse a single file, returning a list of picklable summaries.
+
+    The file may be compressed or a zip archive (see `open_archive`), with
+    one summary per file in the archive. If `path` is "-", the standard
+    input is parsed. Big uncompressed files are split and parsed by `jobs`
+    processes (see `CSVParser.parse`), using the given import `engine`.
+
+    If `report` is given, it's called as `report(kind, path, payload)` while
+    the file is parsed: with kind "progress" and a tuple of rows, errors and
+    elapsed seconds after each chunk, and with kind "entries" and a list
+    with each new entry (as a string) as soon as it's made when `dry_run` is
+    set.
+
+    """
+    start = time.monotonic()
+    summaries = []
+    try:
+        account = Account.objects.select_related("parser_config").get(
+            id=account_id
+        )
+        book = Book.objects.get(id=book_id)
+        user = User.objects.get(id=user_id)
+        name = "stdin" if path == "-" else os.path.basename(path)
+        with open_input(path) as f:
+            for member, binary in open_archive(f, name):
+                # Files in archives are named after the archive.
+                if member.startswith(name + "/"):
+                    label = member.replace(name, path, 1)
+                else:
+                    label = path
+                summaries.append(
+                    import_member(
+                        label,
+                        binary,
+                        member,
+                        report,
+                        dry_run,
+                        account=account,
+                        book=book,
+                        user=user,
+                        batch_size=batch_size,
+                        engine=engine,
+                        jobs=jobs,
+                    )
+                )
+    except Exception as e:
+        elapsed = time.monotonic() - start
+        summaries.append(
+            make_summary(path, errors=[make_error(e, path)], elapsed=elapsed)
+        )
+    return summaries
+
+
 class Command(BaseCommand):
-    help = "Parse a csv files of expense/income entries."
+    help = "Parse csv files of expense/income entries."
 
     def add_arguments(self, parser):
         parser.add_argument(
             "--dry-run", action="store_true", dest="dry-run", default=False
         )
-        parser.add_argument("--file", type=argparse.FileType("r"))
-        accounts = Account.objects.filter(active=True).values_list(
-            "slug", flat=True
+        parser.add_argument(
+            "--file",
+            nargs="+",
+            required=True,
+            dest="files",
+            metavar="FILE",
+            help=(
+                "Paths or glob patterns of the files to parse, - for the "
+                "standard input. Files may be gzip or bzip2 compressed, or "
+                "zip archives."
+            ),
+        )
+        parser.add_argument(
+            "--jobs",
+            type=int,
+            default=os.cpu_count(),
+            help=(
+                "Amount of files parsed in parallel, or of processes parsing "
+                "a single big file."
+            ),
         )
-        parser.add_argument("--account", choices=accounts)
         parser.add_argument(
-            "--book", choices=Book.objects.all().values_list("slug", flat=True)
+            "--batch-size",
+            type=int,
+            default=BATCH_SIZE,
+            help="Rows saved per transaction, 0 saves one row at a time.",
         )
         parser.add_argument(
-            "--user",
-            choices=User.objects.all().values_list("username", flat=True),
+            "--engine",
+            choices=sorted(ENGINES),
+            default="orm",
+            help=(
+                "How entries are saved: with the ORM, or merged in the "
+                "database through a staging table (faster for big files)."
+            ),
         )
+        parser.add_argument(
+            "--progress",
+            action="store_true",
+            help="Report rows/s and errors of each file while parsing.",
+        )
+        # Slugs are validated once the arguments are parsed, so showing the
+        # help or starting the command does not need any query.
+        parser.add_argument("--account", required=True, help="Account slug.")
+        parser.add_argument("--book", required=True, help="Book slug.")
+        parser.add_argument("--user", required=True, help="Username.")
+
+    def get_object(self, queryset, field, value):
+        try:
+            return queryset.get(**{field: value})
+        except ObjectDoesNotExist:
+            name = queryset.model._meta.verbose_name
+            choices = queryset.values_list(field, flat=True)
+            close = difflib.get_close_matches(value, choices)
+            msg = "Unknown %s %r." % (name, value)
+            if close:
+                msg += " Did you mean %s?" % " or ".join(map(repr, close))
+            raise CommandError(msg)
+
+    def expand_paths(self, patterns):
+        paths = []
+        for pattern in patterns:
+            matches = sorted(glob.glob(pattern)) or [pattern]
+            paths.extend(p for p in matches if p not in paths)
+        return paths
+
+    def parse_files(self, paths, jobs, report, *args):
+        """Parse the files in `paths`, yielding summaries as they finish."""
+        # Worker processes can not read the standard input.
+        if jobs < 2 or len(paths) < 2 or "-" in paths:
+            for path in paths:
+                yield from parse_file(path, report, *args, jobs=jobs)
+            return
+
+        # Workers are forked, make sure they do not share the connections.
+        connections.close_all()
+        context = multiprocessing.get_context("fork")
+        with context.Manager() as manager, ProcessPoolExecutor(
+            max_workers=min(jobs, len(paths)), mp_context=context
+        ) as executor:
+            # Workers send their reports through a queue, so they can be
+            # written here as they happen.
+            events = manager.Queue()
+            worker_report = None
+            if report is not None:
+                worker_report = partial(queue_report, events)
+            futures = {
+                executor.submit(parse_file, path, worker_report, *args): path
+                for path in paths
+            }
+            pending = set(futures)
+            while pending:
+                done, pending = wait(
+                    pending, timeout=0.5, return_when=FIRST_COMPLETED
+                )
+                self.flush_reports(events, report)
+                for future in done:
+                    yield from self.get_summaries(futures[future], future)
+
+    def flush_reports(self, events, report):
+        while True:
+            try:
+                event = events.get_nowait()
+            except queue.Empty:
+                return
+            report(*event)
+
+    def get_summaries(self, path, future):
+        try:
+            return future.result()
+        except Exception as e:
+            return [make_summary(path, errors=[make_error(e, path)])]
+
+    def report(self, kind, path, payload):
+        if kind == "entries":
+            for entry in payload:
+                self.stdout.write("=== ENTRY: %s ===" % entry)
+        elif kind == "progress" and self.progress:
+            rows, errors, elapsed = payload
+            # The final report may not have any new row.
+            if self.reported.get(path) == (rows, errors):
+                return
+            self.reported[path] = (rows, errors)
+            rate = rows / elapsed if elapsed else 0
+            self.stdout.write(
+                "=== PROGRESS (%s): %s rows, %.1f rows/s, %s errors ==="
+                % (path, rows, rate, errors)
+            )
 
     def handle(self, *args, **options):
-        account = Account.objects.get(slug=options["account"])
-        book = Book.objects.get(slug=options["book"])
-        user = User.objects.get(username=options["user"])
-        csv_file = options["file"]
+        account = self.get_object(
+            Account.objects.filter(active=True), "slug", options["account"]
+        )
+        book = self.get_object(Book.objects.all(), "slug", options["book"])
+        user = self.get_object(User.objects.all(), "username", options["user"])
+        paths = self.expand_paths(options["files"])
         dry_run = options["dry-run"]
+        self.progress = options["progress"]
+        self.reported = {}
         self.stdout.write(
-            "Parsing (dry run %s) %s for %s"
-            % (dry_run, csv_file.name, account)
-        )
-        result = CSVParser(account=account).parse(
-            csv_file, book=book, user=user, dry_run=dry_run
-        )
-        for error, traceback in result["errors"].items():
-            self.stdout.write("=== ERROR: %s ===" % error)
-            self.stdout.write("\n".join(str(i[0]) for i in traceback))
-            self.stdout.write("\n\n")
-        if dry_run:
-            for entry in result["entries"]:
-                self.stdout.write("=== ENTRY: %s ===" % entry)
+            "Parsing (dry run %s) %s files for %s"
+            % (dry_run, len(paths), account)
+        )
+
+        start = time.monotonic()
+        summaries = []
+        for summary in self.parse_files(
+            paths,
+            options["jobs"],
+            self.report if dry_run or self.progress else None,
+            account.id,
+            book.id,
+            user.id,
+            dry_run,
+            options["batch_size"],
+            options["engine"],
+        ):
+            summaries.append(summary)
+            for error in summary["errors"]:
+                self.stdout.write(
+                    "=== ERROR (%s): %s ==="
+                    % (summary["path"], error["exception"])
+                )
+                self.stdout.write("%s\n%r" % (error["message"], error["data"]))
+                self.stdout.write("\n\n")
+            if summary["duplicate_of"] is not None:
+                self.stdout.write(
+                    "=== ALREADY IMPORTED (%s): %s ==="
+                    % (summary["path"], summary["duplicate_of"])
+                )
+
+        self.stdout.write("=== SUMMARY ===")
+        for summary in summaries:
+            self.write_summary(
+                summary["path"],
+                summary["entries"],
+                summary["skipped"],
+                len(summary["errors"]),
+                summary["rows"],
+                summary["elapsed"],
+            )
+        self.write_summary(
+            "TOTAL",
+            sum(s["entries"] for s in summaries),
+            sum(s["skipped"] for s in summaries),
+            sum(len(s["errors"]) for s in summaries),
+            sum(s["rows"] for s in summaries),
+            time.monotonic() - start,
+        )
+        self.write_stages(summaries)
+
+    def write_summary(self, name, entries, skipped, errors, rows, elapsed):
+        rate = rows / elapsed if elapsed else 0
+        self.stdout.write(
+            "%s: %s entries, %s skipped, %s errors, %s rows, %.1f rows/s"
+            % (name, entries, skipped, errors, rows, rate)
+        )
+
+    def write_stages(self, summaries):
+        stages = {}
+        for summary in summaries:
+            for stage, value in summary["stages"].items():
+                total = stages.setdefault(stage, {"count": 0, "seconds": 0})
+                total["count"] += value["count"]
+                total["seconds"] += value["seconds"]
+        elapsed = sum(v["seconds"] for v in stages.values())
+
+        self.stdout.write("=== STAGES ===")
+        for stage, value in stages.items():
+            share = 100 * value["seconds"] / elapsed if elapsed else 0
+            self.stdout.write(
+                "%s: %s items, %.3fs (%.1f%%)"
+                % (stage, value["count"], value["seconds"], share)
+            )
@@ -0,0 +1,82 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from gemcore.models import RETAG_CHUNK_SIZE, Account, Asset, Book
+
+
+class Command(BaseCommand):
+    help = "Apply the current tag rules of an account to its entries."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--account", required=True, help="Account slug.")
+        parser.add_argument(
+            "--book", help="Book slug, only re-tag the entries in this book."
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            dest="dry-run",
+            default=False,
+            help="Show what would change without saving anything.",
+        )
+        parser.add_argument(
+            "--diff",
+            action="store_true",
+            default=False,
+            help="Show the changes for every entry.",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=RETAG_CHUNK_SIZE,
+            help="Entries fetched and updated at a time.",
+        )
+
+    def get_object(self, queryset, slug):
+        try:
+            return queryset.get(slug=slug)
+        except queryset.model.DoesNotExist:
+            name = queryset.model._meta.verbose_name
+            raise CommandError("Unknown %s %r." % (name, slug))
+
+    def write_diff(self, pk, what, tags, new_tags, asset_id, new_asset_id):
+        self.stdout.write("=== ENTRY %s: %s ===" % (pk, what))
+        if tags != new_tags:
+            self.stdout.write("- tags: %s" % ", ".join(tags))
+            self.stdout.write("+ tags: %s" % ", ".join(new_tags))
+        if asset_id != new_asset_id:
+            self.stdout.write("- asset: %s" % self.assets.get(asset_id))
+            self.stdout.write("+ asset: %s" % self.assets.get(new_asset_id))
+
+    def handle(self, *args, **options):
+        account = self.get_object(Account.objects.all(), options["account"])
+        book = None
+        if options["book"]:
+            book = self.get_object(Book.objects.all(), options["book"])
+        dry_run = options["dry-run"]
+        diff = None
+        if dry_run or options["diff"]:
+            self.assets = {a.pk: a for a in Asset.objects.all()}
+            diff = self.write_diff
+
+        start = time.monotonic()
+        result = account.retag_entries(
+            book=book,
+            dry_run=dry_run,
+            chunk_size=options["chunk_size"],
+            diff=diff,
+        )
+        self.stdout.write(
+            "%s %s of %s entries for %s in %.1fs (dry run %s), %s left "
+            "alone because of conflicting assets."
+            % (
+                "Would re-tag" if dry_run else "Re-tagged",
+                result["changed"],
+                result["entries"],
+                account.slug,
+                time.monotonic() - start,
+                dry_run,
+                result["conflicts"],
+            )
+        )
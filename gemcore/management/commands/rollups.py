@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from gemcore.models import Book
+
+
+class Command(BaseCommand):
+    help = (
+        "Compute the monthly rollups of the existing entries from scratch, "
+        "read by the reports of whole books."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--book",
+            nargs="*",
+            dest="books",
+            metavar="BOOK",
+            help="Book slugs (default: every book).",
+        )
+
+    def handle(self, *args, **options):
+        books = Book.objects.order_by("slug")
+        if options["books"]:
+            books = books.filter(slug__in=options["books"])
+            missing = set(options["books"]).difference(
+                books.values_list("slug", flat=True)
+            )
+            if missing:
+                raise CommandError(
+                    "Unknown book %s." % ", ".join(map(repr, sorted(missing)))
+                )
+
+        for book in books:
+            start = time.monotonic()
+            rollups = book.rebuild_rollups()
+            self.stdout.write(
+                "Computed %s monthly rollups for %s in %.1fs."
+                % (rollups, book.slug, time.monotonic() - start)
+            )
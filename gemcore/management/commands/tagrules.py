@@ -0,0 +1,114 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from gemcore.models import Account, TagRegex, flush_tag_rule_stats
+
+SORT_KEYS = {
+    "cost": lambda rule: rule.cost or 0,
+    "hits": lambda rule: rule.hits,
+    "seconds": lambda rule: rule.seconds,
+}
+
+
+class Command(BaseCommand):
+    help = "Report the usage and cost of the tag rules, flagging bad ones."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--account",
+            nargs="*",
+            dest="accounts",
+            metavar="ACCOUNT",
+            help="Account slugs (default: every account with tag rules).",
+        )
+        parser.add_argument(
+            "--sort",
+            choices=sorted(SORT_KEYS),
+            default="seconds",
+            help="Show the rules in this order, biggest first.",
+        )
+        parser.add_argument(
+            "--flagged",
+            action="store_true",
+            help="Only show dead, slow, overlapping or shadowed rules.",
+        )
+        parser.add_argument(
+            "--reset",
+            action="store_true",
+            help="Reset the stats of the rules once reported.",
+        )
+
+    def get_flags(self, rule, rules):
+        flags = []
+        if rule.is_dead:
+            flags.append("dead")
+        if rule.is_slow:
+            flags.append("slow")
+        if rule.overlaps:
+            flags.append("overlapping")
+        if rule.shadowed:
+            # Later rules are applied after this one, see TagMatcher.
+            later = [
+                "#%s" % r.pk
+                for r in rules
+                if r.tag == rule.tag and r.pk > rule.pk
+            ]
+            flags.append("shadowed by %s" % " or ".join(later))
+        return flags
+
+    def handle(self, *args, **options):
+        # Include the stats not saved yet by this process.
+        flush_tag_rule_stats()
+        accounts = Account.objects.filter(tagregex__isnull=False).distinct()
+        if options["accounts"]:
+            accounts = Account.objects.filter(slug__in=options["accounts"])
+            missing = set(options["accounts"]).difference(
+                accounts.values_list("slug", flat=True)
+            )
+            if missing:
+                raise CommandError(
+                    "Unknown account %s."
+                    % ", ".join(map(repr, sorted(missing)))
+                )
+
+        key = SORT_KEYS[options["sort"]]
+        for account in accounts.order_by("slug"):
+            rules = list(account.tagregex_set.order_by("id"))
+            seconds = sum(r.seconds for r in rules)
+            self.stdout.write(
+                "=== %s: %s rules, %s hits, %.3fs tagging ==="
+                % (
+                    account.slug,
+                    len(rules),
+                    sum(r.hits for r in rules),
+                    seconds,
+                )
+            )
+            for rule in sorted(rules, key=key, reverse=True):
+                flags = self.get_flags(rule, rules)
+                if options["flagged"] and not flags:
+                    continue
+                cost = (
+                    "?" if rule.cost is None else "%.1fus" % (rule.cost * 1e6)
+                )
+                share = 100 * rule.seconds / seconds if seconds else 0
+                self.stdout.write(
+                    "#%s %r -> %s: %s hits, %s overlaps, %s shadowed, "
+                    "%s per evaluation, %.3fs (%.1f%%)%s"
+                    % (
+                        rule.pk,
+                        rule.regex,
+                        rule.tag,
+                        rule.hits,
+                        rule.overlaps,
+                        rule.shadowed,
+                        cost,
+                        rule.seconds,
+                        share,
+                        " [%s]" % ", ".join(flags) if flags else "",
+                    )
+                )
+
+        if options["reset"]:
+            TagRegex.objects.filter(account__in=accounts).update(
+                hits=0, overlaps=0, shadowed=0, evaluations=0, seconds=0
+            )
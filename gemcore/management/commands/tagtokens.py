@@ -0,0 +1,50 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from gemcore.models import RETAG_CHUNK_SIZE, Account
+
+
+class Command(BaseCommand):
+    help = (
+        "Count the tokens of the existing entries from scratch, so tags can "
+        "be suggested from them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--account",
+            nargs="*",
+            dest="accounts",
+            metavar="ACCOUNT",
+            help="Account slugs (default: every account).",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=RETAG_CHUNK_SIZE,
+            help="Entries fetched and counted at a time.",
+        )
+
+    def handle(self, *args, **options):
+        accounts = Account.objects.order_by("slug")
+        if options["accounts"]:
+            accounts = accounts.filter(slug__in=options["accounts"])
+            missing = set(options["accounts"]).difference(
+                accounts.values_list("slug", flat=True)
+            )
+            if missing:
+                raise CommandError(
+                    "Unknown account %s."
+                    % ", ".join(map(repr, sorted(missing)))
+                )
+
+        for account in accounts:
+            start = time.monotonic()
+            entries = account.rebuild_tag_tokens(
+                chunk_size=options["chunk_size"]
+            )
+            self.stdout.write(
+                "Counted the tokens of %s entries for %s in %.1fs."
+                % (entries, account.slug, time.monotonic() - start)
+            )
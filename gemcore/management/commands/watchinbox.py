@@ -0,0 +1,260 @@
+import fnmatch
+import json
+import os
+import shutil
+import signal
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from django.utils.timezone import now
+
+from gemcore.management.commands.parse import make_summary, parse_file
+from gemcore.models import Account, Book
+from gemcore.parser import BATCH_SIZE, ENGINES
+
+User = get_user_model()
+
+DONE_DIR = "done"
+FAILED_DIR = "failed"
+# Added to the name of a processed file for its summary report.
+SUMMARY_SUFFIX = ".summary.json"
+
+
+def parse_rule(value):
+    pattern, sep, slug = value.rpartition("=")
+    if not sep or not pattern or not slug:
+        raise ValueError("Rules look like PATTERN=ACCOUNT, got %r." % value)
+    return pattern, slug
+
+
+def find_account(name, rules, accounts):
+    """Return the slug of the account for the file `name`, None if unknown.
+
+    `rules` is a list of (pattern, slug) pairs, the first pattern matching
+    the name (see `fnmatch`) wins. Otherwise, the name must start with the
+    slug of one of `accounts` followed by a non alphanumeric char, as in
+    "bank-usd_2024-05.csv" for the "bank-usd" account. The longest slug
+    wins.
+
+    """
+    for pattern, slug in rules:
+        if fnmatch.fnmatch(name, pattern):
+            return slug
+    matches = [
+        slug
+        for slug in accounts
+        if name.startswith(slug)
+        and len(name) > len(slug)
+        and not name[len(slug)].isalnum()
+    ]
+    return max(matches, key=len) if matches else None
+
+
+def move_file(path, folder):
+    """Move `path` into `folder`, never overwriting an existing file."""
+    os.makedirs(folder, exist_ok=True)
+    name = os.path.basename(path)
+    target = os.path.join(folder, name)
+    if os.path.exists(target):
+        root, ext = os.path.splitext(name)
+        stamp = now().strftime("%Y%m%d%H%M%S%f")
+        target = os.path.join(folder, "%s.%s%s" % (root, stamp, ext))
+    shutil.move(path, target)
+    return target
+
+
+class Command(BaseCommand):
+    help = (
+        "Watch an inbox directory, importing every new file for the account "
+        "given by its name. Files are moved to the done or failed folders, "
+        "along with a summary report."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--inbox",
+            default=settings.IMPORT_INBOX,
+            help="Directory to watch (default: settings.IMPORT_INBOX).",
+        )
+        parser.add_argument(
+            "--rule",
+            action="append",
+            default=[],
+            dest="rules",
+            metavar="PATTERN=ACCOUNT",
+            help=(
+                "Import files whose name matches the glob PATTERN for the "
+                "ACCOUNT slug. Rules are tried in order, and files matching "
+                "none are for the account whose slug starts their name."
+            ),
+        )
+        parser.add_argument("--book", required=True, help="Book slug.")
+        parser.add_argument("--user", required=True, help="Username.")
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            default=False,
+            help="Exit once the files in the inbox are processed.",
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=5,
+            help="Seconds to wait before checking again for new files.",
+        )
+        parser.add_argument(
+            "--settle",
+            type=float,
+            default=2,
+            help=(
+                "Seconds a file must be left untouched before importing it, "
+                "so files still being copied are not imported."
+            ),
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=BATCH_SIZE,
+            help="Rows saved per transaction, 0 saves one row at a time.",
+        )
+        parser.add_argument("--engine", choices=sorted(ENGINES), default="orm")
+        parser.add_argument(
+            "--jobs",
+            type=int,
+            default=1,
+            help="Amount of processes parsing a single big file.",
+        )
+
+    def get_object(self, queryset, field, value):
+        try:
+            return queryset.get(**{field: value})
+        except queryset.model.DoesNotExist:
+            name = queryset.model._meta.verbose_name
+            raise CommandError("Unknown %s %r." % (name, value))
+
+    def pending_files(self, inbox, settle):
+        """Return the paths of the files in `inbox` ready to be imported."""
+        result = []
+        limit = time.time() - settle
+        for entry in sorted(os.scandir(inbox), key=lambda e: e.name):
+            if entry.name.startswith(".") or not entry.is_file():
+                continue
+            if entry.stat().st_mtime > limit:
+                continue
+            result.append(entry.path)
+        return result
+
+    def process(self, path, account, options):
+        name = os.path.basename(path)
+        if account is None:
+            summaries = [
+                make_summary(
+                    path,
+                    errors=[
+                        {
+                            "exception": "LookupError",
+                            "message": "No account for %r." % name,
+                            "data": name,
+                        }
+                    ],
+                )
+            ]
+        else:
+            summaries = parse_file(
+                path,
+                None,
+                account.id,
+                self.book.id,
+                self.user.id,
+                False,
+                options["batch_size"],
+                engine=options["engine"],
+                jobs=options["jobs"],
+            )
+        # Only files that could not be imported at all failed: moving a file
+        # with a few bad rows to the failed folder would get its good rows
+        # skipped as duplicates once dropped again. Row errors are in the
+        # summary report of done files.
+        failed = any(s["errors"] and not s["entries"] for s in summaries)
+        folder = os.path.join(
+            options["inbox"], FAILED_DIR if failed else DONE_DIR
+        )
+        target = move_file(path, folder)
+        report = dict(
+            file=name,
+            account=account.slug if account is not None else None,
+            book=self.book.slug,
+            processed=now().isoformat(),
+            summaries=summaries,
+        )
+        with open(target + SUMMARY_SUFFIX, "w") as f:
+            json.dump(report, f, indent=2, default=str)
+
+        self.stdout.write(
+            "%s %s for %s: %s entries, %s skipped, %s errors, %s rows"
+            % (
+                "FAILED" if failed else "DONE",
+                name,
+                report["account"],
+                sum(s["entries"] for s in summaries),
+                sum(s["skipped"] for s in summaries),
+                sum(len(s["errors"]) for s in summaries),
+                sum(s["rows"] for s in summaries),
+            )
+        )
+        return not failed
+
+    def stop(self, signum, frame):
+        self.stopping = True
+
+    def handle(self, *args, **options):
+        inbox = options["inbox"]
+        if not inbox or not os.path.isdir(inbox):
+            raise CommandError("Inbox %r is not a directory." % inbox)
+        try:
+            rules = [parse_rule(r) for r in options["rules"]]
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.book = self.get_object(
+            Book.objects.all(), "slug", options["book"]
+        )
+        self.user = self.get_object(
+            User.objects.all(), "username", options["user"]
+        )
+        accounts = Account.objects.filter(active=True)
+        for pattern, slug in rules:
+            self.get_object(accounts, "slug", slug)
+
+        # Finish the current file before stopping.
+        self.stopping = False
+        previous = signal.signal(signal.SIGTERM, self.stop)
+        self.stdout.write("Watching %s" % inbox)
+        try:
+            self.watch(inbox, rules, accounts, options)
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+
+    def watch(self, inbox, rules, accounts, options):
+        while not self.stopping:
+            paths = self.pending_files(inbox, options["settle"])
+            if paths:
+                by_slug = {a.slug: a for a in accounts}
+                processed = failed = 0
+                for path in paths:
+                    slug = find_account(os.path.basename(path), rules, by_slug)
+                    ok = self.process(path, by_slug.get(slug), options)
+                    processed += 1
+                    failed += not ok
+                    if self.stopping:
+                        break
+                self.stdout.write(
+                    "Processed %s files, %s failed." % (processed, failed)
+                )
+            if options["once"]:
+                break
+            time.sleep(options["sleep"])
+            # The connection may have been dropped while sleeping.
+            close_old_connections()
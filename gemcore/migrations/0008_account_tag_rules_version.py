@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("gemcore", "0007_alter_asset_options_tagregex_asset"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="account",
+            name="tag_rules_version",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
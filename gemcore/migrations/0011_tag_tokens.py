@@ -0,0 +1,82 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("gemcore", "0010_importrun"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="account",
+            name="suggest_tags",
+            field=models.BooleanField(
+                default=False,
+                help_text="Tag new entries matching no tag rule like previous entries with the same words.",
+            ),
+        ),
+        migrations.CreateModel(
+            name="AssetToken",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("token", models.CharField(max_length=64)),
+                ("count", models.IntegerField(default=0)),
+                (
+                    "account",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="gemcore.account",
+                    ),
+                ),
+                (
+                    "asset",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="gemcore.asset",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("account", "token", "asset")},
+            },
+        ),
+        migrations.CreateModel(
+            name="TagToken",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("token", models.CharField(max_length=64)),
+                ("tag", models.CharField(blank=True, max_length=256)),
+                ("count", models.IntegerField(default=0)),
+                (
+                    "account",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="gemcore.account",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("account", "token", "tag")},
+            },
+        ),
+    ]
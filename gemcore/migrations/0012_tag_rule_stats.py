@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("gemcore", "0011_tag_tokens"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="tagregex",
+            name="evaluations",
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="tagregex",
+            name="hits",
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="tagregex",
+            name="overlaps",
+            field=models.BigIntegerField(
+                default=0,
+                editable=False,
+                help_text="Matches along with other rules of the account.",
+            ),
+        ),
+        migrations.AddField(
+            model_name="tagregex",
+            name="seconds",
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="tagregex",
+            name="shadowed",
+            field=models.BigIntegerField(
+                default=0,
+                editable=False,
+                help_text="Matches overridden by a later rule with the same tag.",
+            ),
+        ),
+    ]
@@ -0,0 +1,88 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:54
+
+from decimal import Decimal
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+from gemcore.models import REBUILD_ROLLUPS
+
+
+def rollup_entries(apps, schema_editor):
+    Book = apps.get_model("gemcore", "Book")
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            REBUILD_ROLLUPS, [list(Book.objects.values_list("pk", flat=True))]
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("gemcore", "0012_tag_rule_stats"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MonthlyRollup",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("month", models.DateField()),
+                ("is_income", models.BooleanField()),
+                ("count", models.IntegerField(default=0)),
+                (
+                    "total",
+                    models.DecimalField(
+                        decimal_places=2, default=Decimal("0"), max_digits=16
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="entry",
+            index=models.Index(
+                fields=["book", "when"], name="gemcore_ent_book_id_e53c2b_idx"
+            ),
+        ),
+        migrations.AddField(
+            model_name="monthlyrollup",
+            name="account",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE,
+                to="gemcore.account",
+            ),
+        ),
+        migrations.AddField(
+            model_name="monthlyrollup",
+            name="asset",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                to="gemcore.asset",
+            ),
+        ),
+        migrations.AddField(
+            model_name="monthlyrollup",
+            name="book",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE, to="gemcore.book"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="monthlyrollup",
+            constraint=models.UniqueConstraint(
+                fields=("book", "account", "asset", "month", "is_income"),
+                name="unique_monthly_rollup",
+                nulls_distinct=False,
+            ),
+        ),
+        migrations.RunPython(rollup_entries, migrations.RunPython.noop),
+    ]
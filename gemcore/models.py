@@ -1,35 +1,228 @@
+import hashlib
+import inspect
 import operator
 import re
-from collections import OrderedDict, defaultdict
+import time
+from collections import Counter, OrderedDict, defaultdict
 from datetime import date, timedelta
 from decimal import Decimal
-from functools import reduce
+from functools import reduce, wraps
+from itertools import islice
 
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.postgres.fields import ArrayField
+from django.core.cache import caches
+from django.core.exceptions import EmptyResultSet
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.validators import MinValueValidator
 from django.db import connection, models, transaction
-from django.db.models.functions import Now, TruncMonth, TruncYear
-from django.db.models.signals import pre_delete
+from django.db.models.functions import (
+    ExtractMonth,
+    ExtractYear,
+    Now,
+    TruncMonth,
+    TruncYear,
+)
+from django.db.models.signals import (
+    post_delete,
+    post_save,
+    pre_delete,
+    pre_save,
+)
 from django.dispatch import receiver
 from django.utils.text import slugify
 from django.utils.timezone import now
 
 from gemcore.constants import ChoicesMixin
 
+# Amount of entries fetched, and updated, at a time when re-tagging.
+RETAG_CHUNK_SIZE = 5000
+# Words of at least 3 letters in an entry's what are the tokens used to learn
+# tag suggestions, cut to MAX_TOKEN_LENGTH chars.
+TOKEN_RE = re.compile(r"[^\W\d_]{3,}")
+MAX_TOKEN_LENGTH = 64
+# Entry fields needed to keep the token counts up to date.
+TOKEN_FIELDS = ("account_id", "what", "tags", "asset_id")
+# Token counts updated per statement.
+TOKEN_COUNTS_BATCH_SIZE = 1000
+# Entry fields needed to keep the monthly rollups up to date.
+ROLLUP_FIELDS = (
+    "book_id",
+    "account_id",
+    "asset_id",
+    "when",
+    "is_income",
+    "amount",
+)
+
+
+# The facets computed by Book.facets, in the order of the FACETS columns.
+FACET_NAMES = ("countries", "currencies", "months", "years", "who", "tags")
+# Each entry is joined to each of its distinct tags, and to one more row
+# with no tag that is the only one counted by the facets other than tags.
+FACETS = """
+    SELECT
+        e.country, e.currency, e.month::integer, e.year::integer, e.username,
+        t.tag,
+        GROUPING(e.country, e.currency, e.month, e.year, e.username, t.tag),
+        COUNT(*) FILTER (WHERE t.tag IS NULL),
+        COUNT(t.tag)
+    FROM (%s) AS e
+    CROSS JOIN LATERAL (
+        SELECT NULL::varchar AS tag
+        UNION ALL
+        SELECT DISTINCT unnest(e.tags)
+    ) AS t
+    GROUP BY GROUPING SETS (
+        (e.country), (e.currency), (e.month), (e.year), (e.username), (t.tag)
+    )
+"""
+
+
+# The balance of each month between the first and last dates of each
+# currency, including months with no entries, for the currency, "when",
+# amount and is_income rows of entries (or of rollups, "when" being their
+# month). There are no rows for currencies without entries.
+BALANCES = """
+    WITH e AS (%(entries)s),
+    bounds AS (
+        SELECT e.currency, %(first)s AS first, %(last)s AS last
+        FROM e
+        GROUP BY e.currency
+    ),
+    totals AS (
+        SELECT
+            e.currency,
+            date_trunc('month', e."when")::date AS month,
+            SUM(e.amount) FILTER (WHERE e.is_income) AS income,
+            SUM(e.amount) FILTER (WHERE NOT e.is_income) AS expense
+        FROM e
+        GROUP BY 1, 2
+    )
+    SELECT
+        b.currency, s.month::date, b.first, b.last,
+        COALESCE(t.income, 0), COALESCE(t.expense, 0),
+        SUM(COALESCE(t.income, 0) - COALESCE(t.expense, 0))
+            OVER (PARTITION BY b.currency ORDER BY s.month)
+    FROM bounds b
+    CROSS JOIN LATERAL generate_series(
+        date_trunc('month', b.first), b.last, interval '1 month'
+    ) AS s (month)
+    LEFT JOIN totals t ON t.currency = b.currency AND t.month = s.month
+    ORDER BY b.currency, s.month
+"""
+# The first (with ASC) or last (DESC) date of the entries of a book, in the
+# currency of the bounds being computed unless every currency is wanted.
+ENTRIES_BOUND = """(
+    SELECT x."when"
+    FROM gemcore_entry x
+    JOIN gemcore_account xa ON xa.id = x.account_id
+    WHERE x.book_id = %%s AND (%%s OR xa.currency = e.currency)
+    ORDER BY x."when" %s
+    LIMIT 1
+)"""
+
 
 class DryRunError(Exception):
     """Dry run requested."""
 
 
-def month_year_iter(start, end):
-    # Adapted from:
-    # http://stackoverflow.com/questions/5734438/how-to-create-a-month-iterator
-    ym_start = 12 * start.year + start.month - 1
-    ym_end = 12 * end.year + end.month
-    for ym in range(ym_start, ym_end):
-        y, m = divmod(ym, 12)
-        yield date(y, m + 1, 1)
+def month_end(day):
+    """Return the last day of the month of `day`."""
+    next_month = (day.replace(day=1) + timedelta(days=32)).replace(day=1)
+    return next_month - timedelta(days=1)
+
+
+# Keys of the cached reports of a book, and of the book's current version.
+BOOK_REPORT_KEY = "gemcore:book:%s:%s:%s"
+BOOK_VERSION_KEY = "gemcore:book:%s:version"
+
+
+def book_version(book_id):
+    """Return the version of the cached reports of the book `book_id`.
+
+    Versions start from the current time, so a version lost by the cache
+    does not bring back the reports cached before.
+
+    """
+    cache = caches[settings.BOOK_CACHE]
+    key = BOOK_VERSION_KEY % book_id
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def _touch_books(book_ids):
+    cache = caches[settings.BOOK_CACHE]
+    for book_id in book_ids:
+        try:
+            cache.incr(BOOK_VERSION_KEY % book_id)
+        except ValueError:
+            # Never read, a new version is given when first needed.
+            pass
+
+
+def touch_books(book_ids):
+    """Forget the cached reports of the books in `book_ids`.
+
+    Versions are bumped right away, and again once the current transaction
+    is committed, so reports computed before the changes are visible are
+    not used afterwards.
+
+    """
+    if settings.BOOK_CACHE is None:
+        return
+    book_ids = set(book_ids)
+    _touch_books(book_ids)
+    transaction.on_commit(lambda: _touch_books(book_ids))
+
+
+def cached_report(method):
+    """Cache the result of the Book report `method`.
+
+    Results are cached in settings.BOOK_CACHE by book, the arguments given
+    (entries by their query, regardless of their order) and the book's
+    version, so that entry changes (see `touch_books`) forget every cached
+    report of the book at once. Entries are expected to be of the book.
+
+    Nothing is cached if settings.BOOK_CACHE is None, since processes not
+    sharing the cache would never see the changes made by the others.
+    Results must not be lazy, as querysets are.
+
+    """
+    signature = inspect.signature(method)
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if settings.BOOK_CACHE is None:
+            return method(self, *args, **kwargs)
+        arguments = signature.bind(self, *args, **kwargs)
+        arguments.apply_defaults()
+        values = dict(arguments.arguments)
+        del values["self"]
+        entries = values.get("entries")
+        if entries is not None:
+            try:
+                values["entries"] = entries.order_by().query.sql_with_params()
+            except EmptyResultSet:
+                values["entries"] = "none"
+        digest = hashlib.sha1(
+            repr((method.__name__, sorted(values.items()))).encode()
+        ).hexdigest()
+        key = BOOK_REPORT_KEY % (self.pk, book_version(self.pk), digest)
+        cache = caches[settings.BOOK_CACHE]
+        result = cache.get(key)
+        if result is None:
+            result = method(self, *args, **kwargs)
+            cache.set(key, (result,))
+        else:
+            (result,) = result
+        return result
+
+    return wrapper
 
 
 class ParserConfig(models.Model):
@@ -104,25 +297,20 @@ class Book(models.Model):
             .distinct()
         )
 
+    @cached_report
     def countries(self, entries=None):
         if entries is None:
             entries = self.entry_set.all()
 
-        if not entries:
-            return {}
-
-        entries = ", ".join(str(e.id) for e in entries)
-        cursor = connection.cursor()
-        cursor.execute(
-            "SELECT gemcore_entry.country, COUNT(*) FROM gemcore_entry "
-            "WHERE gemcore_entry.book_id = %s "
-            "AND gemcore_entry.id IN (%s) "
-            "GROUP BY gemcore_entry.country "
-            "ORDER BY gemcore_entry.country ASC;" % (self.id, entries)
+        result = OrderedDict(
+            entries.order_by("country")
+            .values("country")
+            .annotate(count=models.Count("id"))
+            .values_list("country", "count")
         )
-        result = OrderedDict(cursor.fetchall())
         return result
 
+    @cached_report
     def currencies(self, entries=None):
         if entries is None:
             entries = self.entry_set.all()
@@ -132,17 +320,23 @@ class Book(models.Model):
             result[d] += 1
         return dict(result)
 
+    @cached_report
     def month_breakdown(self, entries=None):
         if entries is None:
-            entries = self.entry_set.all()
+            return list(
+                self.monthlyrollup_set.values("month")
+                .annotate(count=models.Sum("count"), total=models.Sum("total"))
+                .order_by()
+            )
         # Truncate to month and add to select list
         entries = entries.annotate(month=TruncMonth("when")).values("month")
         # Group By month and select the count of the grouping
         entries = entries.annotate(
             count=models.Count("id"), total=models.Sum("amount")
         )
-        return entries
+        return list(entries)
 
+    @cached_report
     def months(self, entries=None):
         breakdown = self.month_breakdown(entries)
 
@@ -152,17 +346,24 @@ class Book(models.Model):
 
         return dict(result)
 
+    @cached_report
     def year_breakdown(self, entries=None):
         if entries is None:
-            entries = self.entry_set.all()
+            return list(
+                self.monthlyrollup_set.annotate(year=TruncYear("month"))
+                .values("year")
+                .annotate(count=models.Sum("count"), total=models.Sum("total"))
+                .order_by()
+            )
         # Truncate to year and add to select list
         entries = entries.annotate(year=TruncYear("when")).values("year")
         # Group By year and select the count of the grouping
         entries = entries.annotate(
             count=models.Count("id"), total=models.Sum("amount")
         )
-        return entries
+        return list(entries)
 
+    @cached_report
     def years(self, entries=None):
         breakdown = self.year_breakdown(entries)
 
@@ -172,6 +373,7 @@ class Book(models.Model):
 
         return dict(result)
 
+    @cached_report
     def tags(self, entries=None):
         if entries is None:
             entries = self.entry_set.all()
@@ -187,6 +389,7 @@ class Book(models.Model):
 
         return result
 
+    @cached_report
     def who(self, entries=None):
         if entries is None:
             entries = self.entry_set.all()
@@ -195,22 +398,94 @@ class Book(models.Model):
             result[d] += 1
         return dict(result)
 
-    def calculate_balance(self, entries=None, start=None, end=None):
+    @cached_report
+    def facets(self, entries=None):
+        """Return the counts of every facet of `entries`, in a single query.
+
+        The result maps each of countries, currencies, months, tags, who and
+        years to what the method of that name returns for `entries`.
+
+        """
         if entries is None:
             entries = self.entry_set.all()
 
-        if entries.count() == 0:
-            return
+        inner = (
+            entries.order_by()
+            .values(
+                "country",
+                "tags",
+                currency=models.F("account__currency"),
+                month=ExtractMonth("when"),
+                username=models.F("who__username"),
+                year=ExtractYear("when"),
+            )
+            .query
+        )
+        try:
+            sql, params = inner.sql_with_params()
+        except EmptyResultSet:
+            rows = []
+        else:
+            with connection.cursor() as cursor:
+                cursor.execute(FACETS % sql, params)
+                rows = cursor.fetchall()
+
+        result = {name: {} for name in FACET_NAMES}
+        for *values, grouping, count, tagged in rows:
+            # Each grouping set groups by one column, the only one whose bit
+            # (the first column being the highest) is not set.
+            i = next(
+                i
+                for i in range(len(values))
+                if not grouping & (1 << (len(values) - 1 - i))
+            )
+            name = FACET_NAMES[i]
+            if name == "tags":
+                count = tagged
+            if count:
+                result[name][values[i]] = count
+
+        result["countries"] = OrderedDict(sorted(result["countries"].items()))
+        result["months"] = {
+            date(1900, month, 1): count
+            for month, count in result["months"].items()
+        }
+        result["tags"] = OrderedDict(
+            (tag, (label, result["tags"][tag]))
+            for tag, label in ChoicesMixin.TAG_CHOICES
+            if tag in result["tags"]
+        )
+        return result
+
+    @cached_report
+    def calculate_balance(self, entries=None, start=None, end=None):
+        if entries is None and not start and not end:
+            # Every month of the book, read from the rollups.
+            bounds = self.entry_set.aggregate(
+                start=models.Min("when"), end=models.Max("when")
+            )
+            if bounds["start"] is None:
+                return
+            start, end = bounds["start"], bounds["end"]
+            totals = self.monthlyrollup_set.values("is_income").annotate(
+                amount__sum=models.Sum("total")
+            )
+        else:
+            if entries is None:
+                entries = self.entry_set.all()
 
-        if not start:
-            start = entries.earliest("when").when
-        if not end:
-            end = entries.latest("when").when
+            if entries.count() == 0:
+                return
 
-        # Range test (inclusive).
-        assert start <= end
-        entries = entries.filter(when__range=(start, end))
-        totals = entries.values("is_income").annotate(models.Sum("amount"))
+            if not start:
+                start = entries.earliest("when").when
+            if not end:
+                end = entries.latest("when").when
+
+            # Range test (inclusive).
+            assert start <= end
+            entries = entries.filter(when__range=(start, end))
+            totals = entries.values("is_income").annotate(models.Sum("amount"))
 
         assert len(totals) <= 2, totals
 
@@ -230,43 +505,125 @@ class Book(models.Model):
         result["result"] = result["income"] - result["expense"]
         return result
 
+    @cached_report
     def balance(self, entries=None, start=None, end=None):
-        result = self.calculate_balance(entries, start, end)
-        if not result:
-            return
+        """Return the balance of `entries` between `start` and `end`.
 
-        def add_to_acc(month_balance, months):
-            if months:
-                month_balance["acc"] = (
-                    months[-1]["acc"] + month_balance["result"]
-                )
-            else:
-                month_balance["acc"] = month_balance["result"]
-
-        months = []
-        last_month = None
-        for next_month in month_year_iter(result["start"], result["end"]):
-            if last_month is not None:
-                end_of_month = next_month - timedelta(days=1)
-                month_balance = self.calculate_balance(
-                    entries, start=last_month, end=end_of_month
-                )
-                add_to_acc(month_balance, months)
-                months.append(month_balance)
-            last_month = next_month
+        Dates default to those of the first and last entries. The result
+        has the "complete" balance (see `calculate_balance`) and the list
+        of "months", each one with its balance and the accumulated result
+        up to it in "acc". Return None if there are no entries at all.
 
-        month_balance = self.calculate_balance(entries, last_month, end)
-        add_to_acc(month_balance, months)
-        months.append(month_balance)
-        # cross check totals
-        assert months[-1]["acc"] == result["result"]
+        """
+        balances = self._balances(models.Value(""), entries, start, end)
+        return balances.get("")
 
-        return {"complete": result, "months": months}
+    @cached_report
+    def currency_balances(self, entries=None, start=None, end=None):
+        """Return the balance of `entries` for each currency.
 
+        The result maps the currencies, sorted, to their balance as returned
+        by `balance`, dates defaulting to those of the first and last
+        entries of each currency.
+
+        """
+        return self._balances(
+            models.F("account__currency"), entries, start, end
+        )
+
+    def _balances(self, currency, entries, start, end):
+        """Return the balances of `entries` grouped by `currency`.
+
+        Everything is computed in a single query, see BALANCES, reading the
+        rollups when balancing every entry of the book.
+
+        """
+        if entries is None and not start and not end:
+            entries = self.monthlyrollup_set.values(
+                "is_income",
+                currency=currency,
+                when=models.F("month"),
+                amount=models.F("total"),
+            )
+            every_currency = isinstance(currency, models.Value)
+            bounds = [
+                (ENTRIES_BOUND % order, [self.pk, every_currency])
+                for order in ("ASC", "DESC")
+            ]
+        else:
+            if entries is None:
+                entries = self.entry_set.all()
+            if start:
+                entries = entries.filter(when__gte=start)
+            if end:
+                entries = entries.filter(when__lte=end)
+            entries = entries.order_by().values(
+                "when", "amount", "is_income", currency=currency
+            )
+            bounds = [
+                ('COALESCE(%s::date, MIN(e."when"))', [start]),
+                ('COALESCE(%s::date, MAX(e."when"))', [end]),
+            ]
+        result = OrderedDict()
+        try:
+            sql, params = entries.query.sql_with_params()
+        except EmptyResultSet:
+            return result
+        (first, first_params), (last, last_params) = bounds
+        with connection.cursor() as cursor:
+            cursor.execute(
+                BALANCES % dict(entries=sql, first=first, last=last),
+                (*params, *first_params, *last_params),
+            )
+            rows = cursor.fetchall()
+
+        months = defaultdict(list)
+        for key, month, first, last, income, expense, acc in rows:
+            # Range test (inclusive).
+            assert first <= last
+            months[key].append(
+                {
+                    "start": month,
+                    "end": min(last, month_end(month)),
+                    "income": income,
+                    "expense": expense,
+                    "result": income - expense,
+                    "acc": acc,
+                }
+            )
+            result[key] = {"start": first, "end": last}
+
+        for key, complete in result.items():
+            income = sum(m["income"] for m in months[key])
+            expense = sum(m["expense"] for m in months[key])
+            complete.update(
+                result=income - expense, income=income, expense=expense
+            )
+            # cross check totals
+            assert months[key][-1]["acc"] == complete["result"]
+            result[key] = {"complete": complete, "months": months[key]}
+
+        return result
+
+    @cached_report
     def breakdown(self, entries=None, start=None, end=None):
         result = self.calculate_balance(entries, start, end)
         return result
 
+    def rebuild_rollups(self):
+        """Compute the monthly rollups of this book from scratch.
+
+        Rollups are kept up to date as entries change, this is only needed
+        if entries were changed bypassing the ORM. Return the amount of
+        rollups.
+
+        """
+        with transaction.atomic(), connection.cursor() as cursor:
+            self.monthlyrollup_set.all().delete()
+            cursor.execute(REBUILD_ROLLUPS, [[self.pk]])
+            touch_books([self.pk])
+            return cursor.rowcount
+
     def merge_entries(
         self, *entries, dry_run=False, when=None, who=None, what=None
     ):
@@ -355,6 +712,16 @@ class Account(models.Model):
         ParserConfig, null=True, blank=True, on_delete=models.CASCADE
     )
     active = models.BooleanField(default=True)
+    suggest_tags = models.BooleanField(
+        default=False,
+        help_text=(
+            "Tag new entries matching no tag rule like previous entries with "
+            "the same words."
+        ),
+    )
+    # Bumped whenever one of this account's TagRegex changes, so compiled
+    # tag matchers cached by other processes are not used once outdated.
+    tag_rules_version = models.PositiveIntegerField(default=0, editable=False)
 
     objects = AccountManager()
 
@@ -372,13 +739,132 @@ class Account(models.Model):
             self.slug = slugify(self.name)
         return super(Account, self).save(*args, **kwargs)
 
-    def tags_for(self, value):
-        tags = {}
-        for tagregex in self.tagregex_set.all():
-            pattern = re.compile(tagregex.regex)
-            if pattern.match(value):
-                tags[tagregex.tag] = (tagregex.transfer, tagregex.asset)
-        return tags
+    def tag_matcher(self):
+        key = (self.pk, self.tag_rules_version)
+        matcher = _tag_matchers.get(key)
+        if matcher is None:
+            forget_tag_matchers(self.pk)
+            rules = self.tagregex_set.select_related(
+                "transfer", "asset"
+            ).order_by("id")
+            matcher = _tag_matchers[key] = TagMatcher(
+                rules, profile_every=settings.TAG_RULES_PROFILE_EVERY
+            )
+        return matcher
+
+    def tags_for(self, value, stats=True):
+        return self.tag_matcher().tags_for(value, stats=stats)
+
+    def tag_suggester(self, preload=False):
+        return TagSuggester(self.pk, preload=preload)
+
+    def rebuild_tag_tokens(self, chunk_size=RETAG_CHUNK_SIZE):
+        """Count the tokens of every entry of this account from scratch.
+
+        Token counts are kept up to date as entries change, this is only
+        needed to learn from the entries saved before they were counted.
+        Return the amount of entries counted.
+
+        """
+        rows = (
+            Entry.objects.filter(account=self)
+            .order_by()
+            .values_list(*TOKEN_FIELDS)
+            .iterator(chunk_size=chunk_size)
+        )
+        result = 0
+        with transaction.atomic():
+            TagToken.objects.filter(account=self).delete()
+            AssetToken.objects.filter(account=self).delete()
+            for chunk in iter(lambda: list(islice(rows, chunk_size)), []):
+                count_tokens(added=chunk)
+                result += len(chunk)
+        return result
+
+    def retag_entries(
+        self, book=None, dry_run=False, chunk_size=RETAG_CHUNK_SIZE, diff=None
+    ):
+        """Apply the current tag rules to the existing entries.
+
+        Entries (optionally only those in `book`) matching any rule get the
+        tags of the rules, and their asset if any, just like new entries do
+        when imported. Entries matching no rule, or matching rules with more
+        than one asset, are left as they are. Transfers are not created.
+
+        Entries are read in chunks of `chunk_size` through a server-side
+        cursor, and each chunk is saved with one UPDATE per distinct set of
+        tags and asset. If `diff` is given, it's called with the id, what,
+        old and new tags, and old and new asset id of each changed entry.
+        Nothing is saved on `dry_run`.
+
+        Return a dict with the amount of entries checked, changed, and
+        left alone because of conflicting assets.
+
+        """
+        matcher = self.tag_matcher()
+        entries = Entry.objects.filter(account=self)
+        if book is not None:
+            entries = entries.filter(book=book)
+        rows = (
+            entries.order_by()
+            .values_list("id", "book_id", "what", "tags", "asset_id")
+            .iterator(chunk_size=chunk_size)
+        )
+        result = dict(entries=0, changed=0, conflicts=0)
+        books = set()
+        # The tags and asset id (if any) for each what, None on conflicts.
+        targets = {}
+
+        def get_target(what):
+            if what not in targets:
+                tags = matcher.tags_for(what, stats=False)
+                assets = {a.pk for t, a in tags.values() if a is not None}
+                targets[what] = (
+                    (list(tags), assets.pop() if assets else None)
+                    if len(assets) < 2
+                    else None
+                )
+            return targets[what]
+
+        with transaction.atomic():
+            for chunk in iter(lambda: list(islice(rows, chunk_size)), []):
+                result["entries"] += len(chunk)
+                updates = defaultdict(list)
+                added, removed = [], []
+                for pk, book_id, what, tags, asset_id in chunk:
+                    target = get_target(what)
+                    if target is None:
+                        result["conflicts"] += 1
+                        continue
+                    new_tags, new_asset_id = target
+                    if not new_tags:
+                        continue
+                    if new_asset_id is None:
+                        new_asset_id = asset_id
+                    if new_tags == tags and new_asset_id == asset_id:
+                        continue
+                    if diff is not None:
+                        diff(pk, what, tags, new_tags, asset_id, new_asset_id)
+                    moved = new_asset_id != asset_id
+                    updates[tuple(new_tags), new_asset_id, moved].append(pk)
+                    removed.append((self.pk, what, tags, asset_id))
+                    added.append((self.pk, what, new_tags, new_asset_id))
+                    books.add(book_id)
+
+                for (tags, asset_id, moved), pks in updates.items():
+                    result["changed"] += len(pks)
+                    if dry_run:
+                        continue
+                    kwargs = dict(tags=list(tags))
+                    if moved:
+                        # Only changing assets needs updating the rollups.
+                        kwargs["asset_id"] = asset_id
+                    Entry.objects.filter(pk__in=pks).update(**kwargs)
+                if not dry_run:
+                    count_tokens(added=added, removed=removed)
+            if not dry_run:
+                touch_books(books)
+        return result
 
 
 class AssetManager(models.Manager):
@@ -430,6 +916,13 @@ class Asset(models.Model):
 
 
 class TagRegex(models.Model):
+    # Rules never matching in this many evaluations are reported as dead.
+    DEAD_EVALUATIONS = 1000
+    # Rules taking longer than this per evaluation are reported as slow.
+    SLOW_SECONDS = 20e-6
+    # Only ever updated in place, see flush_stats and save.
+    STATS_FIELDS = ("hits", "overlaps", "shadowed", "evaluations", "seconds")
+
     account = models.ForeignKey(Account, on_delete=models.CASCADE)
     asset = models.ForeignKey(
         Asset, on_delete=models.CASCADE, null=True, blank=True
@@ -443,10 +936,398 @@ class TagRegex(models.Model):
         blank=True,
         on_delete=models.CASCADE,
     )
+    # Usage of the rule when tagging, see TagMatcher.
+    hits = models.BigIntegerField(default=0, editable=False)
+    overlaps = models.BigIntegerField(
+        default=0,
+        editable=False,
+        help_text="Matches along with other rules of the account.",
+    )
+    shadowed = models.BigIntegerField(
+        default=0,
+        editable=False,
+        help_text="Matches overridden by a later rule with the same tag.",
+    )
+    evaluations = models.BigIntegerField(default=0, editable=False)
+    seconds = models.FloatField(default=0, editable=False)
 
     class Meta:
         unique_together = ("account", "regex", "tag")
 
+    def save(self, *args, **kwargs):
+        # Saving a changed rule must not overwrite the stats flushed since it
+        # was loaded, as when edited in the admin.
+        if (
+            not self._state.adding
+            and not args
+            and not kwargs.get("force_insert")
+            and kwargs.get("update_fields") is None
+        ):
+            kwargs["update_fields"] = [
+                f.name
+                for f in self._meta.concrete_fields
+                if not f.primary_key and f.name not in self.STATS_FIELDS
+            ]
+        return super(TagRegex, self).save(*args, **kwargs)
+
+    @property
+    def cost(self):
+        """Return the average seconds per evaluation, None if unknown."""
+        return self.seconds / self.evaluations if self.evaluations else None
+
+    @property
+    def is_dead(self):
+        return not self.hits and self.evaluations >= self.DEAD_EVALUATIONS
+
+    @property
+    def is_slow(self):
+        return self.cost is not None and self.cost > self.SLOW_SECONDS
+
+
+FLUSH_TAG_RULE_STATS = """
+    UPDATE gemcore_tagregex AS r SET
+        hits = r.hits + v.hits,
+        "overlaps" = r."overlaps" + v."overlaps",
+        shadowed = r.shadowed + v.shadowed,
+        evaluations = r.evaluations + v.evaluations,
+        seconds = r.seconds + v.seconds
+    FROM (VALUES %s)
+        AS v (id, hits, "overlaps", shadowed, evaluations, seconds)
+    WHERE r.id = v.id
+"""
+
+
+class TagMatcher:
+    """Match values against a set of TagRegex compiled only once.
+
+    Rules whose regex is a plain literal are indexed by their first char, so
+    only those sharing the value's first char are checked. Every other rule
+    is compiled once and matched in order.
+
+    The matches of every rule are counted, as well as how many times it
+    matched along with other rules and how many of those its tag was set by
+    a later rule anyway. One of every `profile_every` values (if any) is
+    matched timing each rule, and the time and evaluations are scaled by
+    `profile_every` to estimate the totals. Counts are saved to the rules
+    by `flush_stats`.
+
+    """
+
+    METACHARS = frozenset(".^$*+?{}[]\\|()")
+
+    def __init__(self, rules, profile_every=0):
+        self.literals = defaultdict(list)
+        self.patterns = []
+        self.rule_ids = []
+        for i, rule in enumerate(rules):
+            self.rule_ids.append(rule.pk)
+            target = (i, rule.tag, rule.transfer, rule.asset)
+            if rule.regex and not self.METACHARS.intersection(rule.regex):
+                self.literals[rule.regex[0]].append((rule.regex, target))
+            else:
+                self.patterns.append((re.compile(rule.regex).match, target))
+        self.profile_every = profile_every
+        self.calls = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        # Hits, overlaps, shadowed, evaluations and seconds of each rule.
+        self.stats = [[0, 0, 0, 0, 0.0] for pk in self.rule_ids]
+
+    def take_stats(self):
+        """Return the stats by rule id since the last call, and reset them."""
+        result = {
+            pk: tuple(stats)
+            for pk, stats in zip(self.rule_ids, self.stats)
+            if any(stats)
+        }
+        self.reset_stats()
+        return result
+
+    def add_stats(self, stats):
+        """Add the `stats` taken from another matcher with the same rules."""
+        for i, pk in enumerate(self.rule_ids):
+            for j, value in enumerate(stats.get(pk, ())):
+                self.stats[i][j] += value
+
+    def flush_stats(self):
+        """Add the stats since the last flush to the rules, in one UPDATE."""
+        stats = self.take_stats()
+        if not stats:
+            return
+        values = ", ".join(["(%s, %s, %s, %s, %s, %s::float)"] * len(stats))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                FLUSH_TAG_RULE_STATS % values,
+                [x for pk in sorted(stats) for x in (pk, *stats[pk])],
+            )
+
+    def profile(self, value):
+        clock = time.perf_counter
+        checks = [
+            (value.startswith, literal, target)
+            for literal, target in self.literals.get(value[:1], ())
+        ]
+        checks.extend(
+            (match, value, target) for match, target in self.patterns
+        )
+        matches = []
+        for check, arg, target in checks:
+            start = clock()
+            matched = check(arg)
+            stats = self.stats[target[0]]
+            stats[3] += self.profile_every
+            stats[4] += (clock() - start) * self.profile_every
+            if matched:
+                matches.append(target)
+        return matches
+
+    def tags_for(self, value, stats=True):
+        """Return the transfer and asset of each tag for `value`.
+
+        The matches are only counted if `stats` is set, so the same value can
+        be looked up again without skewing the stats.
+
+        """
+        if stats:
+            self.calls += 1
+        if (
+            stats
+            and self.profile_every
+            and not self.calls % self.profile_every
+        ):
+            matches = self.profile(value)
+        else:
+            matches = [
+                target
+                for literal, target in self.literals.get(value[:1], ())
+                if value.startswith(literal)
+            ]
+            matches.extend(
+                target for match, target in self.patterns if match(value)
+            )
+        if len(matches) > 1:
+            # Keep rule order, so later rules win for a repeated tag.
+            matches.sort(key=operator.itemgetter(0))
+            if stats:
+                last = {tag: i for i, tag, transfer, asset in matches}
+                for i, tag, transfer, asset in matches:
+                    self.stats[i][1] += 1
+                    self.stats[i][2] += last[tag] != i
+        if stats:
+            for match in matches:
+                self.stats[match[0]][0] += 1
+        return {tag: (transfer, asset) for i, tag, transfer, asset in matches}
+
+
+# Compiled TagMatcher per (account id, account tag rules version).
+_tag_matchers = {}
+
+
+def forget_tag_matchers(account_id):
+    for key in [k for k in _tag_matchers if k[0] == account_id]:
+        _tag_matchers.pop(key).flush_stats()
+
+
+def flush_tag_rule_stats():
+    """Save the stats of the rules of every cached TagMatcher."""
+    for matcher in _tag_matchers.values():
+        matcher.flush_stats()
+
+
+def tokenize(value):
+    """Return the distinct lowercase tokens (see TOKEN_RE) in `value`."""
+    return list(
+        dict.fromkeys(
+            word.lower()[:MAX_TOKEN_LENGTH] for word in TOKEN_RE.findall(value)
+        )
+    )
+
+
+class TagSuggester:
+    """Suggest tags, and an asset, for values from an account's entries.
+
+    Each token of a value suggests the tags (and asset) of at least
+    MIN_SHARE of the account's entries having that token, as long as there
+    are at least MIN_ENTRIES of them. So suggesting costs a lookup per
+    token, no matter how many entries or rules the account has.
+
+    Counts (see TagToken and AssetToken) are read once per token, or all at
+    once if `preload` is set, which is cheaper for many values.
+
+    """
+
+    MIN_ENTRIES = 3
+    MIN_SHARE = 0.8
+
+    def __init__(self, account_id, preload=False):
+        self.account_id = account_id
+        self.preload = preload
+        # Counts per token, by tag ("" being the total) and by asset id.
+        self.tags = {}
+        self.assets = {}
+        self.loaded = set()
+        if preload:
+            self.load()
+
+    def load(self, tokens=None):
+        tags = TagToken.objects.filter(account_id=self.account_id, count__gt=0)
+        assets = AssetToken.objects.filter(
+            account_id=self.account_id, count__gt=0
+        )
+        if tokens is not None:
+            tags = tags.filter(token__in=tokens)
+            assets = assets.filter(token__in=tokens)
+            self.loaded.update(tokens)
+        for token, tag, count in tags.values_list("token", "tag", "count"):
+            self.tags.setdefault(token, {})[tag] = count
+        for token, asset_id, count in assets.values_list(
+            "token", "asset_id", "count"
+        ):
+            self.assets.setdefault(token, {})[asset_id] = count
+
+    def vote(self, shares, total, counts):
+        for key, count in counts.items():
+            share = count / total
+            if key != "" and share >= self.MIN_SHARE:
+                shares[key] = max(shares.get(key, 0), share)
+
+    def suggest(self, value):
+        """Return the list of tags for `value`, and an asset id or None."""
+        tokens = tokenize(value)
+        if not self.preload:
+            missing = [t for t in tokens if t not in self.loaded]
+            if missing:
+                self.load(missing)
+        tags = {}
+        assets = {}
+        for token in tokens:
+            total = self.tags.get(token, {}).get("", 0)
+            if total < self.MIN_ENTRIES:
+                continue
+            self.vote(tags, total, self.tags[token])
+            self.vote(assets, total, self.assets.get(token, {}))
+        asset = max(assets, key=assets.get) if assets else None
+        return sorted(tags, key=lambda t: (-tags[t], t)), asset
+
+
+class EntryQuerySet(models.QuerySet):
+    """Entries whose bulk creations and updates keep the rollups current.
+
+    Bulk creations keep the token counts current too.
+
+    """
+
+    def month_entries(self, months):
+        """Return the entries in `months`, (book id, first day) pairs."""
+        return self.model.objects.filter(
+            reduce(
+                operator.or_,
+                (
+                    models.Q(
+                        book_id=book_id, when__range=(day, month_end(day))
+                    )
+                    for book_id, day in months
+                ),
+            )
+        )
+
+    def month_rollups(self, months):
+        """Return the counts and totals of the entries in `months`.
+
+        `months` is a set of (book id, first day of the month) pairs. Counts
+        and totals are keyed as the rollups are, see `add_rollups`.
+
+        """
+        rows = self.month_entries(months).values_list(
+            "book_id",
+            "account_id",
+            "asset_id",
+            TruncMonth("when"),
+            "is_income",
+        ).annotate(models.Count("id"), models.Sum("amount"))
+        counts = Counter()
+        totals = Counter()
+        for *key, count, total in rows:
+            counts[tuple(key)] = count
+            totals[tuple(key)] = total
+        return counts, totals
+
+    def month_tokens(self, months):
+        """Return a Counter of the TOKEN_FIELDS of the entries in `months`."""
+        rows = self.month_entries(months).values_list(*TOKEN_FIELDS)
+        return Counter(
+            (account_id, what, tuple(tags), asset_id)
+            for account_id, what, tags, asset_id in rows
+        )
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        conflicts = kwargs.get("ignore_conflicts") or kwargs.get(
+            "update_conflicts"
+        )
+        # Entries updated to another book or date leave unknown months.
+        moved = {"book", "book_id", "when"}.intersection(
+            kwargs.get("update_fields") or ()
+        )
+        months = None
+        with transaction.atomic():
+            if conflicts and objs and not moved:
+                # There is no telling which entries were actually created (or
+                # updated), compare their months before and after instead.
+                months = {
+                    (e.book_id, e.rollup_fields[3].replace(day=1))
+                    for e in objs
+                }
+                old_counts, old_totals = self.month_rollups(months)
+                old_tokens = self.month_tokens(months)
+            result = super(EntryQuerySet, self).bulk_create(
+                objs, *args, **kwargs
+            )
+            if months is not None:
+                counts, totals = self.month_rollups(months)
+                counts.subtract(old_counts)
+                totals.subtract(old_totals)
+                add_rollups(counts, totals)
+                tokens = self.month_tokens(months)
+                count_tokens(
+                    added=list((tokens - old_tokens).elements()),
+                    removed=list((old_tokens - tokens).elements()),
+                )
+            elif conflicts:
+                for book in Book.objects.filter(
+                    pk__in={e.book_id for e in objs}
+                ):
+                    book.rebuild_rollups()
+                for account in Account.objects.filter(
+                    pk__in={e.account_id for e in objs}
+                ):
+                    account.rebuild_tag_tokens()
+            else:
+                count_rollups(added=[e.rollup_fields for e in objs])
+                count_tokens(added=[e.token_fields for e in objs])
+            touch_books({e.book_id for e in objs})
+        return result
+
+    def update(self, **kwargs):
+        """Update the entries, keeping their rollups current.
+
+        Updating other fields than those in ROLLUP_FIELDS does not forget
+        the cached reports of the books, see `update_entries`.
+
+        """
+        fields = {self.model._meta.get_field(name).attname for name in kwargs}
+        if fields.isdisjoint(ROLLUP_FIELDS):
+            return super(EntryQuerySet, self).update(**kwargs)
+        with transaction.atomic():
+            old = list(self.values_list("id", *ROLLUP_FIELDS))
+            result = super(EntryQuerySet, self).update(**kwargs)
+            new = Entry.objects.filter(pk__in=[row[0] for row in old])
+            new = list(new.values_list(*ROLLUP_FIELDS))
+            count_rollups(added=new, removed=[row[1:] for row in old])
+            touch_books([row[1] for row in old] + [row[0] for row in new])
+        return result
+
 
 class Entry(models.Model):
     book = models.ForeignKey(Book, on_delete=models.CASCADE)
@@ -474,6 +1355,8 @@ class Entry(models.Model):
     )
     notes = models.TextField(blank=True)
 
+    objects = EntryQuerySet.as_manager()
+
     class Meta:
         unique_together = (
             "book",
@@ -483,6 +1366,8 @@ class Entry(models.Model):
             "amount",
             "is_income",
         )
+        # The first and last dates of a book's entries are looked up often.
+        indexes = [models.Index(fields=["book", "when"])]
         verbose_name_plural = "Entries"
 
     def __str__(self):
@@ -499,6 +1384,242 @@ class Entry(models.Model):
     def money(self):
         return self.amount if self.is_income else -self.amount
 
+    @property
+    def token_fields(self):
+        return tuple(getattr(self, name) for name in TOKEN_FIELDS)
+
+    @property
+    def rollup_fields(self):
+        # Values may not be cleaned yet, as in Entry(when="2024-05-01").
+        return tuple(
+            self._meta.get_field(name).to_python(getattr(self, name))
+            for name in ROLLUP_FIELDS
+        )
+
+
+class TagToken(models.Model):
+    """How many entries of an account have a token and a tag.
+
+    The count for the empty tag is the amount of entries having the token.
+
+    """
+
+    account = models.ForeignKey(Account, on_delete=models.CASCADE)
+    token = models.CharField(max_length=MAX_TOKEN_LENGTH)
+    tag = models.CharField(max_length=256, blank=True)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ("account", "token", "tag")
+
+
+class AssetToken(models.Model):
+    """How many entries of an account have a token and an asset."""
+
+    account = models.ForeignKey(Account, on_delete=models.CASCADE)
+    token = models.CharField(max_length=MAX_TOKEN_LENGTH)
+    asset = models.ForeignKey(Asset, on_delete=models.CASCADE)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ("account", "token", "asset")
+
+
+ADD_TOKEN_COUNTS = """
+    INSERT INTO %(table)s (account_id, token, %(column)s, count)
+    VALUES %(values)s
+    ON CONFLICT (account_id, token, %(column)s)
+    DO UPDATE SET count = %(table)s.count + EXCLUDED.count
+"""
+SUBTRACT_TOKEN_COUNTS = """
+    UPDATE %(table)s AS t SET count = t.count + v.count
+    FROM (VALUES %(values)s) AS v (account_id, token, %(column)s, count)
+    WHERE t.account_id = v.account_id
+        AND t.token = v.token
+        AND t.%(column)s = v.%(column)s
+"""
+
+
+def count_tokens(added=(), removed=()):
+    """Update the token counts for the `added` and `removed` entries.
+
+    Entries are given as (account id, what, tags, asset id) tuples, see
+    TOKEN_FIELDS. Counts are only ever subtracted from existing rows, so
+    forgetting entries never counted is harmless.
+
+    """
+    tags = Counter()
+    assets = Counter()
+    for delta, entries in ((1, added), (-1, removed)):
+        for account_id, what, entry_tags, asset_id in entries:
+            for token in tokenize(what):
+                tags[account_id, token, ""] += delta
+                for tag in set(entry_tags):
+                    tags[account_id, token, tag] += delta
+                if asset_id is not None:
+                    assets[account_id, token, asset_id] += delta
+
+    with connection.cursor() as cursor:
+        for model, column, counts in (
+            (TagToken, "tag", tags),
+            (AssetToken, "asset_id", assets),
+        ):
+            # Sorted, so concurrent updates lock rows in the same order.
+            keys = sorted(k for k, v in counts.items() if v)
+            for sql, rows in (
+                (ADD_TOKEN_COUNTS, [k for k in keys if counts[k] > 0]),
+                (SUBTRACT_TOKEN_COUNTS, [k for k in keys if counts[k] < 0]),
+            ):
+                batches = iter(rows)
+                for batch in iter(
+                    lambda: list(islice(batches, TOKEN_COUNTS_BATCH_SIZE)), []
+                ):
+                    values = ", ".join(["(%s, %s, %s, %s)"] * len(batch))
+                    cursor.execute(
+                        sql
+                        % dict(
+                            table=model._meta.db_table,
+                            column=column,
+                            values=values,
+                        ),
+                        [x for key in batch for x in (*key, counts[key])],
+                    )
+
+
+class MonthlyRollup(models.Model):
+    """How many entries, and for how much, a book has in a month.
+
+    Entries are grouped by account, asset and whether they are incomes, so
+    the reports for a whole book do not need to read every entry.
+
+    """
+
+    book = models.ForeignKey(Book, on_delete=models.CASCADE)
+    account = models.ForeignKey(Account, on_delete=models.CASCADE)
+    asset = models.ForeignKey(Asset, null=True, on_delete=models.CASCADE)
+    month = models.DateField()
+    is_income = models.BooleanField()
+    count = models.IntegerField(default=0)
+    total = models.DecimalField(
+        decimal_places=2, max_digits=16, default=Decimal(0)
+    )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["book", "account", "asset", "month", "is_income"],
+                name="unique_monthly_rollup",
+                nulls_distinct=False,
+            )
+        ]
+
+
+ADD_ROLLUPS = """
+    INSERT INTO gemcore_monthlyrollup (
+        book_id, account_id, asset_id, month, is_income, count, total
+    )
+    VALUES %s
+    ON CONFLICT (book_id, account_id, asset_id, month, is_income)
+    DO UPDATE SET
+        count = gemcore_monthlyrollup.count + EXCLUDED.count,
+        total = gemcore_monthlyrollup.total + EXCLUDED.total
+"""
+SUBTRACT_ROLLUPS = """
+    UPDATE gemcore_monthlyrollup AS r
+    SET count = r.count + v.count, total = r.total + v.total
+    FROM (VALUES %s) AS v (
+        book_id, account_id, asset_id, month, is_income, count, total
+    )
+    WHERE r.book_id = v.book_id
+        AND r.account_id = v.account_id
+        AND r.asset_id IS NOT DISTINCT FROM v.asset_id
+        AND r.month = v.month
+        AND r.is_income = v.is_income
+"""
+DELETE_EMPTY_ROLLUPS = """
+    DELETE FROM gemcore_monthlyrollup
+    WHERE count <= 0 AND book_id = ANY(%s)
+"""
+REBUILD_ROLLUPS = """
+    INSERT INTO gemcore_monthlyrollup (
+        book_id, account_id, asset_id, month, is_income, count, total
+    )
+    SELECT
+        book_id, account_id, asset_id, date_trunc('month', "when")::date,
+        is_income, COUNT(*), SUM(amount)
+    FROM gemcore_entry
+    WHERE book_id = ANY(%s)
+    GROUP BY 1, 2, 3, 4, 5
+"""
+
+
+def count_rollups(added=(), removed=()):
+    """Update the monthly rollups for the `added` and `removed` entries.
+
+    Entries are given as (book id, account id, asset id, when, is_income,
+    amount) tuples, see ROLLUP_FIELDS. As with `count_tokens`, rollups are
+    only ever subtracted from existing rows, and rows left without entries
+    are deleted.
+
+    """
+    counts = Counter()
+    totals = Counter()
+    for delta, entries in ((1, added), (-1, removed)):
+        for book_id, account_id, asset_id, when, is_income, amount in entries:
+            key = (book_id, account_id, asset_id, when.replace(day=1))
+            key += (is_income,)
+            counts[key] += delta
+            totals[key] += delta * amount
+    add_rollups(counts, totals)
+
+
+def add_rollups(counts, totals):
+    """Add the `counts` and `totals` deltas, keyed as the rollups are."""
+    # Sorted, so concurrent updates lock rows in the same order.
+    keys = sorted(
+        (k for k in counts if counts[k] or totals[k]),
+        key=lambda k: (*k[:2], k[2] or 0, *k[3:]),
+    )
+    with connection.cursor() as cursor:
+        for sql, rows in (
+            (ADD_ROLLUPS, [k for k in keys if counts[k] > 0]),
+            (SUBTRACT_ROLLUPS, [k for k in keys if counts[k] <= 0]),
+        ):
+            batches = iter(rows)
+            for batch in iter(
+                lambda: list(islice(batches, TOKEN_COUNTS_BATCH_SIZE)), []
+            ):
+                values = ", ".join(
+                    ["(%s, %s, %s::integer, %s::date, %s, %s, %s)"]
+                    * len(batch)
+                )
+                cursor.execute(
+                    sql % values,
+                    [x for k in batch for x in (*k, counts[k], totals[k])],
+                )
+        if any(counts[k] < 0 for k in keys):
+            cursor.execute(
+                DELETE_EMPTY_ROLLUPS, [sorted({k[0] for k in keys})]
+            )
+
+
+def update_entries(entries, **kwargs):
+    """Update `entries` with `kwargs`, keeping their token counts in sync.
+
+    The cached reports of their books are forgotten too.
+
+    """
+    with transaction.atomic():
+        old = list(entries.values_list("id", "book_id", *TOKEN_FIELDS))
+        result = entries.update(**kwargs)
+        new = Entry.objects.filter(pk__in=[row[0] for row in old])
+        count_tokens(
+            added=new.values_list(*TOKEN_FIELDS),
+            removed=[row[2:] for row in old],
+        )
+        touch_books(row[1] for row in old)
+    return result
+
 
 class EntryHistory(models.Model):
     DELETE = "delete"
@@ -535,6 +1656,159 @@ class EntryHistory(models.Model):
         )
 
 
+class ImportRun(models.Model):
+    """The ledger of the files imported for a given book and account.
+
+    A run is keyed by the SHA-256 of the file content, so importing the very
+    same file again can be detected before parsing it. The rows that were
+    imported are kept apart, see `ImportedRow`.
+
+    """
+
+    book = models.ForeignKey(Book, on_delete=models.CASCADE)
+    account = models.ForeignKey(Account, on_delete=models.CASCADE)
+    parser_config = models.ForeignKey(ParserConfig, on_delete=models.CASCADE)
+    content_hash = models.CharField(max_length=64)
+    name = models.TextField(blank=True)
+    rows = models.PositiveIntegerField(default=0)
+    entry_count = models.PositiveIntegerField(default=0)
+    skipped = models.PositiveIntegerField(default=0)
+    error_count = models.PositiveIntegerField(default=0)
+    errors = models.JSONField(
+        default=list, blank=True, encoder=DjangoJSONEncoder
+    )
+    created = models.DateTimeField(default=now)
+
+    class Meta:
+        ordering = ("-created",)
+        unique_together = ("book", "account", "parser_config", "content_hash")
+
+    def __str__(self):
+        return "%s for %s (%s: %s entries, %s skipped, %s errors)" % (
+            self.name or "Import",
+            self.account.slug,
+            self.created.date(),
+            self.entry_count,
+            self.skipped,
+            self.error_count,
+        )
+
+
+class ImportedRow(models.Model):
+    """A row of a file imported for an account, keyed by its hash.
+
+    Rows imported before are skipped without being processed, so a file
+    overlapping previous ones only needs its new rows to be processed. Each
+    row is tied to the entry made from it: once the entry is deleted, the row
+    can be imported again.
+
+    """
+
+    account = models.ForeignKey(Account, on_delete=models.CASCADE)
+    parser_config = models.ForeignKey(ParserConfig, on_delete=models.CASCADE)
+    entry = models.ForeignKey(Entry, on_delete=models.CASCADE)
+    hash = models.CharField(max_length=32)
+
+    class Meta:
+        indexes = [models.Index(fields=["account", "hash"])]
+
+    def __str__(self):
+        return "%s for %s (entry %s)" % (
+            self.hash,
+            self.account.slug,
+            self.entry_id,
+        )
+
+
+class ImportJobManager(models.Manager):
+    def claim(self):
+        """Mark the oldest pending job as running and return it.
+
+        Jobs being claimed by other workers are skipped, so many workers can
+        share the same queue. Running jobs whose progress was not updated for
+        longer than settings.IMPORT_JOB_TIMEOUT are taken back too, since
+        their worker most likely died. Return None if there are no pending
+        jobs.
+
+        """
+        abandoned = now() - timedelta(seconds=settings.IMPORT_JOB_TIMEOUT)
+        with transaction.atomic():
+            job = (
+                self.select_for_update(skip_locked=True)
+                .filter(
+                    models.Q(status=ImportJob.PENDING)
+                    | models.Q(
+                        status=ImportJob.RUNNING, heartbeat__lt=abandoned
+                    )
+                )
+                .order_by("created", "id")
+                .first()
+            )
+            if job is not None:
+                job.status = ImportJob.RUNNING
+                job.started = job.heartbeat = now()
+                job.save(update_fields=["status", "started", "heartbeat"])
+        return job
+
+
+class ImportJob(models.Model):
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    book = models.ForeignKey(Book, on_delete=models.CASCADE)
+    account = models.ForeignKey(Account, on_delete=models.CASCADE)
+    who = models.ForeignKey(User, on_delete=models.CASCADE)
+    name = models.TextField(blank=True)
+    # The uploaded file, deleted once imported.
+    file = models.FileField(upload_to="imports/", max_length=1024, blank=True)
+    status = models.CharField(
+        max_length=256,
+        choices=((i, i) for i in (PENDING, RUNNING, DONE, FAILED)),
+        default=PENDING,
+    )
+    rows = models.PositiveIntegerField(default=0)
+    entry_count = models.PositiveIntegerField(default=0)
+    error_count = models.PositiveIntegerField(default=0)
+    errors = models.JSONField(
+        default=list, blank=True, encoder=DjangoJSONEncoder
+    )
+    duplicate_of = models.ForeignKey(
+        ImportRun, null=True, blank=True, on_delete=models.SET_NULL
+    )
+
+    created = models.DateTimeField(default=now)
+    started = models.DateTimeField(null=True, blank=True)
+    # Refreshed as the job makes progress, see ImportJobManager.claim.
+    heartbeat = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    objects = ImportJobManager()
+
+    class Meta:
+        ordering = ("-created",)
+
+    def __str__(self):
+        return "%s for %s (%s, %s rows)" % (
+            self.name or "Import",
+            self.account.slug,
+            self.status,
+            self.rows,
+        )
+
+    @property
+    def is_finished(self):
+        return self.status in (self.DONE, self.FAILED)
+
+    @property
+    def rows_per_second(self):
+        if self.started is None:
+            return None
+        elapsed = ((self.finished or now()) - self.started).total_seconds()
+        return self.rows / elapsed if elapsed > 0 else None
+
+
 @receiver(pre_delete, sender=Entry)
 def record_entry_history(sender, instance, **kwargs):
     EntryHistory.objects.create(
@@ -550,3 +1824,71 @@ def record_entry_history(sender, instance, **kwargs):
         notes=instance.notes,
         reason=EntryHistory.DELETE,
     )
+
+
+@receiver(post_delete, sender=ImportJob)
+def delete_import_job_file(sender, instance, **kwargs):
+    if instance.file:
+        instance.file.delete(save=False)
+
+
+@receiver(pre_save, sender=Entry)
+def remember_entry_counts(sender, instance, raw=False, **kwargs):
+    instance._old_counts = None
+    if not raw and not instance._state.adding:
+        instance._old_counts = (
+            Entry.objects.filter(pk=instance.pk)
+            .values_list(*TOKEN_FIELDS, *ROLLUP_FIELDS)
+            .first()
+        )
+
+
+@receiver(post_save, sender=Entry)
+def update_entry_counts(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    tokens = instance.token_fields
+    rollup = instance.rollup_fields
+    old = instance.__dict__.pop("_old_counts", None)
+    books = {instance.book_id}
+    if created:
+        count_tokens(added=[tokens])
+        count_rollups(added=[rollup])
+    elif old is not None:
+        n = len(TOKEN_FIELDS)
+        old_tokens, old_rollup = old[:n], old[n:]
+        if old_tokens != tokens:
+            count_tokens(added=[tokens], removed=[old_tokens])
+        if old_rollup != rollup:
+            count_rollups(added=[rollup], removed=[old_rollup])
+        books.add(old_rollup[0])
+    touch_books(books)
+
+
+@receiver(post_delete, sender=Entry)
+def forget_entry_counts(sender, instance, **kwargs):
+    count_tokens(removed=[instance.token_fields])
+    count_rollups(removed=[instance.rollup_fields])
+    touch_books([instance.book_id])
+
+
+@receiver(pre_delete, sender=Asset)
+def move_asset_rollups(sender, instance, **kwargs):
+    # Entries are kept without an asset, and so are their rollups.
+    counts = Counter()
+    totals = Counter()
+    for rollup in instance.monthlyrollup_set.all():
+        key = (rollup.book_id, rollup.account_id, None, rollup.month)
+        key += (rollup.is_income,)
+        counts[key] += rollup.count
+        totals[key] += rollup.total
+    add_rollups(counts, totals)
+
+
+@receiver(post_save, sender=TagRegex)
+@receiver(post_delete, sender=TagRegex)
+def invalidate_tag_matcher(sender, instance, **kwargs):
+    Account.objects.filter(pk=instance.account_id).update(
+        tag_rules_version=models.F("tag_rules_version") + 1
+    )
+    forget_tag_matchers(instance.account_id)
@@ -1,20 +1,121 @@
 # /usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import bz2
 import codecs
 import csv
+import gzip
+import hashlib
+import io
 import logging
+import mmap
+import multiprocessing
+import os
 import re
-from datetime import datetime
+import shutil
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from decimal import Decimal
+from itertools import islice
 
+import chardet
 from django.conf import settings
-from django.db import transaction
+from django.core.exceptions import ValidationError
+from django.core.validators import ProhibitNullCharactersValidator
+from django.db import IntegrityError, connection, connections, transaction
+from django.utils.timezone import now
 
-from gemcore.forms import EntryForm
+from gemcore.forms import EntryForm, EntryValidator
+from gemcore.models import (
+    Entry,
+    ImportedRow,
+    ImportJob,
+    ImportRun,
+    count_rollups,
+    count_tokens,
+    flush_tag_rule_stats,
+    touch_books,
+)
 
 logger = logging.getLogger(__name__)
 
+# Default amount of rows validated and saved together when batching.
+BATCH_SIZE = 500
+# Amount of bytes read from the start of a file to guess its encoding.
+ENCODING_SAMPLE_SIZE = 64 * 1024
+# Amount of bytes read at a time when hashing a file.
+HASH_CHUNK_SIZE = 64 * 1024
+# Decompressed files are spooled to disk past this size.
+SPOOL_SIZE = 16 * 1024 * 1024
+# Leading bytes identifying compressed files and archives.
+GZIP_MAGIC = b"\x1f\x8b"
+BZIP2_MAGIC = re.compile(rb"BZh[1-9](1AY&SY|\x17rE8P\x90)")
+ZIP_MAGIC = b"PK\x03\x04"
+# Amount of row hashes looked up at a time among the rows imported before.
+KNOWN_ROWS_BATCH = 1000
+# Smallest chunk of a file decoded on its own when parsing in parallel.
+MIN_CHUNK_SIZE = 1024 * 1024
+# Buffered files that can be memory mapped.
+MAPPABLE_FILES = (io.FileIO, io.BufferedReader, io.BufferedRandom)
+# Kinds of decoded rows, see CSVParser.decode_rows.
+DATA = "data"
+DEFERRED = "deferred"
+ERROR = "error"
+SKIPPED = "skipped"
+
+
+def _decode_as_latin1(error):
+    start, end = error.start, error.end
+    return error.object[start:end].decode("latin-1"), end
+
+
+codecs.register_error("gemcore.latin1", _decode_as_latin1)
+
+
+class NamedTextIOWrapper(io.TextIOWrapper):
+    """A TextIOWrapper with a name other than the wrapped buffer's."""
+
+    def __init__(self, buffer, name, **kwargs):
+        super(NamedTextIOWrapper, self).__init__(buffer, **kwargs)
+        self._name = name
+
+    @property
+    def name(self):
+        return self._name
+
+
+def open_text_stream(binary, name, sample_size=ENCODING_SAMPLE_SIZE):
+    """Return a text stream lazily decoding the seekable `binary` file.
+
+    The encoding is guessed from the first `sample_size` bytes only. If the
+    sample is plain ASCII the rest of the file is decoded as UTF-8, falling
+    back to Latin-1 for any byte that is not valid UTF-8.
+
+    """
+    sample = binary.read(sample_size)
+    binary.seek(0)
+    if len(sample) == sample_size:
+        # Drop the last line, it may end in a partial multi-byte char.
+        sample = sample[: sample.rfind(b"\n") + 1] or sample
+    encoding = chardet.detect(sample)["encoding"]
+    errors = "strict"
+    if encoding is None or encoding == "ascii":
+        encoding = "utf-8"
+        errors = "gemcore.latin1"
+    logger.debug(
+        "open_text_stream name: %r encoding: %r errors: %r",
+        name,
+        encoding,
+        errors,
+    )
+    return NamedTextIOWrapper(
+        binary, name, encoding=encoding, errors=errors, newline=""
+    )
+
 
 class DataToBeProcessedError(Exception):
     """This row will be processed later."""
@@ -24,20 +125,314 @@ class DataToBeProcessedError(Exception):
         super(DataToBeProcessedError, self).__init__(*args, **kwargs)
 
 
-class CSVParser(object):
-    def __init__(self, account):
-        super(CSVParser, self).__init__()
+class ImportStats(object):
+    """Wall time and amount of items processed by each stage of an import.
+
+    Times are exclusive: the time spent in a stage measured while another
+    stage is being measured is not accounted to the outer stage, so the
+    times of all the stages add up to the measured total.
+
+    """
+
+    STAGES = (
+        "decode",
+        "make_data",
+        "tagging",
+        "duplicates",
+        "validation",
+        "transfers",
+        "save",
+    )
+
+    def __init__(self):
+        super(ImportStats, self).__init__()
+        self.seconds = dict.fromkeys(self.STAGES, 0.0)
+        self.counts = dict.fromkeys(self.STAGES, 0)
+        self._nested = []
+
+    def add(self, stage, seconds, count=1):
+        self.seconds[stage] += seconds
+        self.counts[stage] += count
+
+    @contextmanager
+    def measure(self, stage, count=1):
+        self._nested.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.add(stage, elapsed - self._nested.pop(), count)
+            if self._nested:
+                self._nested[-1] += elapsed
+
+    def update(self, stages):
+        """Add the counts and times of the `stages` of another as_dict()."""
+        for stage, value in stages.items():
+            self.add(stage, value["seconds"], value["count"])
+
+    def as_dict(self):
+        return {
+            stage: {
+                "count": self.counts[stage],
+                "seconds": self.seconds[stage],
+            }
+            for stage in self.STAGES
+        }
+
+
+def _row_end(data, start, offset):
+    """Return the offset right after the row ending at or after `offset`.
+
+    `start` is the offset of the start of a row in `data`. Quotes are counted
+    from there, so newlines inside quoted fields do not end a row.
+
+    """
+    quotes = data[start:offset].count(b'"')
+    while True:
+        end = data.find(b"\n", offset)
+        if end == -1:
+            return len(data)
+        quotes += data[offset:end].count(b'"')
+        offset = end + 1
+        if quotes % 2 == 0:
+            return offset
+
+
+def split_rows(data, parts, skip_rows=0):
+    """Return the (start, end) offsets of about `parts` chunks of `data`.
+
+    Chunks hold whole CSV rows and are about the same size. The first
+    `skip_rows` rows are not in any chunk.
+
+    """
+    start = 0
+    for i in range(skip_rows):
+        start = _row_end(data, start, start)
+    size = len(data)
+    step = max(1, -(-(size - start) // parts))
+    spans = []
+    while start < size:
+        end = _row_end(data, start, start + step - 1)
+        spans.append((start, end))
+        start = end
+    return spans
+
+
+# The parser and the mapped file of a split parse, set in each worker.
+_chunk_worker = None
+
+
+def _init_chunk_worker(parser, data, encoding, errors, user, find_known):
+    global _chunk_worker
+    _chunk_worker = (parser, data, encoding, errors, user, find_known)
+    # Tag rule stats are sent back to the parent, see `_decode_chunk`.
+    parser.account.tag_matcher().reset_stats()
+
+
+def _decode_chunk(start, end):
+    """Decode the rows between `start` and `end` of the mapped file.
+
+    Return the list of decoded rows (see `CSVParser.decode_rows`), the
+    stages of the work done, and the stats of the tag rules used.
+
+    """
+    parser, data, encoding, errors, user, find_known = _chunk_worker
+    parser.stats = ImportStats()
+    with parser.stats.measure("decode", count=0):
+        text = data[start:end].decode(encoding, errors)
+    rows = parser.read_rows(io.StringIO(text, newline=""))
+    decoded = list(parser.decode_rows(rows, user, find_known))
+    rule_stats = parser.account.tag_matcher().take_stats()
+    return decoded, parser.stats.as_dict(), rule_stats
+
+
+def format_stages(stages):
+    """Return a one line summary of the `stages` of an ImportStats dict."""
+    return ", ".join(
+        "%s: %s in %.3fs" % (stage, value["count"], value["seconds"])
+        for stage, value in stages.items()
+    )
+
+
+class DuplicateIndex(object):
+    """The unique keys of the existing entries for an account in a book.
+
+    Keys are loaded lazily for the date spans requested, so a date already
+    covered is never queried twice.
+
+    """
+
+    def __init__(self, book, account):
+        super(DuplicateIndex, self).__init__()
+        self.book = book
         self.account = account
-        self.config = self.account.parser_config
+        self.keys = set()
+        self.start = self.end = None
+
+    @staticmethod
+    def key(data):
+        when = data["when"]
+        if isinstance(when, datetime):
+            when = when.date()
+        return (
+            data["account"],
+            when,
+            data["what"],
+            data["amount"],
+            data["is_income"],
+        )
+
+    def _load(self, start, end):
+        entries = Entry.objects.filter(
+            book=self.book, account=self.account, when__range=(start, end)
+        )
+        self.keys.update(
+            entries.values_list(
+                "account_id", "when", "what", "amount", "is_income"
+            )
+        )
+
+    def load(self, chunk):
+        """Make sure the keys for the dates in `chunk` are loaded."""
+        dates = [self.key(data)[1] for data in chunk]
+        start, end = min(dates), max(dates)
+        if self.start is None:
+            self._load(start, end)
+            self.start, self.end = start, end
+            return
+        if start < self.start:
+            self._load(start, self.start - timedelta(days=1))
+            self.start = start
+        if end > self.end:
+            self._load(self.end + timedelta(days=1), end)
+            self.end = end
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def add(self, key):
+        self.keys.add(key)
+
+
+class KnownRows(object):
+    """The rows imported before for an account in a book, by their hash.
+
+    Rows are recorded with the entry made from them (see `ImportedRow`), and
+    only the hashes of the rows being imported are ever looked up.
+
+    """
+
+    def __init__(self, book, account):
+        super(KnownRows, self).__init__()
+        self.book = book
+        self.account = account
+
+    def find(self, hashes):
+        """Return the set of `hashes` of rows imported before."""
+        rows = ImportedRow.objects.filter(
+            account=self.account,
+            parser_config=self.account.parser_config,
+            entry__book=self.book,
+        )
+        found = set()
+        hashes = iter(hashes)
+        for batch in iter(lambda: list(islice(hashes, KNOWN_ROWS_BATCH)), []):
+            found.update(
+                rows.filter(hash__in=batch).values_list("hash", flat=True)
+            )
+        return found
+
+    def record(self, imported):
+        """Record the rows of `imported`, a sequence of (hashes, entry)."""
+        ImportedRow.objects.bulk_create(
+            ImportedRow(
+                account=self.account,
+                parser_config=self.account.parser_config,
+                entry=entry,
+                hash=row_hash,
+            )
+            for hashes, entry in imported
+            for row_hash in hashes
+        )
+
+
+class RowDecoder(object):
+    """Decode CSV rows as described by a ParserConfig.
+
+    Everything that only depends on the config (the separators translation
+    table, the date parser and the column indexes) is computed once, when
+    the decoder is built.
+
+    """
+
+    NOT_NUMBER = re.compile(r"[^\d\-.]")
+    ISO_DATE = "%Y-%m-%d"
+    NUMERIC_DATE = re.compile(r"%([dmY])(\W)%([dmY])\2%([dmY])")
+
+    def __init__(self, config):
+        super(RowDecoder, self).__init__()
+        self.config = config
+        separators = {}
+        if len(config.thousands_sep) == 1:
+            separators[config.thousands_sep] = None
+        if config.decimal_point != ".":
+            separators[config.decimal_point] = "."
+        self.separators = str.maketrans(separators)
+        self.amount_columns = tuple(config.amount)
+        self.what_columns = tuple(config.what)
+        self.notes_columns = tuple(config.notes)
+        self.when_columns = tuple(config.when)
+        self.defer_processing = frozenset(config.defer_processing)
+        self.parse_date = self._make_date_parser(config.date_format)
 
-    def _parse_amount(self, row, i):
+    def _make_date_parser(self, date_format):
+        def strptime(value):
+            return datetime.strptime(value, date_format)
+
+        if date_format == self.ISO_DATE:
+
+            def parse_iso(value):
+                if len(value) == 10 and value[4] == value[7] == "-":
+                    try:
+                        return datetime.fromisoformat(value)
+                    except ValueError:
+                        pass
+                return strptime(value)
+
+            return parse_iso
+
+        match = self.NUMERIC_DATE.fullmatch(date_format)
+        if match is None:
+            return strptime
+        order = match.group(1, 3, 4)
+        if sorted(order) != ["Y", "d", "m"]:
+            return strptime
+        digits = {"d": "([0-9]{1,2})", "m": "([0-9]{1,2})", "Y": "([0-9]{4})"}
+        pattern = re.compile(
+            re.escape(match.group(2)).join(digits[i] for i in order)
+        )
+        year, month, day = (order.index(i) + 1 for i in "Ymd")
+
+        def parse_numeric(value):
+            found = pattern.fullmatch(value)
+            if found is not None:
+                try:
+                    return datetime(
+                        int(found[year]), int(found[month]), int(found[day])
+                    )
+                except ValueError:
+                    pass
+            return strptime(value)
+
+        return parse_numeric
+
+    def parse_amount(self, row, i):
         result = "0"
         value = row[i]
         if value:
-            value = value.replace(self.config.thousands_sep, "")
-            if self.config.decimal_point != ".":
-                value = value.replace(self.config.decimal_point, ".")
-            result = re.sub(r"[^\d\-.]", "", value)
+            value = value.translate(self.separators)
+            result = self.NOT_NUMBER.sub("", value)
 
         try:
             result = Decimal(result)
@@ -49,30 +444,54 @@ class CSVParser(object):
 
         return result
 
+    def concat_columns(self, row, indexes, extra=None):
+        result = [v for v in (row[i].strip() for i in indexes) if v]
+        if extra:
+            result.append(extra)
+        return " | ".join(result)
+
+
+class CSVParser(object):
+    def __init__(self, account):
+        super(CSVParser, self).__init__()
+        self.account = account
+        self.config = self.account.parser_config
+        self.decoder = RowDecoder(self.config)
+        self.stats = ImportStats()
+        self.validator = None
+        self.suggester = None
+        self.name = None
+
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, value):
+        self._name = value
+        self.source = "source: %r" % value
+
     def find_amount(self, row):
-        if len(self.config.amount) == 1:
-            result = self._parse_amount(row, self.config.amount[0])
+        columns = self.decoder.amount_columns
+        if len(columns) == 1:
+            result = self.decoder.parse_amount(row, columns[0])
         else:
-            assert len(self.config.amount) == 2, (
+            assert len(columns) == 2, (
                 "Config amount can not be bigger than 2 elements (got %r)."
                 % self.config.amount
             )
-            expense = self._parse_amount(row, self.config.amount[0])
-            income = self._parse_amount(row, self.config.amount[1])
+            expense = self.decoder.parse_amount(row, columns[0])
+            income = self.decoder.parse_amount(row, columns[1])
             result = income - abs(expense)
         return result
 
-    def _concat_columns(self, row, indexes, extra=None):
-        result = [row[i].strip() for i in indexes if row[i].strip()]
-        return " | ".join(result + (extra or []))
-
     def find_notes(self, row):
-        return self._concat_columns(
-            row, self.config.notes, ["source: %r" % self.name]
+        return self.decoder.concat_columns(
+            row, self.decoder.notes_columns, self.source
         )
 
     def find_what(self, row):
-        result = self._concat_columns(row, self.config.what)
+        result = self.decoder.concat_columns(row, self.decoder.what_columns)
         assert result, "What not found (tried %r): %r" % (
             self.config.what,
             row,
@@ -81,10 +500,10 @@ class CSVParser(object):
 
     def find_when(self, row):
         result = None
-        for i in self.config.when:
+        for i in self.decoder.when_columns:
             result = row[i]
             if result:
-                result = datetime.strptime(result, self.config.date_format)
+                result = self.decoder.parse_date(result)
                 break
         assert result, "When not found (tried %r): %r" % (
             self.config.when,
@@ -92,15 +511,34 @@ class CSVParser(object):
         )
         return result
 
-    def make_data(self, row, user, unprocessed=None):
-        assert row, "The given row %r is empty" % row
-        amount = self.find_amount(row)
-        what = self.find_what(row)
+    def get_suggester(self):
+        # Tags are suggested for many rows, so read every count at once.
+        if self.suggester is None:
+            self.suggester = self.account.tag_suggester(preload=True)
+        return self.suggester
+
+    def find_tags(self, what):
+        """Return the tags for `what`, and its asset if any.
 
-        tags_dict = self.account.tags_for(what)
+        If no tag rule matches `what`, and the account suggests tags, those
+        learned from its previous entries are used (see TagSuggester).
+
+        """
+        with self.stats.measure("tagging"):
+            tags_dict = self.account.tags_for(what)
+            if not tags_dict and self.account.suggest_tags:
+                tags, asset = self.get_suggester().suggest(what)
+                return tags or [settings.ENTRY_DEFAULT_TAG], asset
         tags = list(tags_dict.keys()) or [settings.ENTRY_DEFAULT_TAG]
         assets = {t[1] for t in tags_dict.values() if t[1] is not None}
         assert len(assets) < 2, f"{tags_dict=} produce confusing asset list."
+        return tags, None if not assets else assets.pop()
+
+    def make_data(self, row, user, unprocessed=None):
+        assert row, "The given row %r is empty" % row
+        amount = self.find_amount(row)
+        what = self.find_what(row)
+        tags, asset = self.find_tags(what)
 
         data = dict(
             account=self.account.id,
@@ -112,62 +550,209 @@ class CSVParser(object):
             what=what,
             when=self.find_when(row),
             who=user.id,
-            asset=None if not assets else assets.pop(),
+            asset=asset,
         )
 
-        if what in self.config.defer_processing:
+        if what in self.decoder.defer_processing:
             raise DataToBeProcessedError(data)
 
         if unprocessed:
-            assert unprocessed["is_income"] == data["is_income"]
-            assert unprocessed["when"] == data["when"]
-            amount = unprocessed["amount"]
-            data["notes"] = "%s + %s %s" % (
-                data["amount"],
-                unprocessed["what"],
-                amount,
-            )
-            data["amount"] += amount
+            self.merge_unprocessed(data, unprocessed)
 
         return data
 
-    def _validate_and_save_entry(self, data, book, dry_run=False):
-        form = EntryForm(book=book, data=data)
-        if form.is_valid():
-            if dry_run:
-                entry = data
-            else:
-                entry = form.save()
-        logger.debug(
-            "CSVParser._validate_and_save_entry dry_run: %r data: %r "
-            "form is valid: %r form.errors: %r",
-            dry_run,
-            data,
-            form.is_valid(),
-            form.errors,
+    def merge_unprocessed(self, data, unprocessed):
+        """Add the `unprocessed` data of a deferred row to the next `data`."""
+        assert unprocessed["is_income"] == data["is_income"]
+        assert unprocessed["when"] == data["when"]
+        amount = unprocessed["amount"]
+        data["notes"] = "%s + %s %s" % (
+            data["amount"],
+            unprocessed["what"],
+            amount,
         )
-        if form.errors:
+        data["amount"] += amount
+
+    def _raise_for_errors(self, errors):
+        if errors:
             msg = " | ".join(
-                "%s: %s" % (k, ", ".join(v)) for k, v in form.errors.items()
+                "%s: %s" % (k, ", ".join(v)) for k, v in errors.items()
             )
             raise ValueError(msg)
+
+    def get_validator(self, book):
+        """Return the EntryValidator for `book`, reused across rows."""
+        if self.validator is None or self.validator.book != book:
+            self.validator = EntryValidator(book)
+        return self.validator
+
+    def _validate_and_save_entry(self, data, book, dry_run=False):
+        entry = self._validate_entry(data, book)
+        if dry_run:
+            return data
+
+        with self.stats.measure("save"):
+            try:
+                with transaction.atomic():
+                    entry.save(force_insert=True)
+            except IntegrityError:
+                logger.debug(
+                    "CSVParser._validate_and_save_entry duplicated data: %r",
+                    data,
+                )
+                self._raise_for_errors(
+                    {"__all__": [EntryForm.DUPLICATED_ENTRY_ERROR]}
+                )
+        return entry
+
+    def _validate_entry(self, data, book):
+        with self.stats.measure("validation"):
+            entry, errors = self.get_validator(book).validate(data)
+        logger.debug(
+            "CSVParser._validate_entry data: %r errors: %r", data, errors
+        )
+        self._raise_for_errors(errors)
         return entry
 
     @transaction.atomic
     def make_entry(self, data, book, dry_run=False):
-        tags = self.account.tags_for(data["what"])
-
         entry = self._validate_and_save_entry(data, book, dry_run=dry_run)
 
-        # Needs a transfer?
-        tags = self.account.tags_for(data["what"])
+        # Needs a transfer? The rules were already counted by `find_tags`.
+        with self.stats.measure("tagging"):
+            tags = self.account.tags_for(data["what"], stats=False)
         for transfer in [t[0] for t in tags.values() if t[0] is not None]:
-            data["is_income"] = not data["is_income"]
-            data["account"] = transfer.id
-            self._validate_and_save_entry(data, book, dry_run=dry_run)
+            with self.stats.measure("transfers"):
+                data["is_income"] = not data["is_income"]
+                data["account"] = transfer.id
+                self._validate_and_save_entry(data, book, dry_run=dry_run)
 
         return entry
 
+    def build_entries(self, data, book):
+        """Validate `data` and its transfer mirrors without saving them.
+
+        Return the list of unsaved `Entry` instances for the given row, the
+        first one being the entry for this parser's account.
+
+        """
+        entries = [self._validate_entry(data, book)]
+
+        # Needs a transfer? The rules were already counted by `find_tags`.
+        with self.stats.measure("tagging"):
+            tags = self.account.tags_for(data["what"], stats=False)
+        mirror = data
+        for transfer in [t[0] for t in tags.values() if t[0] is not None]:
+            with self.stats.measure("transfers"):
+                mirror = dict(
+                    mirror,
+                    is_income=not mirror["is_income"],
+                    account=transfer.id,
+                )
+                entries.append(self._validate_entry(mirror, book))
+
+        return entries
+
+    def make_entries(
+        self, chunk, book, result, dry_run=False, batch_size=None
+    ):
+        """Validate and save a chunk of rows using a single transaction.
+
+        Entries are saved with a single INSERT, or with one INSERT per
+        `batch_size` entries if given. Each item in `chunk` is the data for
+        one row. Rows that fail validation, or that would duplicate an
+        existing entry, are reported in `result["errors"]` just like
+        `make_entry` failures are.
+
+        """
+        rows = []
+        for data in chunk:
+            try:
+                rows.append((data, self.build_entries(data, book)))
+            except Exception as e:
+                self.add_error(result, e, data)
+
+        if dry_run:
+            for data, entries in rows:
+                self.add_entry(result, data, data)
+            return
+
+        new = [e for data, entries in rows for e in entries]
+        try:
+            with self.stats.measure("save", count=len(new)):
+                Entry.objects.bulk_create(new, batch_size=batch_size)
+        except IntegrityError:
+            # At least one row is a duplicate, fall back to saving row by row
+            # so the offending rows can be reported individually.
+            logger.debug(
+                "CSVParser.make_entries chunk of %i rows has duplicates, "
+                "saving one row at a time",
+                len(rows),
+            )
+            self._save_rows(rows, result)
+        else:
+            for data, entries in rows:
+                self.add_entry(result, entries[0], data)
+
+    def _save_rows(self, rows, result):
+        error = ValueError("__all__: %s" % EntryForm.DUPLICATED_ENTRY_ERROR)
+        for data, entries in rows:
+            try:
+                with self.stats.measure("save", count=len(entries)):
+                    with transaction.atomic():
+                        for entry in entries:
+                            entry.pk = None
+                            entry.save(force_insert=True)
+            except IntegrityError:
+                self.add_error(result, error, data)
+            else:
+                self.add_entry(result, entries[0], data)
+
+    def process_chunk(
+        self, chunk, book, result, known, dry_run=False, batch_size=None
+    ):
+        """Skip known duplicates in `chunk` and create entries for the rest.
+
+        `known` is the DuplicateIndex for this import. Rows already in it
+        are counted in `result["skipped"]` without being validated.
+
+        """
+        rows = []
+        with self.stats.measure("duplicates", count=len(chunk)):
+            known.load(chunk)
+            for data in chunk:
+                key = known.key(data)
+                if key in known:
+                    result["skipped"] += 1
+                    continue
+                known.add(key)
+                rows.append(data)
+
+        if batch_size:
+            self.make_entries(
+                rows, book, result, dry_run=dry_run, batch_size=batch_size
+            )
+            return
+
+        for data in rows:
+            try:
+                entry = self.make_entry(data, book=book, dry_run=dry_run)
+            except Exception as e:
+                self.add_error(result, e, data)
+            else:
+                assert entry is not None, "Entry should not be None"
+                self.add_entry(result, entry, data)
+
+    def add_entry(self, result, entry, data):
+        """Report the `entry` made from `data` (`data` itself on dry runs)."""
+        result["entry_count"] += 1
+        if self.on_entry is None:
+            result["entries"].append(entry)
+        else:
+            self.on_entry(entry)
+        if self.imported is not None:
+            self.imported.append((data, entry))
+
     def add_error(self, result, error, data):
         error = {
             "exception": error.__class__.__name__,
@@ -176,19 +761,53 @@ class CSVParser(object):
         }
         result["errors"].append(error)
 
-    def parse(self, fileobj, book, user, dry_run=False):
-        self.name = getattr(fileobj, "name", "stream with no name")
-        result = dict(entries=[], errors=[])
+    def row_hash(self, row):
+        """Return a short digest of the raw `row`, as read from the file."""
+        value = "\x1f".join(row).encode("utf-8", "surrogatepass")
+        return hashlib.blake2b(value, digest_size=16).hexdigest()
+
+    def process_rows(
+        self, chunk, book, result, known, dry_run, batch_size, row_hashes
+    ):
+        """Process `chunk` recording the rows of its imported data.
+
+        `row_hashes` maps each data in `chunk` (by id) to the hashes of the
+        rows it was built from, recorded in `self.known_rows` along with the
+        entry made from the data. Data that ends up in `result["errors"]`, or
+        skipped as a duplicate, is not recorded, so its rows are processed
+        again the next time they are imported.
 
+        """
+        recorded = self.known_rows is not None and not dry_run
+        self.imported = [] if recorded else None
+        self.process_chunk(chunk, book, result, known, dry_run, batch_size)
+        if recorded:
+            self.known_rows.record(
+                (row_hashes[id(data)], entry) for data, entry in self.imported
+            )
+
+    def read_rows(self, fileobj, ignore_rows=0):
+        """Yield the rows of the text `fileobj` that are not empty.
+
+        The first `ignore_rows` rows are left out, empty or not.
+
+        """
         delimiter = codecs.decode(self.config.delimiter, "unicode_escape")
         reader = csv.reader(fileobj, delimiter=delimiter)
         ignored = 0
-        unprocessed = None
-        for row in reader:
+        while True:
+            start = time.perf_counter()
+            row = next(reader, None)
+            self.stats.add(
+                "decode", time.perf_counter() - start, int(row is not None)
+            )
+            if row is None:
+                return
+
             # ignore initial rows
-            if ignored < self.config.ignore_rows:
+            if ignored < ignore_rows:
                 logger.info(
-                    "CSVParser.parse ignoring row %i: %r", ignored, row
+                    "CSVParser.read_rows ignoring row %i: %r", ignored, row
                 )
                 ignored += 1
                 continue
@@ -196,30 +815,820 @@ class CSVParser(object):
             if not row or not any(row):
                 continue
 
+            yield row
+
+    def find_known_rows(self, rows, find_known):
+        """Yield each of `rows` with its hash, and whether it's known.
+
+        `find_known` is called with the hashes of KNOWN_ROWS_BATCH rows at a
+        time, and returns those of the rows that were imported before (see
+        `KnownRows.find`). If it's None, hashes are not even computed.
+
+        """
+        if find_known is None:
+            for row in rows:
+                yield row, None, False
+            return
+
+        rows = iter(rows)
+        for batch in iter(lambda: list(islice(rows, KNOWN_ROWS_BATCH)), []):
+            hashes = [self.row_hash(row) for row in batch]
+            with self.stats.measure("duplicates", count=0):
+                known = find_known(hashes)
+            for row, row_hash in zip(batch, hashes):
+                yield row, row_hash, row_hash in known
+
+    def decode_rows(self, rows, user, find_known=None):
+        """Yield a (kind, row, value, row hash) tuple for each of `rows`.
+
+        The kind is SKIPPED for rows imported before (with no value), DATA or
+        DEFERRED for the data made from the row (see `make_data`), or ERROR
+        for the exception raised while making it. Row hashes are only
+        computed, and checked, if `find_known` is given (see
+        `find_known_rows`).
+
+        Each row is decoded on its own: deferred data is merged into the
+        data of the following row by `parse`.
+
+        """
+        for row, row_hash, known in self.find_known_rows(rows, find_known):
+            if known:
+                yield SKIPPED, row, None, row_hash
+                continue
+
             try:
-                data = self.make_data(
-                    row=row, user=user, unprocessed=unprocessed
-                )
+                with self.stats.measure("make_data"):
+                    data = self.make_data(row=row, user=user)
             except DataToBeProcessedError as e:
-                assert (
-                    unprocessed is None
-                ), f"Unprocessed data should be None, got {unprocessed=}"
-                unprocessed = e.data
-                continue
+                yield DEFERRED, row, e.data, row_hash
             except Exception as e:
-                self.add_error(result, e, row)
-                continue
+                yield ERROR, row, e, row_hash
+            else:
+                yield DATA, row, data, row_hash
+
+    def map_file(self, fileobj):
+        """Return a read only memory map of the file under the text `fileobj`.
+
+        Return None if `fileobj` is not a regular (uncompressed) file, or if
+        its encoding does not keep newlines and quotes as single bytes, since
+        those bytes are used to find where rows end.
 
-            if not data:
+        """
+        buffer = getattr(fileobj, "buffer", None)
+        if not isinstance(buffer, MAPPABLE_FILES):
+            return None
+        try:
+            if b'\n"'.decode(fileobj.encoding) != '\n"':
                 return None
+            return mmap.mmap(buffer.fileno(), 0, access=mmap.ACCESS_READ)
+        except (LookupError, OSError, UnicodeDecodeError, ValueError):
+            # Unknown encodings, and empty files, can not be mapped.
+            return None
 
-            unprocessed = None
-            try:
-                entry = self.make_entry(data, book=book, dry_run=dry_run)
-            except Exception as e:
-                self.add_error(result, e, data)
-            else:
-                assert entry is not None, "Entry should not be None"
-                result["entries"].append(entry)
+    def scan_split(self, fileobj, data, spans, hashed):
+        """Read the rows of the mapped `data` once, checking its `spans`.
+
+        Spans are found by counting quotes (see `split_rows`), which a stray
+        quote in an unquoted field throws off. Return whether every span
+        starts where `csv.reader` starts a row, and the hashes of the rows
+        if `hashed` is set (see `row_hash`).
+
+        """
+        position = spans[0][0]
+
+        def lines():
+            # Rows are read one line at a time, so once a row is read,
+            # `position` is where it ends.
+            nonlocal position
+            while position < len(data):
+                end = data.find(b"\n", position) + 1 or len(data)
+                line = data[position:end]
+                position = end
+                yield line.decode(fileobj.encoding, fileobj.errors)
+
+        delimiter = codecs.decode(self.config.delimiter, "unicode_escape")
+        starts = [start for start, end in spans[1:]]
+        hashes = []
+        for row in csv.reader(lines(), delimiter=delimiter):
+            if hashed:
+                hashes.append(self.row_hash(row))
+            if starts and position >= starts[0]:
+                if position > starts[0]:
+                    return False, None
+                starts.pop(0)
+        return True, hashes
+
+    def decode_split(self, fileobj, data, spans, user, find_known, jobs):
+        """Decode the `spans` of the mapped `data` in `jobs` processes.
+
+        Yield the list of decoded rows (see `decode_rows`) of each span, in
+        order, as soon as it's available.
+
+        """
+        # Workers are forked: they share the mapped file, the compiled tag
+        # rules, the tag suggestions and the rows imported before (see
+        # `scan_split`), and they must not use the database.
+        self.account.tag_matcher()
+        if self.account.suggest_tags:
+            self.get_suggester()
+        # Make sure workers do not share the connections either. Those in a
+        # transaction can not be closed without breaking it.
+        if not any(c.in_atomic_block for c in connections.all()):
+            connections.close_all()
+        context = multiprocessing.get_context("fork")
+        initargs = (
+            self,
+            data,
+            fileobj.encoding,
+            fileobj.errors,
+            user,
+            find_known,
+        )
+        with ProcessPoolExecutor(
+            max_workers=min(jobs, len(spans)),
+            mp_context=context,
+            initializer=_init_chunk_worker,
+            initargs=initargs,
+        ) as executor:
+            for decoded, stages, rule_stats in executor.map(
+                _decode_chunk, *zip(*spans)
+            ):
+                self.stats.update(stages)
+                self.account.tag_matcher().add_stats(rule_stats)
+                yield decoded
+
+    def merge_rows(self, batches, result, hashed, progress=None):
+        """Yield each data, and the hashes of its rows, in the decoded rows.
+
+        `batches` is a sequence of decoded rows (see `decode_rows`). Rows are
+        counted in `result`, and rows that failed to decode are reported in
+        `result["errors"]`. Deferred data is added to the following data, so
+        this works across batches. If `progress` is given, it's called with
+        `result` after each batch.
+
+        Row hashes are only returned if `hashed` is set. Hashes of rows that
+        failed to decode are dropped, along with the deferred ones before.
+
+        """
+        unprocessed = None
+        pending = []
+        for decoded in batches:
+            for kind, row, value, row_hash in decoded:
+                result["rows"] += 1
+                if kind == SKIPPED:
+                    result["skipped"] += 1
+                    continue
+                if hashed:
+                    pending.append(row_hash)
+
+                if kind == DEFERRED:
+                    assert (
+                        unprocessed is None
+                    ), f"Unprocessed data should be None, got {unprocessed=}"
+                    unprocessed = value
+                    continue
+                if kind == DATA and unprocessed:
+                    try:
+                        self.merge_unprocessed(value, unprocessed)
+                    except Exception as e:
+                        kind, value = ERROR, e
+                if kind == ERROR:
+                    self.add_error(result, value, row)
+                    pending = []
+                    continue
+
+                unprocessed = None
+                yield value, pending
+                pending = []
+
+            if progress is not None:
+                progress(result)
+
+    def parse(
+        self,
+        fileobj,
+        book,
+        user,
+        dry_run=False,
+        batch_size=None,
+        progress=None,
+        known_rows=None,
+        jobs=None,
+        on_entry=None,
+    ):
+        """Parse `fileobj` and create the corresponding entries in `book`.
+
+        If `batch_size` is given, rows are validated and saved in chunks of
+        that many rows, each chunk using one transaction and one INSERT.
+        Otherwise every row is saved in its own transaction.
+
+        If `jobs` is bigger than 1 and `fileobj` is a regular file of at
+        least two MIN_CHUNK_SIZE chunks, it's split in chunks of whole rows
+        that are decoded and tagged by a pool of `jobs` processes. Results
+        are merged in the file order, and every entry is then saved in a
+        single transaction, with one INSERT per `batch_size` (or BATCH_SIZE)
+        entries.
+
+        New entries (their data on `dry_run`) are returned in
+        `result["entries"]` and counted in `result["entry_count"]`. If
+        `on_entry` is given, it's called with each new entry as soon as it's
+        made instead, and only the count is kept.
+
+        Rows matching an existing entry (or a previous row) are not saved
+        again, they are only counted in `result["skipped"]`.
+
+        If `known_rows` is given, it's the KnownRows of `book` and the
+        account. Rows imported before are skipped before being decoded, and
+        the rows imported by this parse are recorded in it.
+
+        If `progress` is given, it's called with the partial result after
+        each chunk is processed, and once more with the final result.
+
+        The time spent and the amount of items processed by each stage of
+        the import (see `ImportStats`) are returned in `result["stages"]`.
+
+        """
+        self.name = getattr(fileobj, "name", "stream with no name")
+        self.stats = ImportStats()
+        self.validator = None
+        self.known_rows = known_rows
+        self.on_entry = on_entry
+        self.imported = None
+        result = dict(entries=[], entry_count=0, errors=[], rows=0, skipped=0)
+        known = DuplicateIndex(book, self.account)
+        chunk = []
+        # The hashes of the rows for each data in the current chunk.
+        row_hashes = {}
+
+        mapped = spans = None
+        if jobs is not None and jobs > 1:
+            mapped = self.map_file(fileobj)
+        if mapped is not None:
+            parts = min(jobs, len(mapped) // MIN_CHUNK_SIZE)
+            spans = split_rows(mapped, max(parts, 1), self.config.ignore_rows)
+        find_known = None if known_rows is None else known_rows.find
+        if spans is not None and len(spans) > 1:
+            with self.stats.measure("decode", count=0):
+                aligned, hashes = self.scan_split(
+                    fileobj, mapped, spans, hashed=find_known is not None
+                )
+            if not aligned:
+                logger.warning(
+                    "CSVParser.parse can not split %r in chunks of whole "
+                    "rows, parsing it in a single process",
+                    self.name,
+                )
+                spans = None
+        if spans is not None and len(spans) > 1:
+            if find_known is not None:
+                # Workers share the rows imported before, found here.
+                with self.stats.measure("duplicates", count=0):
+                    find_known = frozenset(find_known(hashes)).intersection
+            logger.debug(
+                "CSVParser.parse splitting %r in %i chunks",
+                self.name,
+                len(spans),
+            )
+            batches = self.decode_split(
+                fileobj, mapped, spans, user, find_known, jobs
+            )
+            # Everything is saved at once, once all the chunks are merged.
+            limit = None
+            batch_size = batch_size or BATCH_SIZE
+        else:
+            rows = self.read_rows(fileobj, self.config.ignore_rows)
+            batches = [self.decode_rows(rows, user, find_known)]
+            limit = batch_size or BATCH_SIZE
+
+        merged = self.merge_rows(
+            batches,
+            result,
+            hashed=known_rows is not None,
+            progress=progress if limit is None else None,
+        )
+        try:
+            for data, hashes in merged:
+                if not data:
+                    return None
+
+                chunk.append(data)
+                row_hashes[id(data)] = hashes
+                if limit is not None and len(chunk) >= limit:
+                    self.process_rows(
+                        chunk,
+                        book,
+                        result,
+                        known,
+                        dry_run,
+                        batch_size,
+                        row_hashes,
+                    )
+                    chunk = []
+                    row_hashes = {}
+                    if progress is not None:
+                        progress(result)
+        finally:
+            if mapped is not None:
+                mapped.close()
+
+        if chunk:
+            self.process_rows(
+                chunk, book, result, known, dry_run, batch_size, row_hashes
+            )
+        result["stages"] = self.stats.as_dict()
+        flush_tag_rule_stats()
+        logger.debug(
+            "CSVParser.parse stages for %r: %s",
+            self.name,
+            format_stages(result["stages"]),
+        )
+        if progress is not None:
+            progress(result)
 
         return result
+
+
+class StagingCSVParser(CSVParser):
+    """A CSVParser merging each chunk of rows into the entries in SQL.
+
+    The decoded rows, tagged as `CSVParser` does, are COPYed into a temporary
+    staging table, where they are mirrored to their transfer accounts.
+    Entries are then added with INSERT ... ON CONFLICT DO NOTHING, so
+    duplicates are found by the entries unique constraint. The result is the
+    same as `CSVParser` gives: accepted rows are in `result["entries"]`,
+    duplicated rows are counted in `result["skipped"]` and failed rows are in
+    `result["errors"]`.
+
+    Only what changes from row to row is validated in Python. The user,
+    account and country of the entries are validated once per chunk.
+
+    """
+
+    STAGING_TABLE = "gemcore_entry_staging"
+    CANDIDATES_TABLE = "gemcore_entry_candidates"
+    STAGING_COLUMNS = (
+        "position",
+        "when",
+        "what",
+        "amount",
+        "is_income",
+        "notes",
+        "tags",
+        "asset_id",
+        "transfers",
+    )
+    CREATE_STAGING = """
+        CREATE TEMPORARY TABLE gemcore_entry_staging (
+            position integer PRIMARY KEY,
+            "when" date NOT NULL,
+            what text NOT NULL,
+            amount numeric(12, 2) NOT NULL,
+            is_income boolean NOT NULL,
+            notes text NOT NULL,
+            tags varchar(256)[] NOT NULL,
+            asset_id integer,
+            transfers integer[] NOT NULL
+        ) ON COMMIT DROP
+    """
+    # One candidate entry per staged row (n = 0) and per transfer (n > 0).
+    # Each transfer mirrors the previous entry, flipping is_income.
+    CREATE_CANDIDATES = """
+        CREATE TEMPORARY TABLE gemcore_entry_candidates ON COMMIT DROP AS
+        SELECT
+            s.position,
+            m.n,
+            m.account_id,
+            s."when",
+            s.what,
+            s.amount,
+            s.is_income <> (m.n %% 2 = 1) AS is_income,
+            s.notes,
+            s.tags,
+            s.asset_id,
+            CASE
+                WHEN s.asset_id IS NOT NULL
+                    AND s.asset_id <> ALL(%(assets)s) THEN
+                    'asset: ' || %(invalid_choice)s
+                WHEN m.account_id <> ALL(%(accounts)s) THEN
+                    'account: ' || %(invalid_choice)s
+            END AS error
+        FROM gemcore_entry_staging s
+        CROSS JOIN LATERAL (
+            SELECT %(account)s AS account_id, 0::bigint AS n
+            UNION ALL
+            SELECT * FROM unnest(s.transfers) WITH ORDINALITY
+        ) m (account_id, n)
+    """
+    SELECT_CANDIDATES = """
+        SELECT
+            c.position,
+            c.n,
+            c.error,
+            EXISTS (
+                SELECT 1
+                FROM gemcore_entry e
+                WHERE e.book_id = %(book)s
+                    AND e.account_id = c.account_id
+                    AND e."when" = c."when"
+                    AND e.what = c.what
+                    AND e.amount = c.amount
+                    AND e.is_income = c.is_income
+            ) AS existing
+        FROM gemcore_entry_candidates c
+        ORDER BY c.position, c.n
+    """
+    INSERT_ENTRIES = """
+        INSERT INTO gemcore_entry (
+            book_id, who_id, "when", what, account_id, asset_id, amount,
+            is_income, tags, country, notes
+        )
+        SELECT
+            %(book)s, %(who)s, "when", what, account_id, asset_id, amount,
+            is_income, tags, %(country)s, notes
+        FROM gemcore_entry_candidates
+        WHERE position = ANY(%(positions)s)
+        ORDER BY position, n
+        ON CONFLICT DO NOTHING
+        RETURNING
+            id, account_id, "when", what, amount, is_income, tags, asset_id
+    """
+
+    def __init__(self, account):
+        super(StagingCSVParser, self).__init__(account)
+        self.amount_field = Entry._meta.get_field("amount")
+        self.prohibit_null = ProhibitNullCharactersValidator()
+
+    def check_constants(self, book, data):
+        """Validate the values of `data` that are the same for every row."""
+        validator = self.get_validator(book)
+        errors = {}
+        for name, clean in (
+            ("who", validator.clean_related),
+            ("account", validator.clean_related),
+            ("country", validator.clean_choice),
+        ):
+            value = data[name]
+            try:
+                clean(name, value)
+            except ValidationError as e:
+                errors[name] = e.messages
+        return errors
+
+    def check_data(self, data):
+        """Validate the values of `data` that change from row to row."""
+        errors = {}
+        for name in ("what", "notes"):
+            try:
+                self.prohibit_null(data[name])
+            except ValidationError as e:
+                errors[name] = e.messages
+        try:
+            self.amount_field.run_validators(data["amount"])
+        except ValidationError as e:
+            errors["amount"] = e.messages
+        return errors
+
+    def stage(self, cursor, chunk):
+        cursor.execute("DROP TABLE IF EXISTS %s" % self.STAGING_TABLE)
+        cursor.execute("DROP TABLE IF EXISTS %s" % self.CANDIDATES_TABLE)
+        cursor.execute(self.CREATE_STAGING)
+        columns = ", ".join('"%s"' % c for c in self.STAGING_COLUMNS)
+        with cursor.copy(
+            "COPY %s (%s) FROM STDIN" % (self.STAGING_TABLE, columns)
+        ) as copy:
+            for position, data in chunk:
+                when = data["when"]
+                if isinstance(when, datetime):
+                    when = when.date()
+                # Rows were tagged by `find_tags`, only transfers are left.
+                with self.stats.measure("transfers"):
+                    tags = self.account.tags_for(data["what"], stats=False)
+                    transfers = [
+                        t[0].id for t in tags.values() if t[0] is not None
+                    ]
+                copy.write_row(
+                    (
+                        position,
+                        when,
+                        data["what"],
+                        data["amount"],
+                        data["is_income"],
+                        data["notes"],
+                        data["tags"],
+                        data["asset"],
+                        transfers,
+                    )
+                )
+
+    def merge(self, chunk, book, result, known, dry_run):
+        """Stage the valid rows in `chunk` and merge them into the entries.
+
+        Return the (data, entry) pairs for the accepted rows, the entry being
+        None on `dry_run`.
+
+        """
+        validator = self.get_validator(book)
+        invalid_choice = str(
+            validator.fields["account"].error_messages["invalid_choice"]
+        )
+        params = dict(
+            account=self.account.id,
+            accounts=list(validator.objects["account"]),
+            assets=list(validator.objects["asset"]),
+            book=book.id,
+            country=self.config.country,
+            invalid_choice=invalid_choice,
+            who=chunk[0][1]["who"],
+        )
+        duplicated = ValueError(
+            "__all__: %s" % EntryForm.DUPLICATED_ENTRY_ERROR
+        )
+        accepted = {}
+        with connection.cursor() as cursor:
+            self.stage(cursor, chunk)
+            cursor.execute(self.CREATE_CANDIDATES, params)
+            cursor.execute(self.SELECT_CANDIDATES, params)
+            candidates = {}
+            for position, n, error, existing in cursor:
+                candidates.setdefault(position, []).append((error, existing))
+
+            for position, data in chunk:
+                error, existing = candidates[position][0]
+                key = known.key(data)
+                if existing or key in known:
+                    result["skipped"] += 1
+                    continue
+                known.add(key)
+                mirrors = candidates[position][1:]
+                error = error or next((m[0] for m in mirrors if m[0]), None)
+                if error:
+                    self.add_error(result, ValueError(error), data)
+                elif any(m[1] for m in mirrors):
+                    self.add_error(result, duplicated, data)
+                else:
+                    accepted[position] = data
+
+            params["positions"] = list(accepted)
+            cursor.execute(self.INSERT_ENTRIES, params)
+            inserted = cursor.fetchall()
+            ids = {row[1:6]: row[0] for row in inserted}
+            count_tokens(
+                added=[(row[1], row[3], *row[6:]) for row in inserted]
+            )
+            count_rollups(
+                added=[
+                    (book.id, row[1], row[7], row[2], row[5], row[4])
+                    for row in inserted
+                ]
+            )
+            touch_books([book.id])
+
+        merged = []
+        for data in accepted.values():
+            pk = ids.get(known.key(data))
+            if pk is None:
+                # Added by someone else since the candidates were checked.
+                result["skipped"] += 1
+                continue
+            entry = None
+            if not dry_run:
+                entry = Entry(pk=pk, book=book, **self.entry_fields(data))
+            merged.append((data, entry))
+        return merged
+
+    def entry_fields(self, data):
+        return dict(
+            who_id=data["who"],
+            when=data["when"],
+            what=data["what"],
+            account_id=data["account"],
+            asset_id=data["asset"],
+            amount=data["amount"],
+            is_income=data["is_income"],
+            tags=data["tags"],
+            country=data["country"],
+            notes=data["notes"],
+        )
+
+    def process_chunk(
+        self, chunk, book, result, known, dry_run=False, batch_size=None
+    ):
+        """Validate `chunk` and merge it into the entries of `book`.
+
+        Nothing is saved on `dry_run`, though the rows are merged anyway
+        (and rolled back) to find their tags and duplicates.
+
+        """
+        with self.stats.measure("validation", count=len(chunk)):
+            errors = self.check_constants(book, chunk[0])
+            staged = []
+            for position, data in enumerate(chunk):
+                try:
+                    self._raise_for_errors({**errors, **self.check_data(data)})
+                except ValueError as e:
+                    self.add_error(result, e, data)
+                else:
+                    staged.append((position, data))
+        if not staged:
+            return
+
+        with self.stats.measure("save", count=len(staged)):
+            with transaction.atomic():
+                merged = self.merge(staged, book, result, known, dry_run)
+                if dry_run:
+                    transaction.set_rollback(True)
+        for data, entry in merged:
+            self.add_entry(result, data if dry_run else entry, data)
+
+
+# Parsers by the name of the import engine they implement.
+ENGINES = {"orm": CSVParser, "staging": StagingCSVParser}
+
+
+def _strip_extension(name, extension):
+    root, ext = os.path.splitext(name)
+    return root if ext.lower() == extension else name
+
+
+@contextmanager
+def _spooled(f):
+    """Copy the file `f` to a temporary file, and return it rewound.
+
+    The temporary file is kept in memory up to SPOOL_SIZE bytes.
+
+    """
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as spool:
+        shutil.copyfileobj(f, spool)
+        spool.seek(0)
+        yield spool
+
+
+def open_archive(binary, name):
+    """Yield a (name, binary) pair for each file in the seekable `binary`.
+
+    Gzip and bzip2 files are decompressed, and so is each member of a zip
+    file in turn, named after the archive and the member path. Formats are
+    detected by content, so any other file is yielded as is. Yielded files
+    are seekable: files are decompressed only once, to a temporary file (see
+    `_spooled`), since importing them reads them more than once.
+
+    """
+    magic = binary.read(10)
+    binary.seek(0)
+    if magic.startswith(GZIP_MAGIC):
+        with gzip.GzipFile(fileobj=binary, mode="rb") as f, _spooled(f) as s:
+            yield _strip_extension(name, ".gz"), s
+    elif BZIP2_MAGIC.match(magic):
+        with bz2.BZ2File(binary) as f, _spooled(f) as s:
+            yield _strip_extension(name, ".bz2"), s
+    elif magic.startswith(ZIP_MAGIC):
+        with zipfile.ZipFile(binary) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                with archive.open(info) as f, _spooled(f) as s:
+                    yield "%s/%s" % (name, info.filename), s
+    else:
+        yield name, binary
+
+
+def content_hash(binary, chunk_size=HASH_CHUNK_SIZE):
+    """Return the SHA-256 hex digest of the seekable `binary` file.
+
+    The file is read in chunks of `chunk_size` bytes and rewound afterwards.
+
+    """
+    digest = hashlib.sha256()
+    for data in iter(lambda: binary.read(chunk_size), b""):
+        digest.update(data)
+    binary.seek(0)
+    return digest.hexdigest()
+
+
+def import_file(
+    binary, name, account, book, user, dry_run=False, engine="orm", **kwargs
+):
+    """Import the seekable `binary` file into `book`, keeping an ImportRun.
+
+    If the very same content was already imported into `book` for `account`
+    and its parser config, the file is not parsed again: nothing is done and
+    `result["duplicate_of"]` is the original ImportRun, with its results.
+
+    Otherwise rows imported by any previous run are skipped without being
+    decoded, and (unless `dry_run`) a new ImportRun is recorded, available in
+    `result["import_run"]`. The file is parsed with the parser for `engine`
+    (see ENGINES), extra `kwargs` are passed to its `parse`.
+
+    """
+    digest = content_hash(binary)
+    runs = ImportRun.objects.filter(
+        book=book, account=account, parser_config=account.parser_config
+    )
+    previous = runs.filter(content_hash=digest).first()
+    if previous is not None:
+        logger.info(
+            "import_file %r is identical to %r, skipping it", name, previous
+        )
+        return dict(
+            entries=[],
+            entry_count=0,
+            errors=[],
+            rows=0,
+            skipped=0,
+            stages={},
+            duplicate_of=previous,
+            import_run=None,
+        )
+
+    stream = open_text_stream(binary, name=name)
+    try:
+        result = ENGINES[engine](account).parse(
+            stream,
+            book=book,
+            user=user,
+            dry_run=dry_run,
+            known_rows=KnownRows(book, account),
+            **kwargs,
+        )
+    finally:
+        # The binary file belongs to the caller, do not close it.
+        stream.detach()
+    result["duplicate_of"] = None
+    result["import_run"] = None
+    if not dry_run:
+        result["import_run"], _ = ImportRun.objects.get_or_create(
+            book=book,
+            account=account,
+            parser_config=account.parser_config,
+            content_hash=digest,
+            defaults=dict(
+                name=name,
+                rows=result["rows"],
+                entry_count=result["entry_count"],
+                skipped=result["skipped"],
+                error_count=len(result["errors"]),
+                errors=result["errors"],
+            ),
+        )
+    return result
+
+
+def run_import_job(job, batch_size=BATCH_SIZE):
+    """Parse the file of a claimed ImportJob, recording its progress.
+
+    The file is streamed from the storage, and may be compressed, or a zip
+    archive of many files, see `open_archive`. Results are added up for all
+    the files.
+
+    """
+    totals = dict(rows=0, entries=0, errors=[])
+    duplicates = []
+
+    def update_progress(result):
+        ImportJob.objects.filter(pk=job.pk).update(
+            rows=totals["rows"] + result["rows"],
+            entry_count=totals["entries"] + result["entry_count"],
+            error_count=len(totals["errors"]) + len(result["errors"]),
+            heartbeat=now(),
+        )
+
+    try:
+        with job.file.open("rb") as f:
+            for name, binary in open_archive(f, job.name):
+                result = import_file(
+                    binary,
+                    name=name,
+                    account=job.account,
+                    book=job.book,
+                    user=job.who,
+                    batch_size=batch_size,
+                    progress=update_progress,
+                    # Only the amount of entries is needed.
+                    on_entry=lambda entry: None,
+                )
+                totals["rows"] += result["rows"]
+                totals["entries"] += result["entry_count"]
+                totals["errors"].extend(result["errors"])
+                duplicates.append(result["duplicate_of"])
+    except Exception as e:
+        logger.exception("run_import_job failed for job %s", job.pk)
+        job.refresh_from_db(fields=["rows", "entry_count", "error_count"])
+        job.status = ImportJob.FAILED
+        job.errors.append(
+            {"exception": e.__class__.__name__, "message": str(e), "data": ""}
+        )
+        job.error_count += 1
+    else:
+        job.status = ImportJob.DONE
+        job.rows = totals["rows"]
+        job.entry_count = totals["entries"]
+        job.errors = totals["errors"]
+        job.error_count = len(totals["errors"])
+        # Only report a duplicate if every file was imported before.
+        if duplicates and all(duplicates):
+            job.duplicate_of = duplicates[0]
+        # The file is not needed anymore, avoid keeping big files around.
+        job.file.delete(save=False)
+    job.finished = job.heartbeat = now()
+    job.save()
+    return job
@@ -0,0 +1,533 @@
+import gzip
+import json
+import os
+import tempfile
+import zipfile
+from datetime import date
+from io import BytesIO, StringIO
+from unittest.mock import patch
+
+from django.core.management import CommandError, call_command
+
+from gemcore.constants import TAGS
+from gemcore.management.commands.parse import Command
+from gemcore.models import Entry, MonthlyRollup
+from gemcore.tests.helpers import BaseTestCase
+
+
+class ParseCommandTestCase(BaseTestCase):
+    def setUp(self):
+        super(ParseCommandTestCase, self).setUp()
+        self.user = self.factory.make_user()
+        self.book = self.factory.make_book(users=[self.user])
+        parser_config = self.factory.make_parser_config(
+            when=[0], what=[1], amount=[2], country="AR"
+        )
+        self.account = self.factory.make_account(
+            users=[self.user], parser_config=parser_config
+        )
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = tmpdir.name
+
+    def make_file(self, name, content):
+        path = os.path.join(self.tmpdir, name)
+        mode = "wb" if isinstance(content, bytes) else "w"
+        with open(path, mode) as f:
+            f.write(content)
+        return path
+
+    def call_command(self, *files, **kwargs):
+        stdout = StringIO()
+        call_command(
+            "parse",
+            "--file",
+            *files,
+            "--account",
+            self.account.slug,
+            "--book",
+            self.book.slug,
+            "--user",
+            self.user.username,
+            "--jobs",
+            "1",
+            stdout=stdout,
+            **kwargs,
+        )
+        return stdout.getvalue()
+
+    def test_many_files_and_globs(self):
+        path1 = self.make_file("bank-1.csv", "2021-10-21,one,-10\n")
+        self.make_file("bank-2.csv", "2021-10-21,two,-10\n")
+        self.make_file("bank-3.csv", "2021-10-21,three,-10\n")
+
+        output = self.call_command(
+            path1, os.path.join(self.tmpdir, "bank-*.csv")
+        )
+
+        self.assertCountEqual(
+            Entry.objects.values_list("what", flat=True),
+            ["one", "two", "three"],
+        )
+        self.assertIn("Parsing (dry run False) 3 files for", output)
+        for name in ("bank-1.csv", "bank-2.csv", "bank-3.csv"):
+            path = os.path.join(self.tmpdir, name)
+            self.assertIn(
+                "%s: 1 entries, 0 skipped, 0 errors, 1 rows" % path, output
+            )
+        self.assertIn("TOTAL: 3 entries, 0 skipped, 0 errors, 3 rows", output)
+        self.assertIn("=== STAGES ===", output)
+        self.assertIn("decode: 3 items, ", output)
+        self.assertIn("save: 3 items, ", output)
+
+    def test_errors_reported(self):
+        path = self.make_file(
+            "bank.csv", "2021-10-21,one,-10\n2021-10-21,two,xx\n"
+        )
+        missing = os.path.join(self.tmpdir, "missing.csv")
+
+        output = self.call_command(path, missing)
+
+        self.assertEqual(Entry.objects.get().what, "one")
+        self.assertIn("=== ERROR (%s): AssertionError ===" % path, output)
+        self.assertIn(
+            "=== ERROR (%s): FileNotFoundError ===" % missing, output
+        )
+        self.assertIn(
+            "%s: 1 entries, 0 skipped, 1 errors, 2 rows" % path, output
+        )
+        self.assertIn(
+            "%s: 0 entries, 0 skipped, 1 errors, 0 rows" % missing, output
+        )
+        self.assertIn("TOTAL: 1 entries, 0 skipped, 2 errors, 2 rows", output)
+
+    def test_duplicates_skipped(self):
+        path1 = self.make_file("bank-1.csv", "2021-10-21,one,-10\n")
+        path2 = self.make_file(
+            "bank-2.csv", "2021-10-21,one,-10\n2021-10-22,two,-10\n"
+        )
+
+        output = self.call_command(path1, path2)
+
+        self.assertEqual(Entry.objects.count(), 2)
+        self.assertIn(
+            "%s: 1 entries, 1 skipped, 0 errors, 2 rows" % path2, output
+        )
+        self.assertIn("TOTAL: 2 entries, 1 skipped, 0 errors, 3 rows", output)
+
+    def test_identical_file_reported(self):
+        path = self.make_file("bank.csv", "2021-10-21,one,-10\n")
+        self.call_command(path)
+
+        output = self.call_command(path)
+
+        self.assertEqual(Entry.objects.count(), 1)
+        self.assertIn(
+            "=== ALREADY IMPORTED (%s): bank.csv for %s ("
+            % (path, self.account.slug),
+            output,
+        )
+        self.assertIn("1 entries, 0 skipped, 0 errors)", output)
+        self.assertIn("TOTAL: 0 entries, 0 skipped, 0 errors, 0 rows", output)
+
+    def test_no_queries_to_start(self):
+        with self.assertNumQueries(0):
+            Command().create_parser("manage.py", "parse")
+
+    def test_unknown_slugs(self):
+        path = self.make_file("bank.csv", "2021-10-21,one,-10\n")
+        self.account.slug = "my-account"
+        self.account.save()
+
+        with self.assertRaisesMessage(
+            CommandError,
+            "Unknown account 'my-acount'. Did you mean 'my-account'?",
+        ):
+            call_command(
+                "parse",
+                "--file",
+                path,
+                "--account",
+                "my-acount",
+                "--book",
+                self.book.slug,
+                "--user",
+                self.user.username,
+            )
+        with self.assertRaisesMessage(
+            CommandError, "the following arguments are required: --file"
+        ):
+            call_command(
+                "parse",
+                "--account",
+                self.account.slug,
+                "--book",
+                self.book.slug,
+                "--user",
+                self.user.username,
+            )
+        with self.assertRaisesMessage(CommandError, "Unknown book 'foo'."):
+            call_command(
+                "parse",
+                "--file",
+                path,
+                "--account",
+                self.account.slug,
+                "--book",
+                "foo",
+                "--user",
+                self.user.username,
+            )
+        self.assertFalse(Entry.objects.exists())
+
+    def test_progress(self):
+        path = self.make_file(
+            "bank.csv",
+            "2021-10-21,one,-10\n"
+            "2021-10-21,two,xx\n"
+            "2021-10-22,three,-10\n"
+            "2021-10-22,four,-10\n",
+        )
+
+        output = self.call_command(path, "--progress", "--batch-size", "2")
+
+        self.assertEqual(Entry.objects.count(), 3)
+        # Reported after each chunk of 2 entries, and at the end.
+        lines = [line for line in output.splitlines() if "PROGRESS" in line]
+        self.assertEqual(len(lines), 2, output)
+        self.assertIn("=== PROGRESS (%s): 3 rows, " % path, lines[0])
+        self.assertTrue(lines[0].endswith(" rows/s, 1 errors ==="))
+        self.assertIn("=== PROGRESS (%s): 4 rows, " % path, lines[1])
+
+    def test_dry_run(self):
+        path = self.make_file("bank.csv", "2021-10-21,one,-10\n")
+
+        output = self.call_command(path, "--dry-run")
+
+        self.assertFalse(Entry.objects.exists())
+        self.assertIn("=== ENTRY: {", output)
+        self.assertIn("'what': 'one'", output)
+        self.assertIn("TOTAL: 1 entries, 0 skipped, 0 errors, 1 rows", output)
+
+    def test_compressed_files(self):
+        gz_path = self.make_file(
+            "bank-1.csv.gz", gzip.compress(b"2021-10-21,one,-10\n")
+        )
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, "w") as f:
+            f.writestr("two.csv", "2021-10-21,two,-10\n")
+            f.writestr("three.csv", "2021-10-21,three,-10\n")
+        zip_path = self.make_file("bank-2.zip", archive.getvalue())
+
+        output = self.call_command(gz_path, zip_path)
+
+        self.assertCountEqual(
+            Entry.objects.values_list("what", flat=True),
+            ["one", "two", "three"],
+        )
+        self.assertIn(
+            "%s: 1 entries, 0 skipped, 0 errors, 1 rows" % gz_path, output
+        )
+        for name in ("two.csv", "three.csv"):
+            self.assertIn(
+                "%s/%s: 1 entries, 0 skipped, 0 errors, 1 rows"
+                % (zip_path, name),
+                output,
+            )
+        self.assertIn("TOTAL: 3 entries, 0 skipped, 0 errors, 3 rows", output)
+
+    def test_stdin(self):
+        content = gzip.compress(b"2021-10-21,one,-10\n2021-10-22,two,-10\n")
+        with patch("sys.stdin") as stdin:
+            stdin.buffer = BytesIO(content)
+            output = self.call_command("-")
+
+        self.assertCountEqual(
+            Entry.objects.values_list("what", flat=True), ["one", "two"]
+        )
+        self.assertIn("Parsing (dry run False) 1 files for", output)
+        self.assertIn("-: 2 entries, 0 skipped, 0 errors, 2 rows", output)
+        self.assertEqual(
+            Entry.objects.get(what="one").notes, "source: 'stdin'"
+        )
+
+    def test_staging_engine(self):
+        path = self.make_file(
+            "bank.csv",
+            "2021-10-21,one,-10\n2021-10-21,one,-10\n2021-10-22,two,xx\n",
+        )
+
+        output = self.call_command(path, "--engine", "staging")
+
+        self.assertEqual(Entry.objects.get().what, "one")
+        self.assertIn(
+            "%s: 1 entries, 1 skipped, 1 errors, 3 rows" % path, output
+        )
+        self.assertEqual(
+            MonthlyRollup.objects.values_list("count", "total").get(),
+            (1, 10),
+        )
+
+
+class RollupsCommandTestCase(BaseTestCase):
+    def test_rebuild(self):
+        book = self.factory.make_book()
+        self.factory.make_entry(book=book, when=date(2024, 5, 6))
+        MonthlyRollup.objects.all().delete()
+
+        stdout = StringIO()
+        call_command("rollups", "--book", book.slug, stdout=stdout)
+
+        self.assertEqual(
+            MonthlyRollup.objects.values_list("book", "month", "count").get(),
+            (book.pk, date(2024, 5, 1), 1),
+        )
+        self.assertIn(
+            "Computed 1 monthly rollups for %s in " % book.slug,
+            stdout.getvalue(),
+        )
+
+    def test_unknown_book(self):
+        with self.assertRaisesMessage(CommandError, "Unknown book 'foo'."):
+            call_command("rollups", "--book", "foo")
+
+
+class RetagCommandTestCase(BaseTestCase):
+    def setUp(self):
+        super(RetagCommandTestCase, self).setUp()
+        self.user = self.factory.make_user()
+        self.book = self.factory.make_book(users=[self.user])
+        self.account = self.factory.make_account(users=[self.user])
+        self.account.tagregex_set.create(regex="food", tag=TAGS[1])
+        self.entry = self.factory.make_entry(
+            book=self.book, account=self.account, what="food", tags=[TAGS[0]]
+        )
+
+    def call_command(self, *args):
+        stdout = StringIO()
+        call_command(
+            "retag", "--account", self.account.slug, *args, stdout=stdout
+        )
+        return stdout.getvalue()
+
+    def test_retag(self):
+        output = self.call_command("--book", self.book.slug)
+
+        self.entry.refresh_from_db()
+        self.assertEqual(self.entry.tags, [TAGS[1]])
+        self.assertIn(
+            "Re-tagged 1 of 1 entries for %s in " % self.account.slug, output
+        )
+        self.assertNotIn("=== ENTRY", output)
+
+    def test_dry_run_shows_diff(self):
+        output = self.call_command("--dry-run")
+
+        self.entry.refresh_from_db()
+        self.assertEqual(self.entry.tags, [TAGS[0]])
+        self.assertIn("=== ENTRY %s: food ===" % self.entry.id, output)
+        self.assertIn("- tags: %s\n+ tags: %s\n" % (TAGS[0], TAGS[1]), output)
+        self.assertIn("Would re-tag 1 of 1 entries for ", output)
+
+    def test_unknown_account(self):
+        with self.assertRaisesMessage(CommandError, "Unknown account 'foo'."):
+            call_command("retag", "--account", "foo")
+
+
+class TagRulesCommandTestCase(BaseTestCase):
+    def setUp(self):
+        super(TagRulesCommandTestCase, self).setUp()
+        self.account = self.factory.make_account()
+        self.rules = [
+            self.account.tagregex_set.create(
+                regex=regex, tag=tag, hits=hits, evaluations=2000, **kwargs
+            )
+            for regex, tag, hits, kwargs in (
+                ("food", TAGS[1], 10, dict(seconds=0.002, shadowed=5)),
+                ("f.*", TAGS[1], 5, dict(seconds=0.1)),
+                ("nothing", TAGS[2], 0, dict(seconds=0.001)),
+            )
+        ]
+
+    def call_command(self, *args):
+        stdout = StringIO()
+        call_command(
+            "tagrules", "--account", self.account.slug, *args, stdout=stdout
+        )
+        return stdout.getvalue()
+
+    def test_report(self):
+        food, anything, nothing = self.rules
+
+        output = self.call_command().splitlines()
+
+        self.assertEqual(
+            output,
+            [
+                "=== %s: 3 rules, 15 hits, 0.103s tagging ==="
+                % self.account.slug,
+                "#%s 'f.*' -> %s: 5 hits, 0 overlaps, 0 shadowed, 50.0us per "
+                "evaluation, 0.100s (97.1%%) [slow]" % (anything.pk, TAGS[1]),
+                "#%s 'food' -> %s: 10 hits, 0 overlaps, 5 shadowed, 1.0us per "
+                "evaluation, 0.002s (1.9%%) [shadowed by #%s]"
+                % (food.pk, TAGS[1], anything.pk),
+                "#%s 'nothing' -> %s: 0 hits, 0 overlaps, 0 shadowed, 0.5us "
+                "per evaluation, 0.001s (1.0%%) [dead]"
+                % (nothing.pk, TAGS[2]),
+            ],
+        )
+
+    def test_flagged_and_reset(self):
+        self.account.tagregex_set.create(
+            regex="market", tag=TAGS[2], hits=1, evaluations=10, seconds=1e-5
+        )
+
+        output = self.call_command("--flagged", "--sort", "hits", "--reset")
+
+        self.assertNotIn("'market'", output)
+        self.assertIn("'f.*'", output)
+        self.assertIn("'nothing'", output)
+        self.assertFalse(
+            self.account.tagregex_set.exclude(hits=0, seconds=0).exists()
+        )
+
+    def test_unknown_account(self):
+        with self.assertRaisesMessage(CommandError, "Unknown account 'foo'."):
+            call_command("tagrules", "--account", "foo")
+
+
+class WatchInboxCommandTestCase(BaseTestCase):
+    def setUp(self):
+        super(WatchInboxCommandTestCase, self).setUp()
+        self.user = self.factory.make_user()
+        self.book = self.factory.make_book(users=[self.user])
+        parser_config = self.factory.make_parser_config(
+            when=[0], what=[1], amount=[2], country="AR"
+        )
+        self.account = self.factory.make_account(
+            slug="bank", users=[self.user], parser_config=parser_config
+        )
+        self.other = self.factory.make_account(
+            slug="bank-usd", users=[self.user], parser_config=parser_config
+        )
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.inbox = tmpdir.name
+
+    def make_file(self, name, content="2021-10-21,one,-10\n"):
+        path = os.path.join(self.inbox, name)
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    def call_command(self, *args):
+        stdout = StringIO()
+        call_command(
+            "watchinbox",
+            "--inbox",
+            self.inbox,
+            "--book",
+            self.book.slug,
+            "--user",
+            self.user.username,
+            "--once",
+            "--settle",
+            "0",
+            *args,
+            stdout=stdout,
+        )
+        return stdout.getvalue()
+
+    def read_summary(self, folder, name):
+        path = os.path.join(self.inbox, folder, name + ".summary.json")
+        with open(path) as f:
+            return json.load(f)
+
+    def test_files_mapped_by_name(self):
+        self.make_file("bank_2021-10.csv")
+        self.make_file("bank-usd_2021-10.csv", "2021-10-21,two,-10\n")
+        self.make_file("visa.csv", "2021-10-21,three,-10\n")
+
+        output = self.call_command("--rule", "visa*=bank")
+
+        self.assertEqual(
+            sorted(Entry.objects.values_list("account__slug", "what")),
+            [("bank", "one"), ("bank", "three"), ("bank-usd", "two")],
+        )
+        self.assertEqual(os.listdir(self.inbox), ["done"])
+        summary = self.read_summary("done", "bank-usd_2021-10.csv")
+        self.assertEqual(summary["account"], "bank-usd")
+        self.assertEqual(summary["book"], self.book.slug)
+        [file_summary] = summary["summaries"]
+        self.assertEqual(file_summary["entries"], 1)
+        self.assertEqual(file_summary["errors"], [])
+        self.assertIn(
+            "DONE visa.csv for bank: 1 entries, 0 skipped, 0 errors, 1 rows",
+            output,
+        )
+        self.assertIn("Processed 3 files, 0 failed.", output)
+
+    def test_failed_files(self):
+        self.make_file("unknown.csv")
+        self.make_file("bank-invalid.csv", "2021-10-21,one,xx\n")
+
+        output = self.call_command()
+
+        self.assertFalse(Entry.objects.exists())
+        self.assertCountEqual(
+            os.listdir(os.path.join(self.inbox, "failed")),
+            [
+                "bank-invalid.csv",
+                "bank-invalid.csv.summary.json",
+                "unknown.csv",
+                "unknown.csv.summary.json",
+            ],
+        )
+        summary = self.read_summary("failed", "unknown.csv")
+        self.assertIsNone(summary["account"])
+        [error] = summary["summaries"][0]["errors"]
+        self.assertEqual(error["message"], "No account for 'unknown.csv'.")
+        self.assertIn("Processed 2 files, 2 failed.", output)
+
+    def test_row_errors_reported_for_done_files(self):
+        self.make_file("bank.csv", "2021-10-21,one,-10\n2021-10-22,two,xx\n")
+
+        output = self.call_command()
+
+        self.assertEqual(
+            list(Entry.objects.values_list("what", flat=True)), ["one"]
+        )
+        self.assertEqual(os.listdir(self.inbox), ["done"])
+        summary = self.read_summary("done", "bank.csv")
+        [file_summary] = summary["summaries"]
+        self.assertEqual(file_summary["entries"], 1)
+        [error] = file_summary["errors"]
+        self.assertIn("2021-10-22", str(error["data"]))
+        self.assertIn(
+            "DONE bank.csv for bank: 1 entries, 0 skipped, 1 errors, 2 rows",
+            output,
+        )
+        self.assertIn("Processed 1 files, 0 failed.", output)
+
+    def test_same_name_processed_again(self):
+        self.make_file("bank.csv")
+        self.call_command()
+        self.make_file("bank.csv", "2021-10-21,two,-10\n")
+
+        self.call_command()
+
+        self.assertEqual(Entry.objects.count(), 2)
+        self.assertEqual(len(os.listdir(os.path.join(self.inbox, "done"))), 4)
+
+    def test_recent_files_left_alone(self):
+        self.make_file("bank.csv")
+
+        output = self.call_command("--settle", "60")
+
+        self.assertEqual(os.listdir(self.inbox), ["bank.csv"])
+        self.assertFalse(Entry.objects.exists())
+        self.assertNotIn("Processed", output)
+
+    def test_unknown_rule_account(self):
+        with self.assertRaisesMessage(CommandError, "Unknown account 'foo'."):
+            self.call_command("--rule", "*.csv=foo")
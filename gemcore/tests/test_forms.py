@@ -0,0 +1,97 @@
+from datetime import date
+from decimal import Decimal
+
+from django.conf import settings
+
+from gemcore.forms import EntryForm, EntryValidator
+from gemcore.models import Asset
+from gemcore.tests.helpers import BaseTestCase
+
+
+class EntryValidatorTestCase(BaseTestCase):
+    def setUp(self):
+        super(EntryValidatorTestCase, self).setUp()
+        self.user = self.factory.make_user()
+        self.book = self.factory.make_book(users=[self.user])
+        self.account = self.factory.make_account(users=[self.user])
+        self.asset = Asset.objects.create(
+            name="Asset", slug="asset", since=date(2020, 1, 1)
+        )
+        self.asset.users.add(self.user)
+
+    def make_data(self, **kwargs):
+        data = dict(
+            who=self.user.id,
+            when=date(2021, 10, 21),
+            what="Something",
+            account=self.account.id,
+            asset=None,
+            amount=Decimal("10.5"),
+            is_income=False,
+            tags=[settings.ENTRY_DEFAULT_TAG],
+            country="AR",
+            notes="",
+        )
+        data.update(kwargs)
+        return data
+
+    def assert_same_as_form(self, validator, data):
+        form = EntryForm(book=self.book, data=data)
+        form.is_valid()
+        entry, errors = validator.validate(data)
+        self.assertEqual(errors, {k: list(v) for k, v in form.errors.items()})
+        if not errors:
+            expected = form.save(commit=False)
+            for name in validator.fields:
+                self.assertEqual(getattr(entry, name), getattr(expected, name))
+            self.assertEqual(entry.book, self.book)
+        return errors
+
+    def test_valid(self):
+        validator = EntryValidator(self.book)
+        for data in (
+            self.make_data(),
+            self.make_data(asset=self.asset.id, is_income=True),
+            self.make_data(
+                when="2021-10-21", amount="7", account=str(self.account.id)
+            ),
+        ):
+            with self.subTest(data=data):
+                errors = self.assert_same_as_form(validator, data)
+                self.assertEqual(errors, {})
+
+    def test_invalid(self):
+        other_account = self.factory.make_account()
+        validator = EntryValidator(self.book)
+        for data in (
+            self.make_data(account=other_account.id),
+            self.make_data(account="foo"),
+            self.make_data(account=None),
+            self.make_data(asset=0),
+            self.make_data(who=0),
+            self.make_data(when="not a date"),
+            self.make_data(what=""),
+            self.make_data(amount="xx"),
+            self.make_data(amount=Decimal("-1")),
+            self.make_data(amount=Decimal("1.234")),
+            self.make_data(tags=[]),
+            self.make_data(tags=["XX"]),
+            self.make_data(country="XX"),
+            self.make_data(country="", tags=None, what=None),
+        ):
+            with self.subTest(data=data):
+                errors = self.assert_same_as_form(validator, data)
+                self.assertNotEqual(errors, {})
+
+    def test_no_queries_per_row(self):
+        validator = EntryValidator(self.book)
+        # The first lookup of a user needs a query, it's cached afterwards.
+        with self.assertNumQueries(1):
+            validator.validate(self.make_data())
+
+        with self.assertNumQueries(0):
+            for i in range(10):
+                entry, errors = validator.validate(
+                    self.make_data(what="Row %s" % i, asset=self.asset.id)
+                )
+                self.assertEqual(errors, {})
@@ -3,11 +3,26 @@ from datetime import date, timedelta
 from decimal import Decimal
 from unittest.mock import patch
 
-from django.db import IntegrityError
+from django.conf import settings
+from django.db import IntegrityError, connection, models
+from django.test import override_settings
 from django.utils.timezone import now
 
 from gemcore.constants import TAGS
-from gemcore.models import Entry
+from gemcore.models import (
+    Asset,
+    AssetToken,
+    Entry,
+    ImportJob,
+    MonthlyRollup,
+    TagRegex,
+    TagSuggester,
+    TagToken,
+    book_version,
+    flush_tag_rule_stats,
+    tokenize,
+    update_entries,
+)
 from gemcore.tests.helpers import BaseTestCase
 
 MAX_ENTRIES = 50 if os.getenv("GITHUB_ACTIONS") == "true" else 10
@@ -107,6 +122,60 @@ class BookTestCase(BaseTestCase):
         result = self.book.year_breakdown()
         self.assertCountEqual(list(result), expected)
 
+    def test_facets(self):
+        self.assertEqual(
+            self.book.facets(),
+            dict.fromkeys(
+                ("countries", "currencies", "months", "tags", "who", "years"),
+                {},
+            ),
+        )
+        accounts = [
+            self.factory.make_account(currency=c) for c in ("USD", "EUR")
+        ]
+        for i, (user, tags) in enumerate(
+            (
+                (self.user1, [TAGS[0]]),
+                (self.user1, [TAGS[0], TAGS[1]]),
+                (self.user2, [TAGS[1], TAGS[1]]),
+                (self.user2, []),
+                (self.user1, ["not a choice"]),
+            )
+        ):
+            self.factory.make_entry(
+                book=self.book,
+                who=user,
+                account=accounts[i % 2],
+                when=date(2020 + i % 2, 1 + i % 3, 1),
+                country=("AR", "UY")[i % 2],
+                tags=tags,
+            )
+        self.factory.make_entry(tags=[TAGS[2]])
+
+        for entries, queries in (
+            (None, 1),
+            (self.book.entry_set.filter(who=self.user1), 1),
+            (self.book.entry_set.filter(tags__contains=[TAGS[1]]), 1),
+            (self.book.entry_set.none(), 0),
+        ):
+            with self.assertNumQueries(queries):
+                result = self.book.facets(entries)
+            self.assertEqual(
+                result,
+                {
+                    "countries": self.book.countries(entries),
+                    "currencies": self.book.currencies(entries),
+                    "months": self.book.months(entries),
+                    "tags": self.book.tags(entries),
+                    "who": self.book.who(entries),
+                    "years": self.book.years(entries),
+                },
+            )
+        self.assertEqual(
+            list(self.book.facets()["tags"].items()),
+            [(TAGS[0], ("Clothing", 2)), (TAGS[1], ("Food", 2))],
+        )
+
     def test_balance_one_account(self, account=None):
         # no entries
         balance = self.book.balance(Entry.objects.none())
@@ -211,6 +280,262 @@ class BookTestCase(BaseTestCase):
         }
         self.assertEqual(balance, expected)
 
+    def test_balance_single_query(self):
+        account = self.factory.make_account()
+        for when, is_income in (
+            (date(2020, 1, 15), True),
+            (date(2020, 1, 20), False),
+            (date(2020, 4, 3), False),
+            (date(2020, 4, 30), False),
+        ):
+            self.factory.make_entry(
+                book=self.book, account=account, when=when, is_income=is_income
+            )
+
+        with self.assertNumQueries(1):
+            balance = self.book.balance()
+
+        self.assertEqual(
+            balance["complete"],
+            {
+                "expense": Decimal("3.00"),
+                "income": Decimal("1.00"),
+                "result": Decimal("-2.00"),
+                "start": date(2020, 1, 15),
+                "end": date(2020, 4, 30),
+            },
+        )
+        # months with no entries are included
+        self.assertEqual(
+            [
+                (m["start"], m["end"], m["income"], m["expense"], m["acc"])
+                for m in balance["months"]
+            ],
+            [
+                (date(2020, 1, 1), date(2020, 1, 31), 1, 1, 0),
+                (date(2020, 2, 1), date(2020, 2, 29), 0, 0, 0),
+                (date(2020, 3, 1), date(2020, 3, 31), 0, 0, 0),
+                (date(2020, 4, 1), date(2020, 4, 30), 0, 2, -2),
+            ],
+        )
+
+        # only entries within the given dates are considered
+        balance = self.book.balance(
+            start=date(2020, 1, 18), end=date(2020, 4, 10)
+        )
+        self.assertEqual(
+            balance["complete"],
+            {
+                "expense": Decimal("2.00"),
+                "income": Decimal("0"),
+                "result": Decimal("-2.00"),
+                "start": date(2020, 1, 18),
+                "end": date(2020, 4, 10),
+            },
+        )
+        self.assertEqual(
+            [(m["end"], m["acc"]) for m in balance["months"]],
+            [
+                (date(2020, 1, 31), -1),
+                (date(2020, 2, 29), -1),
+                (date(2020, 3, 31), -1),
+                (date(2020, 4, 10), -2),
+            ],
+        )
+
+    def test_currency_balances(self):
+        self.assertEqual(self.book.currency_balances(), {})
+        usd = self.factory.make_account(currency="USD")
+        eur = self.factory.make_account(currency="EUR")
+        for account, when in (
+            (usd, date(2020, 1, 15)),
+            (usd, date(2020, 3, 1)),
+            (eur, date(2020, 2, 10)),
+        ):
+            self.factory.make_entry(book=self.book, account=account, when=when)
+        entries = self.book.entry_set.all()
+
+        with self.assertNumQueries(1):
+            balances = self.book.currency_balances(entries)
+
+        self.assertEqual(list(balances), ["EUR", "USD"])
+        for currency, balance in balances.items():
+            with self.subTest(currency=currency):
+                self.assertEqual(
+                    balance,
+                    self.book.balance(
+                        entries.filter(account__currency=currency)
+                    ),
+                )
+        self.assertEqual(len(balances["USD"]["months"]), 3)
+        self.assertEqual(self.book.currency_balances(), balances)
+
+    def assert_rollups(self, expected):
+        rollups = MonthlyRollup.objects.filter(book=self.book)
+        self.assertCountEqual(
+            rollups.values_list(
+                "account", "asset", "month", "is_income", "count", "total"
+            ),
+            expected,
+        )
+
+    def test_rollups_follow_entries(self):
+        account = self.factory.make_account()
+        asset = Asset.objects.create(
+            name="Car", slug="car", since=date(2020, 1, 1)
+        )
+        jan, feb = date(2020, 1, 1), date(2020, 2, 1)
+        entry = self.factory.make_entry(
+            book=self.book, account=account, when=date(2020, 1, 5)
+        )
+        Entry.objects.bulk_create(
+            [
+                self.factory.make_entry(
+                    book=self.book,
+                    account=account,
+                    when=when,
+                    amount=Decimal("2.50"),
+                    asset=asset,
+                    save=False,
+                )
+                for when in (date(2020, 1, 9), "2020-02-29")
+            ]
+        )
+        self.assert_rollups(
+            [
+                (account.pk, None, jan, False, 1, Decimal("1.00")),
+                (account.pk, asset.pk, jan, False, 1, Decimal("2.50")),
+                (account.pk, asset.pk, feb, False, 1, Decimal("2.50")),
+            ]
+        )
+
+        entry.when = date(2020, 2, 2)
+        entry.is_income = True
+        entry.save()
+        Entry.objects.filter(when__lt=feb).update(amount=Decimal("4"))
+        self.assert_rollups(
+            [
+                (account.pk, None, feb, True, 1, Decimal("1.00")),
+                (account.pk, asset.pk, jan, False, 1, Decimal("4.00")),
+                (account.pk, asset.pk, feb, False, 1, Decimal("2.50")),
+            ]
+        )
+
+        # entries left without an asset keep being counted
+        asset.delete()
+        entry.delete()
+        self.assert_rollups(
+            [
+                (account.pk, None, jan, False, 1, Decimal("4.00")),
+                (account.pk, None, feb, False, 1, Decimal("2.50")),
+            ]
+        )
+
+        MonthlyRollup.objects.all().delete()
+        self.assertEqual(self.book.rebuild_rollups(), 2)
+        self.assert_rollups(
+            [
+                (account.pk, None, jan, False, 1, Decimal("4.00")),
+                (account.pk, None, feb, False, 1, Decimal("2.50")),
+            ]
+        )
+
+    def test_rollups_follow_conflicting_bulk_create(self):
+        account = self.factory.make_account()
+        asset = Asset.objects.create(
+            name="Car", slug="car", since=date(2020, 1, 1)
+        )
+        jan, mar = date(2020, 1, 1), date(2020, 3, 1)
+        for when in (date(2020, 1, 5), date(2020, 3, 5)):
+            self.factory.make_entry(
+                book=self.book, account=account, when=when, what="one"
+            )
+        # Months with no new entries are not even looked at.
+        MonthlyRollup.objects.filter(month=mar).update(count=42)
+
+        def make_entries(*whens, **kwargs):
+            return [
+                self.factory.make_entry(
+                    book=self.book,
+                    account=account,
+                    when=when,
+                    what="one",
+                    save=False,
+                    **kwargs,
+                )
+                for when in whens
+            ]
+
+        Entry.objects.bulk_create(
+            make_entries(date(2020, 1, 5), date(2020, 1, 9)),
+            ignore_conflicts=True,
+        )
+        self.assert_rollups(
+            [
+                (account.pk, None, jan, False, 2, Decimal("2.00")),
+                (account.pk, None, mar, False, 42, Decimal("1.00")),
+            ]
+        )
+        # Token counts follow too, only counting the created entries.
+        token = TagToken.objects.get(account=account, token="one", tag="")
+        self.assertEqual(token.count, 3)
+
+        Entry.objects.bulk_create(
+            make_entries(date(2020, 1, 9), asset=asset),
+            update_conflicts=True,
+            unique_fields=[
+                "book",
+                "account",
+                "when",
+                "what",
+                "amount",
+                "is_income",
+            ],
+            update_fields=["asset"],
+        )
+        self.assert_rollups(
+            [
+                (account.pk, None, jan, False, 1, Decimal("1.00")),
+                (account.pk, asset.pk, jan, False, 1, Decimal("1.00")),
+                (account.pk, None, mar, False, 42, Decimal("1.00")),
+            ]
+        )
+        token.refresh_from_db()
+        self.assertEqual(token.count, 3)
+        self.assertEqual(
+            list(AssetToken.objects.values_list("token", "asset", "count")),
+            [("one", asset.pk, 1)],
+        )
+
+    def test_reports_read_rollups(self):
+        account = self.factory.make_account()
+        for i in range(6):
+            self.factory.make_entry(
+                book=self.book,
+                account=account,
+                when=date(2020, 1 + i % 3, 1 + i),
+                is_income=i % 2,
+            )
+        entries = self.book.entry_set.all()
+        for name in ("month_breakdown", "year_breakdown"):
+            with self.subTest(name=name):
+                report = getattr(self.book, name)
+                self.assertCountEqual(report(), report(entries))
+        for name in ("calculate_balance", "balance"):
+            with self.subTest(name=name):
+                report = getattr(self.book, name)
+                self.assertEqual(report(), report(entries))
+
+        # entries changed behind the ORM's back are not seen until rebuilt
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "UPDATE gemcore_entry SET amount = 5 "
+                'WHERE EXTRACT(month FROM "when") = 1'
+            )
+        self.assertEqual(self.book.balance()["complete"]["expense"], 3)
+        self.book.rebuild_rollups()
+        self.assertEqual(self.book.balance()["complete"]["expense"], 7)
+
     def assert_merge_entries_value_error(self, *entries, expected_error):
         with self.assertRaises(ValueError) as ctx:
             self.book.merge_entries(*entries)
@@ -440,6 +765,92 @@ class BookTestCase(BaseTestCase):
         self.book.breakdown()
 
 
+# Tests run in a single process, so a local memory cache is shared enough.
+@override_settings(BOOK_CACHE="books")
+class BookCacheTestCase(BaseTestCase):
+    def setUp(self):
+        super(BookCacheTestCase, self).setUp()
+        self.book = self.factory.make_book()
+        self.account = self.factory.make_account()
+
+    def test_reports_cached(self):
+        self.assertIsNone(self.book.balance())
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.book.balance())
+
+        entry = self.factory.make_entry(
+            book=self.book, account=self.account, when=date(2020, 1, 1)
+        )
+        entries = self.book.entry_set.all()
+        facets = self.book.facets(entries)
+        with self.assertNumQueries(0):
+            # the order of the entries does not matter
+            self.assertEqual(
+                self.book.facets(entries=entries.order_by("-when")), facets
+            )
+        with self.assertNumQueries(1):
+            self.book.facets(entries.filter(what="foo"))
+
+        self.assertEqual(
+            list(self.book.month_breakdown()),
+            [{"month": date(2020, 1, 1), "count": 1, "total": 1}],
+        )
+        with self.assertNumQueries(0):
+            self.assertEqual(len(self.book.month_breakdown()), 1)
+
+        self.assertEqual(self.book.balance()["complete"]["expense"], 1)
+        self.assertEqual(self.book.balance(entries)["months"][0]["acc"], -1)
+        entry.delete()
+        self.assertIsNone(self.book.balance())
+        self.assertIsNone(self.book.balance(entries))
+
+    @override_settings(BOOK_CACHE=None)
+    def test_reports_not_cached_without_shared_cache(self):
+        self.factory.make_entry(book=self.book, account=self.account)
+        entries = self.book.entry_set.all()
+        facets = self.book.facets(entries)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.book.facets(entries), facets)
+        self.assertIsInstance(self.book.month_breakdown(), list)
+
+    def test_entry_changes_forget_reports(self):
+        entry = self.factory.make_entry(
+            book=self.book, account=self.account, country="AR"
+        )
+        entries = self.book.entry_set.all()
+        other_book = self.factory.make_book()
+
+        for change in (
+            lambda: self.factory.make_entry(
+                book=self.book, account=self.account, what="other"
+            ),
+            lambda: Entry.objects.bulk_create(
+                [
+                    self.factory.make_entry(
+                        book=self.book, account=self.account, save=False
+                    )
+                ]
+            ),
+            lambda: update_entries(entries, country="UY"),
+            lambda: entries.update(amount=Decimal(2)),
+            lambda: Entry.objects.filter(pk=entry.pk).delete(),
+            lambda: self.book.rebuild_rollups(),
+        ):
+            with self.subTest(change=change):
+                self.book.facets(entries)
+                version = book_version(self.book.pk)
+                other_version = book_version(other_book.pk)
+                change()
+                self.assertNotEqual(book_version(self.book.pk), version)
+                self.assertEqual(book_version(other_book.pk), other_version)
+                with self.assertNumQueries(1):
+                    facets = self.book.facets(entries)
+                self.assertEqual(
+                    facets, self.book.facets.__wrapped__(self.book, entries)
+                )
+
+
 class AccountTestCase(BaseTestCase):
     def test_tags_for(self):
         account = self.factory.make_account()
@@ -468,3 +879,373 @@ class AccountTestCase(BaseTestCase):
         self.assertCountEqual(account.tags_for("foo"), ["food"])
         self.assertCountEqual(account.tags_for("12x"), ["fun", "house"])
         self.assertCountEqual(account.tags_for("y12x"), [])
+
+    def test_tags_for_literal_and_regex_rules(self):
+        account = self.factory.make_account()
+        tag1, tag2, tag3 = TAGS[:3]
+        self.factory.make_tag_regex(regex="SUPER", tag=tag1, account=account)
+        self.factory.make_tag_regex(
+            regex="SUPER MARKET", tag=tag2, account=account
+        )
+        self.factory.make_tag_regex(regex=r"S\w+", tag=tag3, account=account)
+
+        self.assertCountEqual(account.tags_for("SUPER"), [tag1, tag3])
+        self.assertCountEqual(
+            account.tags_for("SUPER MARKET 1"), [tag1, tag2, tag3]
+        )
+        self.assertCountEqual(account.tags_for("THE SUPER"), [])
+        self.assertCountEqual(account.tags_for("SUPE"), [tag3])
+
+    def test_tags_for_later_rules_win(self):
+        account = self.factory.make_account()
+        other = self.factory.make_account()
+        tag = TAGS[0]
+        account.tagregex_set.create(regex="foo", tag=tag)
+        account.tagregex_set.create(regex="f.o", tag=tag, transfer=other)
+
+        self.assertEqual(account.tags_for("foo"), {tag: (other, None)})
+
+    def test_tags_for_stats(self):
+        account = self.factory.make_account()
+        tag1, tag2 = TAGS[:2]
+        first = account.tagregex_set.create(regex="foo", tag=tag1)
+        second = account.tagregex_set.create(regex="f.o", tag=tag1)
+        other = account.tagregex_set.create(regex="bar", tag=tag2)
+        dead = account.tagregex_set.create(regex="fnothing", tag=tag2)
+        # Leave out the stats of any other matcher.
+        flush_tag_rule_stats()
+
+        with self.settings(TAG_RULES_PROFILE_EVERY=2):
+            for value in ("foo", "fxo", "bar", "foo bar"):
+                account.tags_for(value)
+            # Matches are counted in memory, and saved in a single query.
+            with self.assertNumQueries(1):
+                flush_tag_rule_stats()
+
+        for rule, stats in (
+            (first, (2, 2, 2)),
+            (second, (3, 2, 0)),
+            (other, (1, 0, 0)),
+            (dead, (0, 0, 0)),
+        ):
+            rule.refresh_from_db()
+            self.assertEqual(
+                (rule.hits, rule.overlaps, rule.shadowed), stats, rule.regex
+            )
+        # Every other value is profiled, checking the regexes and the
+        # literals starting like the value, and counted twice.
+        self.assertEqual(
+            [r.evaluations for r in (first, second, other, dead)],
+            [4, 4, 0, 4],
+        )
+        self.assertGreater(second.seconds, 0)
+        self.assertIsNone(other.cost)
+        self.assertFalse(dead.is_dead)
+        with patch.object(TagRegex, "DEAD_EVALUATIONS", 4):
+            self.assertTrue(dead.is_dead)
+            self.assertFalse(first.is_dead)
+        with patch.object(TagRegex, "SLOW_SECONDS", 0):
+            self.assertTrue(second.is_slow)
+
+    def test_tag_rule_save_keeps_stats(self):
+        account = self.factory.make_account()
+        rule = account.tagregex_set.create(regex="foo", tag=TAGS[0])
+        # Stats are flushed after the rule was loaded, as when editing it.
+        TagRegex.objects.filter(pk=rule.pk).update(
+            hits=models.F("hits") + 3, seconds=0.5
+        )
+
+        rule.regex = "fo+"
+        rule.save()
+
+        rule.refresh_from_db()
+        self.assertEqual(
+            (rule.regex, rule.hits, rule.seconds), ("fo+", 3, 0.5)
+        )
+
+    def test_tags_for_compiled_once(self):
+        account = self.factory.make_account()
+        self.factory.make_tag_regex(regex="foo", tag=TAGS[0], account=account)
+        account.tags_for("foo")
+
+        with self.assertNumQueries(0):
+            self.assertCountEqual(account.tags_for("foo"), [TAGS[0]])
+
+    def test_tags_for_invalidated_on_rule_change(self):
+        account = self.factory.make_account()
+        tag1, tag2 = TAGS[:2]
+        rule = self.factory.make_tag_regex(
+            regex="foo", tag=tag1, account=account
+        )
+        self.assertCountEqual(account.tags_for("foo"), [tag1])
+
+        self.factory.make_tag_regex(regex="fo+", tag=tag2, account=account)
+        self.assertCountEqual(account.tags_for("foo"), [tag1, tag2])
+
+        rule.regex = "bar"
+        rule.save()
+        self.assertCountEqual(account.tags_for("foo"), [tag2])
+        self.assertCountEqual(account.tags_for("bar"), [tag1])
+
+        rule.delete()
+        self.assertCountEqual(account.tags_for("bar"), [])
+
+    def test_tags_for_version_bumped_on_rule_change(self):
+        account = self.factory.make_account()
+        self.factory.make_tag_regex(regex="foo", tag=TAGS[0], account=account)
+
+        account.refresh_from_db()
+        self.assertEqual(account.tag_rules_version, 1)
+
+    def test_retag_entries(self):
+        user = self.factory.make_user()
+        book = self.factory.make_book(users=[user])
+        account = self.factory.make_account(users=[user])
+        asset = Asset.objects.create(
+            name="Car", slug="car", since=date(2020, 1, 1)
+        )
+        other_asset = Asset.objects.create(
+            name="House", slug="house", since=date(2020, 1, 1)
+        )
+        tag1, tag2, tag3 = TAGS[:3]
+        account.tagregex_set.create(regex="fuel", tag=tag1, asset=asset)
+        account.tagregex_set.create(regex="f.*", tag=tag2)
+        account.tagregex_set.create(regex="roof", tag=tag3, asset=asset)
+        account.tagregex_set.create(regex="roof", tag=tag1, asset=other_asset)
+        entries = {
+            what: self.factory.make_entry(
+                book=book, account=account, what=what, tags=tags, asset=None
+            )
+            for what, tags in (
+                ("fuel", [tag3]),
+                ("food", [tag2]),
+                ("other", [tag3]),
+                ("roof", [tag2]),
+            )
+        }
+        for i in range(3):
+            self.factory.make_entry(
+                book=book, account=account, what="fee %s" % i, tags=[tag3]
+            )
+        changes = []
+
+        def diff(*args):
+            changes.append(args)
+
+        result = account.retag_entries(chunk_size=2, diff=diff)
+
+        self.assertEqual(result, {"entries": 7, "changed": 4, "conflicts": 1})
+        fuel = entries["fuel"]
+        self.assertIn(
+            (fuel.id, "fuel", [tag3], [tag1, tag2], None, asset.id), changes
+        )
+        fuel.refresh_from_db()
+        self.assertEqual(fuel.tags, [tag1, tag2])
+        self.assertEqual(fuel.asset, asset)
+        for what, tags in (
+            ("food", [tag2]),
+            ("other", [tag3]),
+            ("roof", [tag2]),
+        ):
+            entry = Entry.objects.get(what=what)
+            self.assertEqual(entry.tags, tags)
+            self.assertIsNone(entry.asset)
+        self.assertCountEqual(
+            Entry.objects.filter(what__startswith="fee ").values_list(
+                "tags", flat=True
+            ),
+            [[tag2]] * 3,
+        )
+
+    def test_retag_entries_dry_run_and_book(self):
+        user = self.factory.make_user()
+        book = self.factory.make_book(users=[user])
+        other_book = self.factory.make_book(users=[user])
+        account = self.factory.make_account(users=[user])
+        account.tagregex_set.create(regex="food", tag=TAGS[1])
+        entry = self.factory.make_entry(
+            book=book, account=account, what="food", tags=[TAGS[0]]
+        )
+        other = self.factory.make_entry(
+            book=other_book, account=account, what="food", tags=[TAGS[0]]
+        )
+
+        result = account.retag_entries(book=book, dry_run=True)
+
+        self.assertEqual(result, {"entries": 1, "changed": 1, "conflicts": 0})
+        entry.refresh_from_db()
+        self.assertEqual(entry.tags, [TAGS[0]])
+
+        # A server-side cursor, a single UPDATE, and the token counts added
+        # and subtracted, in a transaction.
+        with self.assertNumQueries(6):
+            result = account.retag_entries(book=book)
+
+        self.assertEqual(result["changed"], 1)
+        entry.refresh_from_db()
+        self.assertEqual(entry.tags, [TAGS[1]])
+        other.refresh_from_db()
+        self.assertEqual(other.tags, [TAGS[0]])
+
+    def assert_tag_tokens(self, account, expected):
+        tokens = TagToken.objects.filter(account=account, count__gt=0)
+        self.assertEqual({(t.token, t.tag): t.count for t in tokens}, expected)
+
+    def test_tokenize(self):
+        self.assertEqual(
+            tokenize("SHELL 4432 Shell-station de Córdoba x2"),
+            ["shell", "station", "córdoba"],
+        )
+        self.assertEqual(tokenize("12/10 #42"), [])
+
+    def test_tag_tokens_follow_entries(self):
+        user = self.factory.make_user()
+        book = self.factory.make_book(users=[user])
+        account = self.factory.make_account(users=[user])
+        asset = Asset.objects.create(
+            name="Car", slug="car", since=date(2020, 1, 1)
+        )
+        tag1, tag2 = TAGS[:2]
+        entry = self.factory.make_entry(
+            book=book, account=account, what="Shell fuel", tags=[tag1]
+        )
+        other = self.factory.make_entry(
+            book=book,
+            account=account,
+            what="Shell",
+            tags=[tag1, tag2],
+            asset=asset,
+        )
+        self.assert_tag_tokens(
+            account,
+            {
+                ("shell", ""): 2,
+                ("shell", tag1): 2,
+                ("shell", tag2): 1,
+                ("fuel", ""): 1,
+                ("fuel", tag1): 1,
+            },
+        )
+        self.assertEqual(
+            list(AssetToken.objects.values_list("token", "asset", "count")),
+            [("shell", asset.pk, 1)],
+        )
+
+        entry.what = "Fuel"
+        entry.tags = [tag2]
+        entry.save()
+        self.assert_tag_tokens(
+            account,
+            {
+                ("shell", ""): 1,
+                ("shell", tag1): 1,
+                ("shell", tag2): 1,
+                ("fuel", ""): 1,
+                ("fuel", tag2): 1,
+            },
+        )
+
+        update_entries(Entry.objects.filter(pk=other.pk), tags=[tag2])
+        other.delete()
+        self.assert_tag_tokens(account, {("fuel", ""): 1, ("fuel", tag2): 1})
+        self.assertEqual(AssetToken.objects.get().count, 0)
+
+        self.assertEqual(account.rebuild_tag_tokens(), 1)
+        self.assert_tag_tokens(account, {("fuel", ""): 1, ("fuel", tag2): 1})
+        self.assertFalse(AssetToken.objects.exists())
+
+    def test_tag_suggester(self):
+        user = self.factory.make_user()
+        book = self.factory.make_book(users=[user])
+        account = self.factory.make_account(users=[user])
+        asset = Asset.objects.create(
+            name="Car", slug="car", since=date(2020, 1, 1)
+        )
+        tag1, tag2, tag3 = TAGS[:3]
+        for what, tags, entry_asset in (
+            ("Shell 1", [tag1], asset),
+            ("Shell 2", [tag1, tag2], asset),
+            ("Shell 3", [tag1], asset),
+            ("Shell 4", [tag1, tag3], None),
+            ("Market 1", [tag2], None),
+            ("Market 2", [tag2], None),
+        ):
+            self.factory.make_entry(
+                book=book,
+                account=account,
+                what=what,
+                tags=tags,
+                asset=entry_asset,
+            )
+        suggester = account.tag_suggester()
+
+        # Only the counts for the given tokens are read.
+        with self.assertNumQueries(2):
+            self.assertEqual(suggester.suggest("SHELL 42"), ([tag1], None))
+        with self.assertNumQueries(0):
+            self.assertEqual(suggester.suggest("shell"), ([tag1], None))
+        # Too few entries to tell.
+        self.assertEqual(suggester.suggest("Market 3"), ([], None))
+        self.assertEqual(suggester.suggest("Other"), ([], None))
+
+        with patch.object(TagSuggester, "MIN_SHARE", 0.75):
+            self.assertEqual(
+                account.tag_suggester(preload=True).suggest("Shell 5"),
+                ([tag1], asset.pk),
+            )
+        with patch.object(TagSuggester, "MIN_ENTRIES", 2):
+            self.assertEqual(
+                account.tag_suggester().suggest("Shell market"),
+                ([tag1, tag2], None),
+            )
+
+
+class ImportJobTestCase(BaseTestCase):
+    def make_job(self, **kwargs):
+        user = self.factory.make_user()
+        return ImportJob.objects.create(
+            book=self.factory.make_book(users=[user]),
+            account=self.factory.make_account(users=[user]),
+            who=user,
+            **kwargs,
+        )
+
+    def test_claim_empty(self):
+        self.make_job(status=ImportJob.DONE)
+        self.make_job(status=ImportJob.RUNNING)
+
+        self.assertIsNone(ImportJob.objects.claim())
+
+    def test_claim_oldest_pending(self):
+        self.make_job(status=ImportJob.FAILED)
+        first = self.make_job()
+        second = self.make_job()
+
+        job = ImportJob.objects.claim()
+
+        self.assertEqual(job, first)
+        self.assertEqual(job.status, ImportJob.RUNNING)
+        self.assertIsNotNone(job.started)
+        first.refresh_from_db()
+        self.assertEqual(first.status, ImportJob.RUNNING)
+        self.assertEqual(ImportJob.objects.claim(), second)
+        self.assertIsNone(ImportJob.objects.claim())
+
+    def test_claim_abandoned(self):
+        timeout = timedelta(seconds=settings.IMPORT_JOB_TIMEOUT)
+        long_ago = now() - timeout - timedelta(minutes=1)
+        # Running for long, but still making progress.
+        self.make_job(
+            status=ImportJob.RUNNING, started=long_ago, heartbeat=now()
+        )
+        abandoned = self.make_job(
+            status=ImportJob.RUNNING, started=long_ago, heartbeat=long_ago
+        )
+
+        job = ImportJob.objects.claim()
+
+        self.assertEqual(job, abandoned)
+        self.assertEqual(job.status, ImportJob.RUNNING)
+        self.assertGreater(job.started, now() - timeout)
+        self.assertGreater(job.heartbeat, now() - timeout)
+        self.assertIsNone(ImportJob.objects.claim())
@@ -1,28 +1,63 @@
+import bz2
 import csv
-from datetime import datetime
+import gc
+import gzip
+import os
+import tempfile
+import zipfile
+from datetime import date, datetime
 from decimal import Decimal
-from io import StringIO
+from io import BytesIO, StringIO
+from unittest.mock import patch
 
 from django.conf import settings
 
-from gemcore.models import Entry
-from gemcore.parser import CSVParser
+from gemcore.constants import TAGS
+from gemcore.models import (
+    Entry,
+    ImportedRow,
+    ImportRun,
+    ParserConfig,
+    TagToken,
+)
+from gemcore.parser import (
+    CSVParser,
+    ImportStats,
+    KnownRows,
+    RowDecoder,
+    StagingCSVParser,
+    import_file,
+    open_archive,
+    open_text_stream,
+    split_rows,
+)
 from gemcore.tests.helpers import BaseTestCase
 
 
 class CSVParserTestCase(BaseTestCase):
+    parser_class = CSVParser
+    batch_size = None
+    jobs = None
+
     def make_account_with_parser(self, **kwargs):
         parser = self.factory.make_parser_config(**kwargs)
         user = self.factory.make_user()
         account = self.factory.make_account(users=[user], parser_config=parser)
         return account
 
-    def do_parse(self, account, stream, book=None):
+    def do_parse(self, account, stream, book=None, **kwargs):
         user = account.users.get()
         if book is None:
             book = self.factory.make_book(users=[user])
 
-        result = CSVParser(account).parse(stream, book=book, user=user)
+        result = self.parser_class(account).parse(
+            stream,
+            book=book,
+            user=user,
+            batch_size=self.batch_size,
+            jobs=self.jobs,
+            **kwargs,
+        )
         stream.seek(0)
         reader = csv.reader(stream)
         rows = [i for i in reader if filter(bool, i)]
@@ -59,25 +94,200 @@ class CSVParserTestCase(BaseTestCase):
         f = StringIO("2021-10-21,line 2,0,20")
         result, rows = self.do_parse(account, f, book)
 
-        self.assert_result(result, errors=1, entries=0, all_entries=2)
-        data = {
-            "account": account.pk,
-            "asset": None,
-            "amount": Decimal("20"),
-            "country": "US",
-            "is_income": True,
-            "notes": "source: 'stream with no name'",
-            "tags": [settings.ENTRY_DEFAULT_TAG],
-            "what": "line 2",
-            "when": datetime(2021, 10, 21, 0, 0),
-            "who": user.pk,
-        }
-        error = {
-            "exception": "ValueError",
-            "message": "__all__: There is already an entry for this data.",
-            "data": data,
-        }
-        self.assertEqual(result["errors"], [error])
+        self.assert_result(result, errors=0, entries=0, all_entries=2)
+        self.assertEqual(result["skipped"], 1)
+        # the rollups count each entry once
+        self.assertEqual(
+            list(book.month_breakdown()),
+            [{"month": date(2021, 10, 1), "count": 2, "total": 30}],
+        )
+
+    def test_duplicated_entry_other_book_or_account(self):
+        account = self.make_account_with_parser(
+            when=[0], what=[1], amount=[2, 3], country="US"
+        )
+        user = account.users.get()
+        book = self.factory.make_book(users=[user])
+        other_book = self.factory.make_book(users=[user])
+        other_account = self.factory.make_account(users=[user])
+        for b, a in ((other_book, account), (book, other_account)):
+            self.factory.make_entry(
+                book=b,
+                account=a,
+                who=user,
+                when=date(2021, 10, 21),
+                what="line 1",
+                amount=Decimal("10"),
+            )
+
+        f = StringIO("2021-10-21,line 1,10,0\n")
+        result, rows = self.do_parse(account, f, book)
+
+        self.assert_result(result, errors=0, entries=1, all_entries=3)
+        self.assertEqual(result["skipped"], 0)
+
+    def test_duplicated_transfer(self):
+        account = self.make_account_with_parser(
+            when=[0], what=[1], amount=[2, 3], country="US"
+        )
+        user = account.users.get()
+        book = self.factory.make_book(users=[user])
+        other = self.factory.make_account(users=[user])
+        account.tagregex_set.create(
+            regex="^transfer", tag=TAGS[0], transfer=other
+        )
+        self.factory.make_entry(
+            book=book,
+            account=other,
+            who=user,
+            when=date(2021, 10, 21),
+            what="transfer to other",
+            amount=Decimal("10"),
+            is_income=True,
+        )
+
+        f = StringIO("2021-10-21,transfer to other,10,0\n")
+        result, rows = self.do_parse(account, f, book)
+
+        self.assert_result(result, errors=1, entries=0, all_entries=1)
+        self.assertEqual(result["skipped"], 0)
+        [error] = result["errors"]
+        self.assertEqual(error["exception"], "ValueError")
+        self.assertEqual(
+            error["message"],
+            "__all__: There is already an entry for this data.",
+        )
+        self.assertEqual(error["data"]["what"], "transfer to other")
+
+    def test_suggested_tags(self):
+        account = self.make_account_with_parser(
+            when=[0], what=[1], amount=[2, 3], country="US"
+        )
+        account.suggest_tags = True
+        account.save()
+        user = account.users.get()
+        book = self.factory.make_book(users=[user])
+        for i in range(3):
+            self.factory.make_entry(
+                book=book,
+                account=account,
+                who=user,
+                what="Shell station %s" % i,
+                tags=[TAGS[1]],
+            )
+
+        f = StringIO("2021-10-21,SHELL 42,10,0\n2021-10-21,other,0,20\n")
+        result, rows = self.do_parse(account, f, book)
+
+        self.assert_result(result, errors=0, entries=2, all_entries=5)
+        self.assert_entry_correct(what="SHELL 42", tags=[TAGS[1]])
+        self.assert_entry_correct(
+            what="other", tags=[settings.ENTRY_DEFAULT_TAG]
+        )
+        # Imported entries are learned from too.
+        token = TagToken.objects.get(account=account, token="shell", tag="")
+        self.assertEqual(token.count, 4)
+
+    def test_tag_rule_stats(self):
+        account = self.make_account_with_parser(
+            when=[0], what=[1], amount=[2, 3], country="US"
+        )
+        rule = account.tagregex_set.create(regex="food", tag=TAGS[1])
+        f = StringIO(
+            "2021-10-21,food 1,10,0\n"
+            "2021-10-21,other,10,0\n"
+            "2021-10-21,food 2,0,20\n"
+            "2021-10-21,food 3,0,20\n"
+        )
+
+        result, rows = self.do_parse(account, f)
+
+        self.assert_result(result, errors=0, entries=4)
+        rule.refresh_from_db()
+        self.assertEqual(rule.hits, 3)
+
+    def test_duplicated_rows_in_same_file(self):
+        account = self.make_account_with_parser(
+            when=[0], what=[1], amount=[2, 3], country="US"
+        )
+
+        f = StringIO(
+            "2021-10-21,line 1,10,0\n"
+            "2021-10-21,line 2,0,20\n"
+            "2021-10-21,line 1,10,0\n"
+        )
+        result, rows = self.do_parse(account, f)
+
+        self.assert_result(result, errors=0, entries=2)
+        self.assertEqual(result["skipped"], 1)
+
+    def test_transfer(self):
+        account = self.make_account_with_parser(
+            when=[0], what=[1], amount=[2, 3], country="US"
+        )
+        user = account.users.get()
+        other = self.factory.make_account(users=[user])
+        account.tagregex_set.create(
+            regex="^transfer", tag=TAGS[0], transfer=other
+        )
+
+        # fmt: off
+        f = StringIO(
+            "2021-10-21,transfer to other,10,0\n"
+            "2021-10-21,line 2,0,20\n"
+        )
+        # fmt: on
+        result, rows = self.do_parse(account, f)
+
+        self.assert_result(result, errors=0, entries=2, all_entries=3)
+        self.assert_entry_correct(
+            account=account,
+            what="transfer to other",
+            is_income=False,
+            tags=[TAGS[0]],
+        )
+        self.assert_entry_correct(
+            account=other,
+            what="transfer to other",
+            is_income=True,
+            tags=[TAGS[0]],
+        )
+        self.assert_entry_correct(account=account, what="line 2")
+
+    def test_stages(self):
+        account = self.make_account_with_parser(
+            when=[0], what=[1], amount=[2, 3], country="US"
+        )
+        user = account.users.get()
+        other = self.factory.make_account(users=[user])
+        account.tagregex_set.create(
+            regex="^transfer", tag=TAGS[0], transfer=other
+        )
+
+        f = StringIO(
+            "2021-10-21,transfer to other,10,0\n"
+            "2021-10-21,line 2,0,20\n"
+            "2021-10-21,line 3,xx,0\n"
+        )
+        result, rows = self.do_parse(account, f)
+
+        self.assert_result(result, errors=1, entries=2, all_entries=3)
+        counts = {k: v["count"] for k, v in result["stages"].items()}
+        self.assertEqual(
+            counts,
+            {
+                "decode": 3,
+                "make_data": 3,
+                # Once when making the data, once more looking for transfers.
+                "tagging": 4,
+                "duplicates": 2,
+                "validation": 3,
+                "transfers": 1,
+                "save": 3,
+            },
+        )
+        for value in result["stages"].values():
+            self.assertGreaterEqual(value["seconds"], 0)
 
     def test_index_error(self):
         account = self.make_account_with_parser(
@@ -273,3 +483,571 @@ class CSVParserTestCase(BaseTestCase):
                 amount=amount,
             )
             last_extra_fee = 0
+
+    def test_on_entry(self):
+        account = self.make_account_with_parser(
+            when=[0], what=[1], amount=[2], country="US"
+        )
+        f = StringIO(
+            "2021-10-21,one,-10\n2021-10-21,one,-10\n2021-10-22,two,xx\n"
+            "2021-10-23,three,-10\n"
+        )
+        entries = []
+
+        result, rows = self.do_parse(account, f, on_entry=entries.append)
+
+        self.assertEqual(result["entries"], [])
+        self.assertEqual(result["entry_count"], 2)
+        self.assertEqual(result["skipped"], 1)
+        self.assertEqual(len(result["errors"]), 1)
+        self.assertEqual(
+            entries,
+            list(Entry.objects.filter(account=account).order_by("when")),
+        )
+
+
+class RowDecoderTestCase(BaseTestCase):
+    def make_decoder(self, **kwargs):
+        kwargs.setdefault("when", [0])
+        kwargs.setdefault("what", [1])
+        kwargs.setdefault("amount", [2])
+        return RowDecoder(ParserConfig(**kwargs))
+
+    def assert_parse_date(self, date_format, value):
+        decoder = self.make_decoder(date_format=date_format)
+        try:
+            expected = datetime.strptime(value, date_format)
+        except ValueError as e:
+            with self.assertRaisesMessage(ValueError, str(e)):
+                decoder.parse_date(value)
+        else:
+            self.assertEqual(decoder.parse_date(value), expected)
+
+    def test_parse_date_matches_strptime(self):
+        values = {
+            "%Y-%m-%d": [
+                "2021-10-21",
+                "2021-1-2",
+                "2021-02-30",
+                "20211021",
+                "2021-10-21T10:00",
+                "21-10-21",
+                "",
+            ],
+            "%d/%m/%Y": [
+                "21/10/2021",
+                "1/2/2021",
+                "30/02/2021",
+                "21/10/21",
+                "21-10-2021",
+                "021/10/2021",
+                " 21/10/2021",
+            ],
+            "%m.%d.%Y": ["10.21.2021", "21.10.2021"],
+            "%Y%m%d": ["20211021", "2021-10-21"],
+            "%d %b %Y": ["21 Oct 2021", "21 10 2021"],
+        }
+        for date_format, dates in values.items():
+            for value in dates:
+                with self.subTest(date_format=date_format, value=value):
+                    self.assert_parse_date(date_format, value)
+
+    def test_parse_amount(self):
+        cases = [
+            (dict(), "1,234.56", Decimal("1234.56")),
+            (dict(), "-$ 1,234.56", Decimal("-1234.56")),
+            (dict(), "", Decimal("0")),
+            (
+                dict(thousands_sep=".", decimal_point=","),
+                "1.234,56",
+                Decimal("1234.56"),
+            ),
+            (
+                dict(thousands_sep=" ", decimal_point=","),
+                "-1 234,5",
+                Decimal("-1234.5"),
+            ),
+        ]
+        for kwargs, value, expected in cases:
+            with self.subTest(kwargs=kwargs, value=value):
+                decoder = self.make_decoder(**kwargs)
+                self.assertEqual(decoder.parse_amount([value], 0), expected)
+
+    def test_parse_amount_invalid(self):
+        decoder = self.make_decoder()
+
+        with self.assertRaisesMessage(
+            AssertionError, "Can not convert '1.2.3' to Decimal"
+        ):
+            decoder.parse_amount(["1.2.3"], 0)
+
+
+class BatchCSVParserTestCase(CSVParserTestCase):
+    batch_size = 7
+
+
+class StagingCSVParserTestCase(CSVParserTestCase):
+    parser_class = StagingCSVParser
+
+    def test_stages(self):
+        account = self.make_account_with_parser(
+            when=[0], what=[1], amount=[2, 3], country="US"
+        )
+        f = StringIO(
+            "2021-10-21,line 1,10,0\n"
+            "2021-10-21,line 2,0,20\n"
+            "2021-10-21,line 3,xx,0\n"
+        )
+        result, rows = self.do_parse(account, f)
+
+        self.assert_result(result, errors=1, entries=2)
+        counts = {k: v["count"] for k, v in result["stages"].items()}
+        # Duplicates are found when saving.
+        self.assertEqual(
+            counts,
+            {
+                "decode": 3,
+                "make_data": 3,
+                "tagging": 2,
+                "duplicates": 0,
+                "validation": 2,
+                "transfers": 2,
+                "save": 2,
+            },
+        )
+
+    def test_tags_like_tag_matcher(self):
+        account = self.make_account_with_parser(
+            when=[0], what=[1], amount=[2], country="US"
+        )
+        user = account.users.get()
+        other = self.factory.make_account(users=[user])
+        rules = [
+            ("super", TAGS[1], None),
+            ("^sup.r", TAGS[2], None),
+            ("super market", TAGS[1], other),
+            (".*market", TAGS[3], None),
+            # Not valid, or not the same, as PostgreSQL regexes.
+            (r"\bnothing\b", TAGS[4], None),
+            (r"(?P<article>the) market", TAGS[5], None),
+            (r"(?<!super )market", TAGS[6], None),
+        ]
+        for regex, tag, transfer in rules:
+            account.tagregex_set.create(
+                regex=regex, tag=tag, transfer=transfer
+            )
+        f = StringIO(
+            "2021-10-21,super market,-10\n"
+            "2021-10-21,super,-10\n"
+            "2021-10-21,the market,-10\n"
+            "2021-10-21,nothing,-10\n"
+        )
+
+        result, rows = self.do_parse(account, f)
+
+        self.assert_result(result, errors=0, entries=4, all_entries=5)
+        for entry in result["entries"]:
+            expected = list(account.tags_for(entry.what))
+            self.assertEqual(
+                entry.tags, expected or [settings.ENTRY_DEFAULT_TAG]
+            )
+            self.assertEqual(
+                Entry.objects.get(account=account, what=entry.what).tags,
+                entry.tags,
+            )
+        mirror = Entry.objects.get(account=other)
+        self.assertEqual(mirror.what, "super market")
+        self.assertTrue(mirror.is_income)
+
+    def test_dry_run(self):
+        account = self.make_account_with_parser(
+            when=[0], what=[1], amount=[2], country="US"
+        )
+        user = account.users.get()
+        book = self.factory.make_book(users=[user])
+        f = StringIO("2021-10-21,one,-10\n2021-10-21,one,-10\n")
+
+        result = self.parser_class(account).parse(
+            f, book=book, user=user, dry_run=True
+        )
+
+        self.assertFalse(Entry.objects.exists())
+        self.assertEqual(result["skipped"], 1)
+        [data] = result["entries"]
+        self.assertEqual(data["what"], "one")
+        self.assertEqual(data["tags"], [settings.ENTRY_DEFAULT_TAG])
+
+
+class SplitCSVParserTestCase(CSVParserTestCase):
+    jobs = 3
+
+    def setUp(self):
+        super(SplitCSVParserTestCase, self).setUp()
+        # Split even the smallest files in as many chunks as jobs.
+        patcher = patch("gemcore.parser.MIN_CHUNK_SIZE", 1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def do_parse(self, account, stream, book=None, **kwargs):
+        # Only regular files can be split.
+        if isinstance(stream, StringIO):
+            fd, path = tempfile.mkstemp(suffix=".csv")
+            self.addCleanup(os.remove, path)
+            with open(fd, "w") as f:
+                f.write(stream.getvalue())
+            stream = open(path)
+            self.addCleanup(stream.close)
+
+        self.splits = []
+
+        def split(*args, **kwargs):
+            self.splits.append(split_rows(*args, **kwargs))
+            return self.splits[-1]
+
+        with patch("gemcore.parser.split_rows", split):
+            result = super(SplitCSVParserTestCase, self).do_parse(
+                account, stream, book, **kwargs
+            )
+
+        self.assertEqual(len(self.splits), 1)
+        return result
+
+    def test_deferred_row_ending_a_chunk(self):
+        account = self.make_account_with_parser(
+            when=[0],
+            what=[1],
+            amount=[2],
+            country="AR",
+            defer_processing=["fee"],
+        )
+        f = StringIO(
+            "2021-10-21,fee,-1\n"
+            "2021-10-21,one,-9\n"
+            "2021-10-22,fee,-2\n"
+            "2021-10-22,two,-8\n"
+        )
+        self.jobs = 4
+
+        result, rows = self.do_parse(account, f)
+
+        # Every row is decoded on its own.
+        self.assertEqual(len(self.splits[0]), 4)
+        self.assert_result(result, errors=0, entries=2)
+        self.assertEqual(result["rows"], 4)
+        self.assert_entry_correct(what="one", amount=10, notes="9 + fee 1")
+        self.assert_entry_correct(what="two", amount=10, notes="8 + fee 2")
+
+    def test_stray_quote_not_split(self):
+        account = self.make_account_with_parser(
+            when=[0], what=[1], amount=[2], country="AR"
+        )
+        # Counting quotes, the file is split inside the quoted field.
+        f = StringIO(
+            '2021-10-21,one 5" pipe,-1\n'
+            "2021-10-22,two,-2\n"
+            '2021-10-23,"three\nlines",-3\n'
+            "2021-10-24,four,-4\n"
+        )
+        self.jobs = 2
+
+        with self.assertLogs("gemcore.parser", "WARNING"):
+            result, rows = self.do_parse(account, f)
+
+        self.assertEqual(len(self.splits[0]), 2)
+        self.assert_result(result, errors=0, entries=4)
+        self.assert_entry_correct(what='one 5" pipe', amount=1)
+        self.assert_entry_correct(what="three\nlines", amount=3)
+
+    def test_connections_closed_before_forking(self):
+        account = self.make_account_with_parser(
+            when=[0], what=[1], amount=[2], country="AR"
+        )
+        f = StringIO("2021-10-21,one,-1\n2021-10-22,two,-2\n")
+
+        # Connections in the test transaction are never closed.
+        with patch("gemcore.parser.connections") as connections:
+            connections.all.return_value = []
+            result, rows = self.do_parse(account, f)
+
+        connections.close_all.assert_called_once_with()
+        self.assert_result(result, errors=0, entries=2)
+
+    def test_known_rows_skipped(self):
+        account = self.make_account_with_parser(
+            when=[0], what=[1], amount=[2], country="AR"
+        )
+        book = self.factory.make_book(users=[account.users.get()])
+        content = "2021-10-21,one,-9\n2021-10-22,two,-8\n"
+        known_rows = KnownRows(book, account)
+        self.do_parse(account, StringIO(content), book, known_rows=known_rows)
+        Entry.objects.filter(what="two").delete()
+
+        result, rows = self.do_parse(
+            account,
+            StringIO(content + "2021-10-23,three,-7\n"),
+            book,
+            known_rows=known_rows,
+        )
+
+        self.assertGreater(len(self.splits[0]), 1)
+        self.assertEqual(result["skipped"], 1)
+        self.assertEqual(result["stages"]["make_data"]["count"], 2)
+        self.assertEqual(
+            sorted(Entry.objects.values_list("what", flat=True)),
+            ["one", "three", "two"],
+        )
+
+
+class SplitRowsTestCase(BaseTestCase):
+    def assert_chunks(self, data, parts, expected, **kwargs):
+        spans = split_rows(data, parts, **kwargs)
+        self.assertEqual([data[start:end] for start, end in spans], expected)
+
+    def test_whole_rows(self):
+        data = b"a,1\nb,2\nc,3\nd,4\n"
+        self.assert_chunks(data, 1, [data])
+        self.assert_chunks(data, 2, [b"a,1\nb,2\n", b"c,3\nd,4\n"])
+        self.assert_chunks(data, 3, [b"a,1\nb,2\n", b"c,3\nd,4\n"])
+        self.assert_chunks(data, 10, [b"a,1\n", b"b,2\n", b"c,3\n", b"d,4\n"])
+
+    def test_no_trailing_newline(self):
+        self.assert_chunks(b"a,1\nb,2", 2, [b"a,1\n", b"b,2"])
+
+    def test_quoted_newlines(self):
+        data = b'a,"x\ny\nz"\nb,""""\nc,3\n'
+        self.assert_chunks(data, 10, [b'a,"x\ny\nz"\n', b'b,""""\n', b"c,3\n"])
+
+    def test_skip_rows(self):
+        data = b'h,"1\n2"\n\na,1\nb,2\n'
+        self.assert_chunks(data, 2, [b"a,1\n", b"b,2\n"], skip_rows=2)
+        self.assert_chunks(data, 2, [], skip_rows=5)
+
+    def test_empty(self):
+        self.assert_chunks(b"", 2, [])
+
+
+class ImportStatsTestCase(BaseTestCase):
+    def test_nested_stages_are_exclusive(self):
+        stats = ImportStats()
+        with patch("time.perf_counter", side_effect=[0, 1, 4, 10]):
+            with stats.measure("make_data"):
+                with stats.measure("tagging", count=2):
+                    pass
+
+        self.assertEqual(stats.counts["make_data"], 1)
+        self.assertEqual(stats.counts["tagging"], 2)
+        self.assertEqual(stats.seconds["tagging"], 3)
+        self.assertEqual(stats.seconds["make_data"], 7)
+        self.assertEqual(stats.seconds["save"], 0)
+
+
+class ImportFileTestCase(BaseTestCase):
+    def setUp(self):
+        super(ImportFileTestCase, self).setUp()
+        self.user = self.factory.make_user()
+        self.book = self.factory.make_book(users=[self.user])
+        parser_config = self.factory.make_parser_config(
+            when=[0], what=[1], amount=[2], country="US"
+        )
+        self.account = self.factory.make_account(
+            users=[self.user], parser_config=parser_config
+        )
+
+    def do_import(self, content, book=None, **kwargs):
+        return import_file(
+            BytesIO(content.encode("utf-8")),
+            name="test.csv",
+            account=self.account,
+            book=book or self.book,
+            user=self.user,
+            **kwargs,
+        )
+
+    def test_new_file_recorded(self):
+        result = self.do_import("2021-10-21,one,-10\n2021-10-21,two,xx\n")
+
+        self.assertEqual(len(result["entries"]), 1)
+        self.assertEqual(len(result["errors"]), 1)
+        self.assertIsNone(result["duplicate_of"])
+        run = ImportRun.objects.get()
+        self.assertEqual(result["import_run"], run)
+        self.assertEqual(run.name, "test.csv")
+        self.assertEqual(run.parser_config, self.account.parser_config)
+        self.assertEqual(
+            (run.rows, run.entry_count, run.skipped, run.error_count),
+            (2, 1, 0, 1),
+        )
+        # Only the imported row is recorded, the failed one will be retried.
+        row = ImportedRow.objects.get()
+        self.assertEqual(row.entry, result["entries"][0])
+        self.assertEqual(row.account, self.account)
+
+    def test_binary_file_left_open(self):
+        binary = BytesIO(b"2021-10-21,one,-10\n")
+
+        import_file(
+            binary,
+            name="test.csv",
+            account=self.account,
+            book=self.book,
+            user=self.user,
+        )
+        gc.collect()
+
+        self.assertFalse(binary.closed)
+
+    def test_identical_file_not_parsed(self):
+        content = "2021-10-21,one,-10\n2021-10-22,two,-10\n"
+        first = self.do_import(content)
+        # Not even the duplicate index is needed to skip the content.
+        Entry.objects.all().delete()
+
+        result = self.do_import(content)
+
+        self.assertEqual(result["duplicate_of"], first["import_run"])
+        self.assertIsNone(result["import_run"])
+        self.assertEqual(result["rows"], 0)
+        self.assertEqual(result["entries"], [])
+        self.assertFalse(Entry.objects.exists())
+        self.assertEqual(ImportRun.objects.count(), 1)
+
+    def test_overlapping_file_only_processes_new_rows(self):
+        self.do_import("2021-10-21,one,-10\n2021-10-22,two,xx\n")
+
+        result = self.do_import(
+            "2021-10-21,one,-10\n2021-10-22,two,xx\n2021-10-23,three,-10\n"
+        )
+
+        self.assertIsNone(result["duplicate_of"])
+        self.assertEqual(result["rows"], 3)
+        self.assertEqual(result["skipped"], 1)
+        # The known row is not even decoded.
+        self.assertEqual(result["stages"]["make_data"]["count"], 2)
+        self.assertEqual(len(result["errors"]), 1)
+        self.assertEqual(
+            sorted(Entry.objects.values_list("what", flat=True)),
+            ["one", "three"],
+        )
+        self.assertEqual(ImportRun.objects.count(), 2)
+        self.assertEqual(ImportedRow.objects.count(), 2)
+
+    def test_row_of_deleted_entry_imported_again(self):
+        self.do_import("2021-10-21,one,-10\n")
+        Entry.objects.all().delete()
+        self.assertFalse(ImportedRow.objects.exists())
+
+        result = self.do_import("2021-10-21,one,-10\n2021-10-22,two,-10\n")
+
+        self.assertEqual(result["skipped"], 0)
+        self.assertEqual(len(result["entries"]), 2)
+        self.assertEqual(ImportedRow.objects.count(), 2)
+
+    def test_other_book_is_not_a_duplicate(self):
+        content = "2021-10-21,one,-10\n"
+        self.do_import(content)
+        other = self.factory.make_book(users=[self.user])
+
+        result = self.do_import(content, book=other)
+
+        self.assertIsNone(result["duplicate_of"])
+        self.assertEqual(result["skipped"], 0)
+        self.assertEqual(Entry.objects.filter(book=other).count(), 1)
+
+    def test_dry_run_not_recorded(self):
+        result = self.do_import("2021-10-21,one,-10\n", dry_run=True)
+
+        self.assertEqual(len(result["entries"]), 1)
+        self.assertIsNone(result["import_run"])
+        self.assertFalse(ImportRun.objects.exists())
+
+
+class OpenTextStreamTestCase(BaseTestCase):
+    content = "2021-10-21,Año nuevo,10\n2021-10-22,Ñandú,20\n" * 10
+
+    def assert_decoded(self, binary, expected, **kwargs):
+        stream = open_text_stream(binary, name="test.csv", **kwargs)
+        self.assertEqual(stream.name, "test.csv")
+        self.assertEqual(stream.read(), expected)
+
+    def test_utf8(self):
+        binary = BytesIO(self.content.encode("utf-8"))
+        self.assert_decoded(binary, self.content)
+
+    def test_latin1(self):
+        binary = BytesIO(self.content.encode("latin-1"))
+        self.assert_decoded(binary, self.content)
+
+    def test_empty(self):
+        self.assert_decoded(BytesIO(b""), "")
+
+    def test_non_ascii_after_ascii_sample(self):
+        ascii = "2021-10-20,New year,10\n" * 10
+        for encoding in ("utf-8", "latin-1"):
+            with self.subTest(encoding=encoding):
+                binary = BytesIO((ascii + self.content).encode(encoding))
+                self.assert_decoded(
+                    binary, ascii + self.content, sample_size=len(ascii)
+                )
+
+
+class OpenArchiveTestCase(BaseTestCase):
+    content = b"2021-10-21,something,-10\n"
+
+    def assert_members(self, binary, name, expected):
+        members = [(n, f.read()) for n, f in open_archive(binary, name)]
+        self.assertEqual(members, expected)
+
+    def test_plain(self):
+        self.assert_members(
+            BytesIO(self.content), "bank.csv", [("bank.csv", self.content)]
+        )
+
+    def test_plain_looking_like_bzip2(self):
+        content = b"BZh1,not,compressed\n"
+        self.assert_members(
+            BytesIO(content), "bank.csv", [("bank.csv", content)]
+        )
+
+    def test_gzip(self):
+        binary = BytesIO(gzip.compress(self.content))
+        self.assert_members(
+            binary, "bank.csv.gz", [("bank.csv", self.content)]
+        )
+
+    def test_bzip2(self):
+        binary = BytesIO(bz2.compress(self.content))
+        self.assert_members(
+            binary, "bank.csv.BZ2", [("bank.csv", self.content)]
+        )
+
+    def test_compressed_decompressed_once(self):
+        content = self.content * 100
+        binary = BytesIO(gzip.compress(content))
+        with patch("gemcore.parser.SPOOL_SIZE", 1024):
+            for name, f in open_archive(binary, "bank.csv.gz"):
+                # The compressed file was read to the end already.
+                self.assertEqual(binary.tell(), len(binary.getvalue()))
+                self.assertEqual(f.read(), content)
+                f.seek(0)
+                self.assertEqual(f.read(), content)
+
+    def test_compressed_without_extension(self):
+        binary = BytesIO(gzip.compress(self.content))
+        self.assert_members(binary, "bank", [("bank", self.content)])
+
+    def test_zip(self):
+        binary = BytesIO()
+        with zipfile.ZipFile(binary, "w") as archive:
+            archive.writestr("one.csv", self.content)
+            archive.writestr("2021/", b"")
+            archive.writestr("2021/two.csv", b"other")
+        binary.seek(0)
+
+        self.assert_members(
+            binary,
+            "bank.zip",
+            [
+                ("bank.zip/one.csv", self.content),
+                ("bank.zip/2021/two.csv", b"other"),
+            ],
+        )
@@ -1,6 +1,15 @@
+import os
+import tempfile
+import zipfile
+from io import BytesIO, StringIO
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import override_settings
 from django.urls import reverse
 
 from gemcore.constants import TAGS
+from gemcore.models import Entry, ImportJob
 from gemcore.tests.helpers import BaseTestCase
 
 
@@ -38,6 +47,115 @@ class AddEntryTestCase(BaseTestCase):
         self.assertFormError(form, field=None, errors=[error])
 
 
+class LoadFromFileTestCase(BaseTestCase):
+    def setUp(self):
+        super(LoadFromFileTestCase, self).setUp()
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media.name))
+        self.user = self.factory.make_user()
+        self.book = self.factory.make_book(users=[self.user])
+        parser_config = self.factory.make_parser_config(
+            when=[0], what=[1], amount=[2], country="AR"
+        )
+        self.account = self.factory.make_account(
+            users=[self.user], parser_config=parser_config
+        )
+        assert self.client.login(username=self.user.username, password="test")
+
+    def upload(self, content, name="bank.csv", encoding="utf-8"):
+        if isinstance(content, str):
+            content = content.encode(encoding)
+        csv_file = SimpleUploadedFile(name, content, content_type="text/csv")
+        url = reverse("load-from-file", kwargs={"book_slug": self.book.slug})
+        return self.client.post(
+            url, data={"account": self.account.id, "csv_file": csv_file}
+        )
+
+    def test_upload_file_creates_job(self):
+        content = "2021-10-21,Año nuevo,-10\n2021-10-22,Ñandú,20\n"
+        response = self.upload(content, encoding="latin-1")
+
+        job = ImportJob.objects.get()
+        self.assertRedirects(
+            response, reverse("import-job", args=[self.book.slug, job.id])
+        )
+        self.assertEqual(job.status, ImportJob.PENDING)
+        self.assertEqual(job.name, "bank.csv")
+        self.assertEqual(job.account, self.account)
+        self.assertEqual(job.who, self.user)
+        self.assertFalse(Entry.objects.exists())
+        path = job.file.path
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), content.encode("latin-1"))
+
+        call_command("importworker", "--once", stdout=StringIO())
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportJob.DONE)
+        self.assertGreater(job.heartbeat, job.started)
+        # the uploaded file is deleted once imported
+        self.assertFalse(job.file)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(job.rows, 2)
+        self.assertEqual(job.entry_count, 2)
+        self.assertEqual(job.error_count, 0)
+        self.assertCountEqual(
+            Entry.objects.values_list("what", flat=True),
+            ["Año nuevo", "Ñandú"],
+        )
+        self.assertEqual(
+            Entry.objects.get(what="Año nuevo").notes, "source: 'bank.csv'"
+        )
+
+    def test_job_progress_polled_until_finished(self):
+        self.upload("2021-10-21,something,-10\n2021-10-22,invalid,xx\n")
+        job = ImportJob.objects.get()
+        url = reverse("import-job", args=[self.book.slug, job.id])
+
+        response = self.client.get(url, HTTP_HX_REQUEST="true")
+        self.assertTemplateUsed(response, "gemcore/_import_job.html")
+        self.assertTemplateNotUsed(response, "base.html")
+        self.assertContains(response, 'hx-trigger="every 2s"')
+
+        call_command("importworker", "--once", stdout=StringIO())
+
+        response = self.client.get(url, HTTP_HX_REQUEST="true")
+        self.assertNotContains(response, "hx-trigger")
+        self.assertContains(response, "<dt>Errors</dt><dd>1</dd>")
+        self.assertContains(response, "Go to entries")
+
+    def test_upload_zip_file(self):
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, "w") as f:
+            f.writestr("one.csv", "2021-10-21,one,-10\n2021-10-22,bad,xx\n")
+            f.writestr("two.csv", "2021-10-23,two,-10\n")
+        self.upload(archive.getvalue(), name="bank.zip")
+
+        call_command("importworker", "--once", stdout=StringIO())
+
+        job = ImportJob.objects.get()
+        self.assertEqual(job.status, ImportJob.DONE)
+        self.assertEqual(job.rows, 3)
+        self.assertEqual(job.entry_count, 2)
+        self.assertEqual(job.error_count, 1)
+        self.assertIsNone(job.duplicate_of)
+        self.assertEqual(
+            Entry.objects.get(what="two").notes, "source: 'bank.zip/two.csv'"
+        )
+
+    def test_job_of_other_book_not_found(self):
+        self.upload("2021-10-21,something,-10\n")
+        job = ImportJob.objects.get()
+        other = self.factory.make_book(users=[self.user])
+
+        response = self.client.get(
+            reverse("import-job", args=[other.slug, job.id])
+        )
+
+        self.assertEqual(response.status_code, 404)
+
+
 class BalanceViewTestCase(BaseTestCase):
     def test_get_by_account(self):
         user = self.factory.make_user()
@@ -125,6 +243,37 @@ class BulkRemoveTestCase(BulkTestCaseMixin, BaseTestCase):
         )
 
 
+class BulkBalanceTestCase(BulkTestCaseMixin, BaseTestCase):
+    action_name = "calculate-balance"
+    action_btn = (
+        '<button type="submit" class="btn btn-sm btn-default" '
+        f'name="{action_name}" hx-post="." hx-trigger="click" '
+        'hx-target="#entries-balance-inline">Balance</button>'
+    )
+
+    def test_balance_per_currency(self):
+        user = self.factory.make_user()
+        book = self.factory.make_book(users=[user])
+        entries = [
+            self.factory.make_entry(
+                book=book, account=self.factory.make_account(currency=c)
+            )
+            for c in ("USD", "EUR")
+        ]
+
+        data = {"entry": [e.id for e in entries], self.action_name: 1}
+        response = self.do_request(user, book, method="POST", data=data)
+
+        self.assertTemplateUsed(
+            response, "gemcore/_balance_multiple_currency.html"
+        )
+        self.assertEqual(
+            response.context["balances"], book.currency_balances()
+        )
+        self.assertContains(response, "<h3>For EUR</h3>")
+        self.assertContains(response, "<h3>For USD</h3>")
+
+
 class BulkMergeTestCase(BulkTestCaseMixin, BaseTestCase):
     action_name = "merge-selected"
     action_btn = (
@@ -12,6 +12,11 @@ urlpatterns = [
         gemcore.views.load_from_file,
         name="load-from-file",
     ),
+    path(
+        "<slug:book_slug>/fromfile/<int:job_id>/",
+        gemcore.views.import_job,
+        name="import-job",
+    ),
     path(
         "<slug:book_slug>/transfer/",
         gemcore.views.account_transfer,
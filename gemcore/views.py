@@ -1,10 +1,9 @@
 from datetime import datetime, timedelta
-from io import StringIO
 from urllib.parse import urlencode
 
-import chardet
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
+from django.core.files.base import ContentFile
 from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
 from django.http import Http404, HttpResponseRedirect
 from django.shortcuts import get_object_or_404, render
@@ -26,8 +25,14 @@ from gemcore.forms import (
     EntryForm,
     EntryMergeForm,
 )
-from gemcore.models import Account, Asset, Book, Entry
-from gemcore.parser import CSVParser
+from gemcore.models import (
+    Account,
+    Asset,
+    Book,
+    Entry,
+    ImportJob,
+    update_entries,
+)
 
 ENTRIES_PER_PAGE = 25
 MAX_PAGES = 4
@@ -169,16 +174,17 @@ def parse_request(request, book, **kwargs):
         "who": who,
         "year": year,
     }
+    facets = book.facets(entries)
     available = {
-        "countries": sorted(book.countries(entries).items()),
-        "currencies": sorted(book.currencies(entries).items()),
+        "countries": sorted(facets["countries"].items()),
+        "currencies": sorted(facets["currencies"].items()),
         "months": [
             (d.strftime("%b").lower(), i)
-            for d, i in sorted(book.months(entries).items())
+            for d, i in sorted(facets["months"].items())
         ],
-        "tags": sorted(book.tags(entries).items()),
-        "users": sorted(book.who(entries).items()),
-        "years": sorted(book.years(entries).items()),
+        "tags": sorted(facets["tags"].items()),
+        "users": sorted(facets["who"].items()),
+        "years": sorted(facets["years"].items()),
     }
     return entries, filters, available
 
@@ -234,7 +240,7 @@ def entries(request, book_slug):
                         request, "Invalid request, target account is empty."
                     )
                 else:
-                    entries.update(account=target)
+                    update_entries(entries, account=target)
                     msg = (
                         ", ".join(str(e) for e in entries.order_by("id")),
                         target,
@@ -258,7 +264,7 @@ def entries(request, book_slug):
                         request, "Invalid request, target asset is empty."
                     )
                 else:
-                    entries.update(asset=target)
+                    update_entries(entries, asset=target)
                     msg = (
                         ", ".join(str(e) for e in entries.order_by("id")),
                         target,
@@ -282,7 +288,7 @@ def entries(request, book_slug):
                         request, "Invalid request, target tags are empty."
                     )
                 else:
-                    entries.update(tags=[target])
+                    update_entries(entries, tags=[target])
                     msg = (
                         ", ".join(str(e) for e in entries.order_by("id")),
                         target,
@@ -306,7 +312,7 @@ def entries(request, book_slug):
                         request, "Invalid request, target country are empty."
                     )
                 else:
-                    entries.update(country=target)
+                    update_entries(entries, country=target)
                     msg = (
                         ", ".join(str(e) for e in entries.order_by("id")),
                         target,
@@ -342,21 +348,13 @@ def entries(request, book_slug):
             template = "gemcore/remove-entries.html"
 
         elif "calculate-balance" in request.POST:
-            entries = entries.select_related("account")
-            currencies = entries.values_list(
-                "account__currency", flat=True
-            ).distinct()
-            if len(currencies) < 2:
+            balances = book.currency_balances(entries)
+            if len(balances) < 2:
                 template = "gemcore/_balance_result.html"
-                context["balance"] = book.balance(entries)
+                context["balance"] = next(iter(balances.values()), None)
             else:
                 template = "gemcore/_balance_multiple_currency.html"
-                context["balances"] = {
-                    currency: book.balance(
-                        entries.filter(account__currency=currency)
-                    )
-                    for currency in currencies
-                }
+                context["balances"] = balances
 
         else:
             raise Http404()
@@ -570,17 +568,6 @@ def load_from_file(request, book_slug):
             book=book, data=request.POST, files=request.FILES
         )
         if form.is_valid():
-            uploaded_file = form.cleaned_data.get("csv_file")
-            if uploaded_file:
-                csv_content = uploaded_file.file.read()
-                encoding = chardet.detect(csv_content)["encoding"]
-                csv_file = StringIO(csv_content.decode(encoding))
-                csv_file.name = uploaded_file.name
-            else:
-                csv_content = form.cleaned_data.get("csv_content")
-                csv_file = StringIO(csv_content)
-                csv_file.name = ""
-
             account = form.cleaned_data["account"]
             if account.parser_config is None:
                 messages.error(
@@ -589,39 +576,24 @@ def load_from_file(request, book_slug):
                 )
                 return HttpResponseRedirect(".")
 
-            result = CSVParser(account).parse(
-                csv_file, book=book, user=request.user
-            )
-            success = len(result["entries"])
-            errors = len(result["errors"])
-            if not errors:
-                messages.success(
-                    request,
-                    "File %s successfully parsed (%s entries added)."
-                    % (csv_file.name, success),
-                )
-            elif success:
-                messages.warning(
-                    request,
-                    "File %s partially parsed (%s successes, %s errors)."
-                    % (csv_file.name, success, errors),
-                )
+            uploaded_file = form.cleaned_data.get("csv_file")
+            if uploaded_file:
+                name = uploaded_file.name
             else:
-                messages.error(
-                    request,
-                    "File %s could not be parsed (%s errors)."
-                    % (csv_file.name, errors),
-                )
-
-            if errors:
-                for error in result["errors"]:
-                    e = error["exception"]
-                    msg = error["message"]
-                    data = error["data"]
-                    messages.error(request, "%s\n\n%s\n%r" % (e, msg, data))
+                name = ""
+                content = form.cleaned_data.get("csv_content").encode("utf-8")
+                uploaded_file = ContentFile(content, name="content.csv")
 
+            # The file is stored in chunks, and read back by the worker.
+            job = ImportJob.objects.create(
+                book=book,
+                account=account,
+                who=request.user,
+                name=name,
+                file=uploaded_file,
+            )
             return HttpResponseRedirect(
-                reverse("entries", kwargs=dict(book_slug=book_slug))
+                reverse("import-job", args=(book_slug, job.id))
             )
     else:
         form = CSVExpenseForm(book=book)
@@ -630,6 +602,19 @@ def load_from_file(request, book_slug):
     return render(request, "gemcore/load.html", context)
 
 
+@require_GET
+@login_required
+def import_job(request, book_slug, job_id):
+    book = get_object_or_404(Book, slug=book_slug, users=request.user)
+    job = get_object_or_404(ImportJob, book=book, id=job_id)
+    context = dict(book=book, job=job)
+    if request.htmx:
+        template = "gemcore/_import_job.html"
+    else:
+        template = "gemcore/import-job.html"
+    return render(request, template, context)
+
+
 @require_http_methods(["GET", "POST"])
 @login_required
 def account_transfer(request, book_slug):
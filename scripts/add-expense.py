@@ -1,21 +1,86 @@
 import argparse
+import csv
+import json
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pprint
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+ENDPOINT = "/api/entries/"
+BATCH_ENDPOINT = "/api/entries/batch/"
+# Responses worth retrying, the request may succeed if sent again later.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Of those, the ones answered before the request is processed, so even a POST
+# can be sent again without adding the same entries twice.
+UNPROCESSED_STATUSES = (429, 503)
+
+
+class PostRetry(Retry):
+    """A Retry sending POST requests again only if they were not processed.
+
+    Other errors, such as a gateway timeout or a dropped connection while
+    waiting for the response, may come after the entries were added.
+
+    """
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method.upper() == "POST":
+            return status_code in UNPROCESSED_STATUSES
+        return super(PostRetry, self).is_retry(
+            method, status_code, has_retry_after
+        )
+
+
+def make_session(token, workers=1, retries=3, backoff=0.5):
+    """Return a session with a connection pool big enough for `workers`.
+
+    Connection errors and transient errors (see RETRY_STATUSES) are retried
+    up to `retries` times, sleeping `backoff * 2 ** attempt` seconds between
+    attempts. POST requests are only retried if they could not reach the
+    server, or were rejected before being processed (see PostRetry).
+
+    """
+    session = requests.Session()
+    session.headers.update(
+        {
+            "Content-Type": "application/json",
+            "Authorization": f"Token {token}",
+        }
+    )
+    retry = PostRetry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=RETRY_STATUSES,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=1, pool_maxsize=workers, max_retries=retry
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
 
 def add_expense(
-    book, account, what, amount, tags, country, notes, verbose=False
+    book,
+    account,
+    what,
+    amount,
+    tags,
+    country,
+    notes,
+    verbose=False,
+    session=None,
 ):
     token = os.getenv("CGEM_TOKEN", "Invalid")
     base_url = os.getenv("CGEM_ROOT_URL", "http://localhost:8000")
-    endpoint = "/api/entries/"
-    url = base_url + endpoint
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Token {token}",
-    }
+    url = base_url + ENDPOINT
+    if session is None:
+        session = make_session(token)
     data = {
         "book": book,
         "account": account,
@@ -24,18 +89,121 @@ def add_expense(
         "country": country,
         "notes": notes,
     }
+    # Without tags, the server finds them from the account rules.
+    if tags is not None:
+        data["tags"] = tags
     if verbose:
         print("\n*** About to POST data to:", url)
-        print("*** with headers:", headers)
+        print("*** with headers:", session.headers)
         pprint(data)
 
-    response = requests.post(url, json=data, headers=headers)
+    response = session.post(url, json=data)
     if verbose:
         print("\n*** Result:", response.status_code)
     assert response.ok, "%s: %s" % (response.status_code, response.text)
     pprint(response.json())
 
 
+def read_expenses(fileobj, fmt, defaults):
+    """Yield the expenses in `fileobj`, either CSV (with header) or JSONL.
+
+    Missing fields are taken from `defaults`. In CSV files, the tags column
+    is a comma separated list of tags. Expenses with no tags are tagged by
+    the server.
+
+    """
+    if fmt == "csv":
+        rows = csv.DictReader(fileobj)
+    else:
+        rows = (json.loads(line) for line in fileobj if line.strip())
+    for row in rows:
+        expense = dict(defaults)
+        expense.update((k, v) for k, v in row.items() if v not in (None, ""))
+        if isinstance(expense.get("tags"), str):
+            expense["tags"] = [
+                t.strip() for t in expense["tags"].split(",") if t.strip()
+            ]
+        yield expense
+
+
+def chunked(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def post_single(session, url, expense):
+    try:
+        response = session.post(url, json=expense)
+    except requests.RequestException as e:
+        return {"status": None, "errors": str(e)}
+    if response.status_code == 201:
+        return {"status": 201, "entry": response.json()}
+    return {"status": response.status_code, "errors": response.text}
+
+
+def post_chunk(session, base_url, chunk):
+    """POST `chunk` to the batch endpoint, or one by one if not available.
+
+    Return the list of per expense results, and whether the batch endpoint
+    was available.
+
+    """
+    try:
+        response = session.post(base_url + BATCH_ENDPOINT, json=chunk)
+    except requests.RequestException as e:
+        return [{"status": None, "errors": str(e)}] * len(chunk), True
+    if response.status_code in (404, 405):
+        url = base_url + ENDPOINT
+        return [post_single(session, url, e) for e in chunk], False
+    try:
+        return response.json()["results"], True
+    except (ValueError, KeyError):
+        error = {"status": response.status_code, "errors": response.text}
+        return [error] * len(chunk), True
+
+
+def add_expenses(expenses, workers=4, chunk_size=100, retries=3):
+    """Add all the given `expenses`, returning a result for each of them.
+
+    Expenses are sent in chunks of `chunk_size` to the batch endpoint, with
+    at most `workers` requests in flight. If the server has no batch
+    endpoint, every expense is POSTed on its own, using as many workers.
+
+    """
+    token = os.getenv("CGEM_TOKEN", "Invalid")
+    base_url = os.getenv("CGEM_ROOT_URL", "http://localhost:8000")
+    session = make_session(token, workers=workers, retries=retries)
+    chunks = chunked(expenses, chunk_size)
+
+    # Find out whether the batch endpoint is available with the first chunk.
+    results, batch = [], True
+    first = next(chunks, None)
+    if first is not None:
+        results, batch = post_chunk(session, base_url, first)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        if batch:
+            for chunk_results, _ in executor.map(
+                lambda chunk: post_chunk(session, base_url, chunk), chunks
+            ):
+                results.extend(chunk_results)
+        else:
+            url = base_url + ENDPOINT
+            results.extend(
+                executor.map(
+                    lambda expense: post_single(session, url, expense),
+                    (e for chunk in chunks for e in chunk),
+                )
+            )
+    return results
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-v", "--verbose", action="store_true")
@@ -48,18 +216,103 @@ def main():
         default="US",
         help="The country where the expense occurred",
     )
-    parser.add_argument("--tags", nargs="+", default=["imported"])
+    parser.add_argument(
+        "--tags",
+        nargs="+",
+        help="The expense tags (default: found by the server)",
+    )
     parser.add_argument(
         "--notes",
         default="Submitted via API",
         help="Extra notes/comments for the expense",
     )
-    parser.add_argument("what", help="The expense description")
-    parser.add_argument("amount", help="The expense amount")
+    parser.add_argument(
+        "--batch",
+        metavar="FILE",
+        help=(
+            "Add the expenses in FILE (CSV with header, or JSONL) instead of "
+            "a single one, use - to read from stdin. The other options are "
+            "used as defaults for the missing fields."
+        ),
+    )
+    parser.add_argument(
+        "--format",
+        choices=("csv", "jsonl"),
+        help="The format of the batch file (default: guessed from its name)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Amount of concurrent requests in batch mode",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=100,
+        help="Amount of expenses sent per batch request",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=3,
+        help="Amount of retries for transient failures",
+    )
+    parser.add_argument("what", nargs="?", help="The expense description")
+    parser.add_argument("amount", nargs="?", help="The expense amount")
 
     args = parser.parse_args()
 
-    add_expense(**vars(args))
+    if args.batch is None:
+        if args.what is None or args.amount is None:
+            parser.error("what and amount are required unless using --batch")
+        add_expense(
+            book=args.book,
+            account=args.account,
+            what=args.what,
+            amount=args.amount,
+            tags=args.tags,
+            country=args.country,
+            notes=args.notes,
+            verbose=args.verbose,
+        )
+        return
+
+    fmt = args.format
+    if fmt is None:
+        fmt = "csv" if args.batch.lower().endswith(".csv") else "jsonl"
+    defaults = {
+        "book": args.book,
+        "account": args.account,
+        "country": args.country,
+        "notes": args.notes,
+    }
+    if args.tags is not None:
+        defaults["tags"] = args.tags
+    if args.batch == "-":
+        fileobj = sys.stdin
+    else:
+        fileobj = open(args.batch, newline="")
+    with fileobj:
+        results = add_expenses(
+            read_expenses(fileobj, fmt, defaults),
+            workers=args.workers,
+            chunk_size=args.chunk_size,
+            retries=args.retries,
+        )
+
+    errors = 0
+    for i, result in enumerate(results):
+        if result["status"] == 201:
+            if args.verbose:
+                pprint(result["entry"])
+            continue
+        errors += 1
+        print("*** Expense %s failed (%s):" % (i, result["status"]))
+        pprint(result["errors"])
+    print("%s expenses added, %s errors" % (len(results) - errors, errors))
+    if errors:
+        sys.exit(1)
 
 
 if __name__ == "__main__":